@@ -0,0 +1,52 @@
+"""
+Benchmark of the th_affine2d backends and of AffineCompose on an image + mask pair.
+
+Usage: python tests/benchmarks/bench_affine2d.py [--size 512] [--repeats 20] [--device cpu]
+"""
+
+import argparse
+import time
+
+import torch as th
+
+from wick.transforms import AffineCompose, Rotate, Zoom
+from wick.utils import th_affine2d
+
+
+def _time(fn, repeats, device):
+    fn()        # warm-up (also fills the grid cache)
+    if device.startswith('cuda'):
+        th.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    if device.startswith('cuda'):
+        th.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats * 1000.
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--device', type=str, default='cpu')
+    args = parser.parse_args()
+
+    image = th.rand(3, args.size, args.size, device=args.device)
+    mask = th.randint(0, 5, (1, args.size, args.size), device=args.device).float()
+    matrix = th.FloatTensor([[0.9, -0.2, 3.], [0.2, 0.9, -3.], [0., 0., 1.]])
+
+    print('th_affine2d on a 3x%ix%i image (ms per call)' % (args.size, args.size))
+    for backend in ('gather', 'grid_sample'):
+        ms = _time(lambda: th_affine2d(image, matrix, backend=backend), args.repeats, args.device)
+        print('  %-12s %8.2f' % (backend, ms))
+
+    tform = AffineCompose([Rotate(10), Zoom(0.9)], interp=['bilinear', 'nearest'])
+    legacy = lambda: (th_affine2d(image, matrix, backend='gather'), th_affine2d(mask, matrix, mode='nearest', backend='gather'))
+    print('image + mask pair (ms per call)')
+    print('  %-12s %8.2f' % ('gather', _time(legacy, args.repeats, args.device)))
+    print('  %-12s %8.2f' % ('AffineCompose', _time(lambda: tform(image, mask), args.repeats, args.device)))
+
+
+if __name__ == '__main__':
+    main()
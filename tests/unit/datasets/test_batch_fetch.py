@@ -0,0 +1,128 @@
+"""
+Tests for the batch fetch protocol (__getitems__) of wick datasets
+"""
+
+import numpy as np
+import pandas as pd
+import torch as th
+from torch.utils.data import DataLoader, Subset
+from torch.utils.data.dataloader import default_collate
+
+from wick.datasets.CSVDataset import CSVDataset
+from wick.datasets.TensorDataset import TensorDataset
+from wick.datasets.data_utils import SampleBatch, collate_batch
+from wick.datasets.tnt.batchdataset import BatchDataset
+from wick.datasets.tnt.tensordataset import TensorDataset as TntTensorDataset
+from wick.transforms import RandomFlip
+
+
+def test_tensor_dataset_getitems_matches_getitem():
+    x = th.rand(10, 1, 4, 4)
+    y = th.arange(10)
+    dataset = TensorDataset(x, y, input_transform=RandomFlip(p=1))
+    batch = dataset.__getitems__([3, 1, 7])
+    assert isinstance(batch, SampleBatch)
+    for sample, idx in zip(batch, [3, 1, 7]):
+        assert th.equal(sample[0], dataset[idx][0]) and sample[1] == dataset[idx][1]
+
+    inputs, targets = collate_batch(batch)
+    assert th.equal(inputs, x[[3, 1, 7]].flip(-1)) and th.equal(targets, y[[3, 1, 7]])
+
+
+def test_batch_transforms_get_whole_batch():
+    calls = []
+    def tform(x):
+        calls.append(tuple(x.shape))
+        return x
+    tform.batch = True
+
+    dataset = TensorDataset(th.rand(8, 3), th.arange(8), input_transform=tform)
+    loader = DataLoader(dataset, batch_size=4)
+    assert [len(b[0]) for b in loader] == [4, 4]
+    assert calls == [(4, 3), (4, 3)]
+
+
+def test_csv_dataset_getitems_matches_getitem():
+    df = pd.DataFrame({'a': np.arange(6.), 'b': np.arange(6.) * 2, 'y': np.arange(6) % 2})
+    dataset = CSVDataset(df, input_cols=['a', 'b'], target_cols=['y'])
+    batch = dataset.__getitems__([5, 0])
+    for sample, idx in zip(batch, [5, 0]):
+        assert np.array_equal(sample[0], dataset[idx][0]) and sample[1] == dataset[idx][1]
+
+    # string columns give the same types as __getitem__ + default collate
+    df = pd.DataFrame({'path': ['a.png', 'b.png', 'c.png'], 'y': [0, 1, 0]})
+    dataset = CSVDataset(df, input_cols=['path'], target_cols=['y'])
+    paths, targets = collate_batch(dataset.__getitems__([2, 0]))
+    expected_paths, expected_targets = next(iter(DataLoader(Subset(dataset, [2, 0]), batch_size=2, collate_fn=default_collate)))
+    assert paths == list(expected_paths) == ['c.png', 'a.png'] and th.equal(targets, expected_targets)
+
+
+def test_tnt_batch_dataset_uses_batch_fetch():
+    data = {'x': th.rand(10, 3), 'y': th.arange(10)}
+    batches = BatchDataset(TntTensorDataset(data), batchsize=4)
+    assert len(batches) == 3
+    assert th.equal(batches[1]['x'], data['x'][4:8])
+    assert th.equal(batches[2]['y'], data['y'][8:])
+
+
+def test_collate_channels_last():
+    from wick.datasets.data_utils import collate_channels_last
+    from wick.transforms import ChannelsFirst
+
+    hwc = [th.rand(5, 6, 3) for _ in range(4)]
+    samples = [(ChannelsFirst()(x), th.zeros(5, 6).long(), 1) for x in hwc]
+    x, mask, label = collate_channels_last(samples)
+    assert x.shape == (4, 3, 5, 6) and x.is_contiguous(memory_format=th.channels_last)
+    assert th.equal(x, th.stack([s[0] for s in samples]))
+    assert mask.shape == (4, 5, 6) and label.tolist() == [1] * 4
+
+    # contiguous CHW samples are converted as well
+    x = collate_channels_last([th.rand(3, 5, 6) for _ in range(2)])
+    assert x.is_contiguous(memory_format=th.channels_last)
+
+    dataset = TensorDataset(th.rand(8, 3, 5, 6), th.arange(8))
+    x, y = collate_channels_last(dataset.__getitems__([0, 1, 2]))
+    assert x.is_contiguous(memory_format=th.channels_last) and y.tolist() == [0, 1, 2]
+
+
+def test_batch_fetch_loader_keeps_loader_options():
+    from wick.modules._utils import _batch_fetch_loader
+
+    def worker_init_fn(worker_id):
+        pass
+    generator = th.Generator()
+    loader = DataLoader(TensorDataset(th.rand(6, 2), th.rand(6)), batch_size=4, shuffle=True, drop_last=True, num_workers=1,
+                        worker_init_fn=worker_init_fn, generator=generator, prefetch_factor=3, persistent_workers=True,
+                        timeout=5, multiprocessing_context='spawn')
+    fetching = _batch_fetch_loader(loader)
+    assert fetching is not loader and fetching.collate_fn is collate_batch
+    assert fetching.batch_sampler is loader.batch_sampler
+    for name in ('num_workers', 'worker_init_fn', 'generator', 'prefetch_factor', 'persistent_workers', 'timeout',
+                 'multiprocessing_context', 'pin_memory', 'pin_memory_device'):
+        assert getattr(fetching, name) == getattr(loader, name)
+    batches = iter([])
+    assert _batch_fetch_loader(batches) is batches
+
+
+def test_variable_size_samples_with_custom_collate():
+    from wick.datasets.data_utils import PadCollate
+
+    def crop(x):
+        size = 2 + int(x[0, 0, 0] * 3)
+        return x[:, :size, :size]
+
+    x = th.rand(6, 1, 5, 5)
+    x[:, 0, 0, 0] = th.tensor([0., 0.5, 0.9, 0.1, 0.4, 0.7])
+    dataset = TensorDataset(x, th.arange(6), input_transform=crop)
+    samples = dataset.__getitems__([0, 1, 2])
+    assert not isinstance(samples, SampleBatch)
+    for sample, idx in zip(samples, [0, 1, 2]):
+        assert th.equal(sample[0], dataset[idx][0]) and sample[1] == idx
+
+    loader = DataLoader(dataset, batch_size=3, collate_fn=PadCollate())
+    for inputs, targets in loader:
+        assert inputs.shape[:2] == (3, 1) and len(targets) == 3
+
+    df = pd.DataFrame({'a': np.arange(4.), 'b': np.arange(4.)})
+    dataset = CSVDataset(df, input_cols=['a', 'b'], input_transform=lambda row: row[:1 + int(row[0]) % 2])
+    assert [len(s) for s in dataset.__getitems__([0, 1, 2])] == [1, 2, 1]
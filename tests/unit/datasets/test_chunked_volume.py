@@ -0,0 +1,61 @@
+"""
+Tests for wick/datasets/ChunkedVolume.py and wick/datasets/VolumePatchDataset.py
+"""
+
+import os
+import pickle
+
+import numpy as np
+
+from wick.datasets.ChunkedVolume import ChunkedVolume, ChunkCache, convert_npy_folder
+from wick.datasets.VolumePatchDataset import VolumePatchDataset
+
+
+def test_chunked_volume_reads_regions(tmpdir):
+    array = np.random.rand(9, 10, 7).astype(np.float32)
+    volume = ChunkedVolume.create(os.path.join(str(tmpdir), 'v.wvol'), array, chunks=(4, 4, 4))
+    assert volume.shape == (9, 10, 7) and volume.grid == (3, 3, 2)
+
+    assert np.array_equal(volume[2:7, 3:10, 1:6], array[2:7, 3:10, 1:6])
+    assert np.array_equal(volume[5], array[5])
+    assert np.array_equal(volume[:, 4, -1], array[:, 4, -1])
+
+    region = volume.read((-2, 8, 5), (4, 4, 4))      # partly outside the volume
+    assert np.array_equal(region[2:, :2, :2], array[:2, 8:, 5:])
+    assert region[:2].sum() == 0 and region[:, 2:].sum() == 0
+
+    volume.cache = ChunkCache(max_bytes=2 * 4 ** 3 * 4, chunk_bytes=4 ** 3 * 4)
+    assert np.array_equal(volume[0:8, 0:4, 0:4], array[0:8, 0:4, 0:4])
+    assert len(volume.cache) == 2
+    assert np.array_equal(volume[0:8, 0:4, 0:4], array[0:8, 0:4, 0:4])       # served from the cache
+    assert np.array_equal(volume[4:8, 4:8, 4:7], array[4:8, 4:8, 4:7])       # evicts the least recently used chunk
+
+    volume.cache = None      # the shared cache reaches workers through process spawning, not plain pickling
+    volume = pickle.loads(pickle.dumps(volume))
+    assert np.array_equal(volume[3:9, 6:10, 2:7], array[3:9, 6:10, 2:7])
+
+
+def test_volume_patch_dataset_from_npy_folder(tmpdir):
+    root = str(tmpdir)
+    os.makedirs(os.path.join(root, 'npy', 'a'))
+    image = np.random.randint(0, 100, size=(6, 8, 8)).astype(np.int16)
+    label = (image > 50).astype(np.uint8)
+    np.save(os.path.join(root, 'npy', 'a', 'image.npy'), image)
+    np.save(os.path.join(root, 'npy', 'a', 'label.npy'), label)
+
+    paths = convert_npy_folder(os.path.join(root, 'npy'), os.path.join(root, 'wvol'), chunks=(4, 4, 4))
+    assert [os.path.relpath(p, root) for p in paths] == [os.path.join('wvol', 'a', 'image.wvol'),
+                                                        os.path.join('wvol', 'a', 'label.wvol')]
+
+    dataset = VolumePatchDataset([paths[0]], [paths[1]], patch_size=4, overlap=1)
+    assert dataset.cache is None        # no shared memory unless asked for
+    assert VolumePatchDataset([paths[0]], patch_size=4, cache_bytes=1024).cache is not None
+    assert len(dataset) == 2 * 3 * 3
+    for index in range(len(dataset)):
+        _, z, y, x = dataset.patches[index]
+        patch, target = dataset[index]
+        assert np.array_equal(patch, image[z:z + 4, y:y + 4, x:x + 4])
+        assert np.array_equal(target, label[z:z + 4, y:y + 4, x:x + 4])
+
+    patch, _ = dataset.read_patch(0, (4, 6, 6), size=(4, 4, 4))
+    assert patch.shape == (4, 4, 4) and np.array_equal(patch[:2, :2, :2], image[4:, 6:, 6:])
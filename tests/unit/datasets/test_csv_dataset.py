@@ -0,0 +1,54 @@
+"""
+Tests for wick/datasets/CSVDataset.py
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from wick.datasets.CSVDataset import CSVDataset
+
+
+def _table():
+    return pd.DataFrame({'a': np.arange(10.), 'b': np.arange(10.) * 2, 'y': np.arange(10) % 3,
+                         'split': ['train', 'val'] * 5, 'unused': ['x'] * 10})
+
+
+def test_csv_file_reads_only_needed_columns(tmpdir):
+    path = os.path.join(str(tmpdir), 'table.csv')
+    _table().to_csv(path, index=False)
+
+    dataset = CSVDataset(path, input_cols=['a', 'b'], target_cols=[2], chunksize=3)
+    assert len(dataset) == 10
+    assert np.array_equal(dataset[4][0], [4., 8.]) and dataset[4][1] == 1
+    assert sorted(dataset._columns._cache) == ['a', 'b', 'y']
+
+    # df is built on demand from the file
+    assert dataset.df.equals(pd.read_csv(path))
+    train, _ = dataset.split_by_column('split')
+    assert train.df['a'].tolist() == [0., 2., 4., 6., 8.]
+
+
+def test_empty_csv_keeps_header_dtypes(tmpdir):
+    path = os.path.join(str(tmpdir), 'empty.csv')
+    _table().iloc[:0].to_csv(path, index=False)
+    dataset = CSVDataset(path, input_cols=['a', 'split'])
+    assert len(dataset) == 0
+    header = pd.read_csv(path, nrows=0)
+    assert dataset._columns.column('a').dtype == header['a'].dtype
+
+
+def test_splits_are_index_views():
+    dataset = CSVDataset(_table(), input_cols=['a'], target_cols=['y'])
+    train, val = dataset.split_by_column('split')
+    assert len(train) == 5 and len(val) == 5
+    assert train.inputs is dataset.inputs
+    assert dataset.df is dataset.source and train.df['split'].unique().tolist() == ['train']
+    assert [val[i][0] for i in range(5)] == [1., 3., 5., 7., 9.]
+
+    first, second = val.train_test_split(0.6)
+    assert len(first) == 3 and len(second) == 2
+    assert sorted([first[i][0] for i in range(3)] + [second[i][0] for i in range(2)]) == [1., 3., 5., 7., 9.]
+    batch = second.__getitems__([0, 1])
+    assert [sample[0] for sample in batch] == [second[0][0], second[1][0]]
@@ -0,0 +1,214 @@
+"""
+Tests for wick/datasets/FolderDataset.py
+"""
+
+import os
+
+import numpy as np
+import pytest
+import torch as th
+from PIL import Image
+
+from wick.datasets.ClonedDataset import random_split_dataset
+from wick.datasets.FolderDataset import FolderDataset, bw_image_loader, identity_x, rgb_image_loader
+from wick.datasets.PredictFolderDataset import PredictFolderDataset
+from wick.datasets.data_utils import SampleCache, SampleIndex, SampleQuarantine, _StringArray, npy_loader, _build_index_lut, _remap_mask
+from wick.transforms import MaskToTensor
+
+
+def _make_segmentation_folder(root):
+    os.makedirs(os.path.join(root, 'images', 'cls'))
+    os.makedirs(os.path.join(root, 'masks', 'cls'))
+
+    mask = np.zeros((8, 8), dtype=np.uint8)
+    mask[2:4, 2:4] = 128
+    mask[5:7, 5:7] = 255
+    Image.fromarray(np.zeros((8, 8, 3), dtype=np.uint8)).save(os.path.join(root, 'images', 'cls', 'a.png'))
+    Image.fromarray(mask).save(os.path.join(root, 'masks', 'cls', 'a.png'))
+    return mask
+
+
+def test_remap_mask_lut_matches_loop():
+    mask = np.random.randint(0, 256, size=(16, 16)).astype(np.uint8)
+    index_map = {255: 1, 128: 2, 7: 0}
+
+    expected = mask.astype(np.float32)
+    for k, v in index_map.items():
+        expected[mask == k] = v
+
+    lut = _build_index_lut(index_map, dtype=np.float32)
+    assert np.array_equal(_remap_mask(mask, index_map, lut=lut), expected)
+    # non-8-bit masks fall back to the per-key loop
+    assert np.array_equal(_remap_mask(mask.astype(np.int32), index_map, lut=lut), expected)
+
+
+def test_folder_dataset_compact_targets(tmpdir):
+    root = str(tmpdir)
+    mask = _make_segmentation_folder(root)
+
+    for compact in (False, True):
+        dataset = FolderDataset(os.path.join(root, 'images'), class_mode='image', rel_target_root='../masks',
+                                target_loader=bw_image_loader, target_index_map={255: 1, 128: 2},
+                                compact_targets=compact, target_transform=MaskToTensor('long'))
+        _, target = dataset[0]
+        assert target.dtype == th.int64
+        assert target[3, 3] == 2 and target[6, 6] == 1 and target[0, 0] == 0
+        assert target.shape == mask.shape
+
+
+def _make_label_folder(root):
+    for cls, count in (('cat', 3), ('dög', 2)):
+        os.makedirs(os.path.join(root, cls))
+        for i in range(count):
+            Image.fromarray(np.zeros((4, 4, 3), dtype=np.uint8)).save(os.path.join(root, cls, '%i.png' % i))
+
+
+def test_sample_index_round_trip():
+    items = [('/a/x.png', 0), ('/b/ünïcode.png', 2), ('/c/z.png', 1)]
+    index = SampleIndex(items)
+    assert len(index) == 3
+    assert list(index) == items and index[-1] == items[-1]
+    assert isinstance(index.inputs.buffer, np.ndarray) and index.targets.dtype == np.int64
+    assert type(index[0][1]) is int
+
+    assert index.select([2, 0]).tolist() == [items[2], items[0]]
+    assert index.select([]).tolist() == []
+
+    # list operations of the former list of tuples
+    assert index[:2] == items[:2] and index[::-1] == items[::-1] and index[5:] == []
+    assert index + [('/d.png', 3)] == items + [('/d.png', 3)] and [('/d.png', 3)] + index == [('/d.png', 3)] + items
+
+    paths = SampleIndex([('/a/x.png', '/m/x.png'), ('/a/y.png', '/m/y.png')])
+    assert isinstance(paths.targets, _StringArray)
+    assert paths.select([1]).tolist() == [('/a/y.png', '/m/y.png')]
+
+    # identical input/target paths (class_mode='path') are stored once
+    same = SampleIndex([('/a/x.png', '/a/x.png')])
+    assert same.targets is None and same[0] == ('/a/x.png', '/a/x.png')
+
+
+def test_folder_datasets_use_compact_index(tmpdir):
+    root = str(tmpdir)
+    _make_label_folder(root)
+
+    dataset = FolderDataset(root, class_mode='label', default_loader=identity_x)
+    assert isinstance(dataset.data, SampleIndex)
+    assert [target for _, target in dataset.getdata()] == [0, 0, 0, 1, 1]
+    assert dataset[3][0] == os.path.join(root, 'dög', '0.png')
+
+    predict = PredictFolderDataset(root)
+    assert predict.data.targets is None and predict[0][0] == predict[0][1]
+
+    assert dataset.get_sample_sizes().tolist() == [[4, 4]] * 5
+
+    part1, part2 = random_split_dataset(dataset, splitRatio=0.6, random_seed=1)
+    assert isinstance(part1.data, SampleIndex) and isinstance(part2.data, SampleIndex)
+    assert part1.get_sample_sizes().shape == (len(part1), 2)
+    assert sorted(part1.getdata().tolist() + part2.getdata().tolist()) == sorted(dataset.getdata().tolist())
+
+
+def test_folder_dataset_caches_deterministic_prefix(tmpdir):
+    from wick.transforms import Compose, RandomFlip, ToTensor, TypeCast
+    root = os.path.join(str(tmpdir), 'data')
+    _make_label_folder(root)
+
+    calls = []
+    def loader(path):
+        calls.append(path)
+        return np.full((4, 4, 3), len(calls), dtype=np.uint8)
+
+    transform = Compose([ToTensor(), TypeCast('float'), RandomFlip(p=1)])
+    for cache in ('memory', 'disk'):
+        del calls[:]
+        dataset = FolderDataset(root, class_mode='label', default_loader=loader, transform=transform,
+                                cache=cache, cache_dir=os.path.join(str(tmpdir), 'cache'))
+        first = [dataset[i][0] for i in range(len(dataset))]
+        second = [dataset[i][0] for i in range(len(dataset))]
+        assert len(calls) == len(dataset)           # every file is decoded once
+        assert all(th.equal(a, b) for a, b in zip(first, second))
+        assert first[0].dtype == th.float32
+        dataset.cache.clear()
+
+    part1, _ = random_split_dataset(dataset, splitRatio=0.6, random_seed=1)
+    assert part1.cache is dataset.cache
+
+
+def test_sample_cache_tiers_return_copies(tmpdir):
+    for cache in (SampleCache('memory'), SampleCache('disk', cache_dir=str(tmpdir))):
+        value = (th.zeros(3), np.zeros(2))
+        cache.put('a', value)
+        value[0].add_(1)                    # e.g. a random transform working in place
+        cached = cache.get('a')
+        cached[1][:] = 5
+        assert th.equal(cache.get('a')[0], th.zeros(3)) and np.array_equal(cache.get('a')[1], np.zeros(2))
+        assert cache.get('b') is None
+
+
+def test_folder_dataset_quarantines_corrupt_samples(tmpdir):
+    from torch.utils.data import DataLoader
+    from wick.transforms import ToTensor
+    root = os.path.join(str(tmpdir), 'data')
+    _make_label_folder(root)
+    corrupt = os.path.join(root, 'cat', '1.png')
+    with open(corrupt, 'wb') as f:
+        f.write(b'not a png')
+    qfile = os.path.join(str(tmpdir), 'quarantine.txt')
+
+    dataset = FolderDataset(root, class_mode='label', default_loader=lambda p: np.asarray(rgb_image_loader(p)),
+                            transform=ToTensor(), quarantine=qfile)
+    assert len(dataset) == 5
+    corrupt_index = [path for path, _ in dataset.getdata()].index(corrupt)
+    with pytest.warns(UserWarning):
+        x, _ = dataset[corrupt_index]       # a replacement sample is returned instead
+    assert x.shape == (4, 4, 3)
+    assert corrupt in dataset.quarantine and corrupt in SampleQuarantine(qfile)
+
+    batches = list(DataLoader(dataset, batch_size=5))
+    assert batches[0][0].shape == (5, 4, 4, 3)
+
+    # the next scan leaves the quarantined file out
+    rescanned = FolderDataset(root, class_mode='label', quarantine=qfile)
+    assert len(rescanned) == 4 and corrupt not in [path for path, _ in rescanned.getdata()]
+
+
+def test_folder_dataset_raises_transform_errors(tmpdir):
+    root = os.path.join(str(tmpdir), 'data')
+    _make_label_folder(root)
+    qfile = os.path.join(str(tmpdir), 'quarantine.txt')
+
+    def broken_transform(x):
+        raise ValueError('bug in a transform')
+    dataset = FolderDataset(root, class_mode='label', transform=broken_transform, quarantine=qfile)
+    with pytest.raises(ValueError):
+        dataset[0]
+    assert len(dataset.quarantine) == 0 and not os.path.exists(qfile)
+
+
+def test_folder_dataset_raises_loader_value_errors(tmpdir):
+    root = os.path.join(str(tmpdir), 'data')
+    _make_label_folder(root)
+    qfile = os.path.join(str(tmpdir), 'quarantine.txt')
+
+    def broken_loader(path):
+        raise ValueError('bug in a loader')
+    dataset = FolderDataset(root, class_mode='label', default_loader=broken_loader, quarantine=qfile)
+    with pytest.raises(ValueError):
+        dataset[0]
+    assert len(dataset.quarantine) == 0
+
+    # a truncated .npy file is a read error
+    path = os.path.join(str(tmpdir), 'broken.npy')
+    np.save(path, np.zeros((4, 4)))
+    with open(path, 'r+b') as f:
+        f.truncate(20)
+    with pytest.raises(OSError):
+        npy_loader(path)
+
+
+def test_quarantine_refreshes_on_interval(tmpdir):
+    qfile = os.path.join(str(tmpdir), 'quarantine.txt')
+    reader = SampleQuarantine(qfile, refresh_interval=3600)
+    SampleQuarantine(qfile).add('a.png', reason='broken')
+    assert 'a.png' not in reader        # not picked up before the interval is over
+    assert 'a.png' in reader.paths()    # explicit reads always refresh
+    assert 'a.png' in SampleQuarantine(qfile, refresh_interval=0)
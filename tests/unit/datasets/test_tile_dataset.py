@@ -0,0 +1,79 @@
+"""
+Tests for wick/datasets/TileDataset.py
+"""
+
+import os
+
+import numpy as np
+from PIL import Image
+
+from wick.datasets.TileDataset import TileDataset
+from wick.datasets.data_utils import _integral_image, _box_sums, _downsample_any, _tile_origins
+
+
+def _make_images(root):
+    image = np.random.randint(0, 255, size=(10, 12, 3)).astype(np.uint8)
+    mask = np.zeros((10, 12), dtype=np.uint8)
+    mask[7:10, 9:12] = 255
+    Image.fromarray(image).save(os.path.join(root, 'image.png'))
+    Image.fromarray(mask).save(os.path.join(root, 'mask.png'))
+    np.save(os.path.join(root, 'image.npy'), image)
+    np.save(os.path.join(root, 'mask.npy'), mask)
+    return image, mask
+
+
+def test_tile_origins_cover_axis():
+    assert _tile_origins(10, 4, overlap=1) == [0, 3, 6]
+    assert _tile_origins(12, 4, overlap=1) == [0, 3, 6, 8]
+    assert _tile_origins(3, 4) == [0]
+
+    mask = np.random.rand(7, 9) > 0.5
+    ii = _integral_image(mask)
+    assert ii[5, 8] - ii[2, 8] - ii[5, 3] + ii[2, 3] == mask[2:5, 3:8].sum()
+
+    volume = np.random.rand(5, 6, 7) > 0.5
+    sums = _box_sums(_integral_image(volume), [[1, 2, 0], [0, 0, 0]], [[4, 5, 7], [5, 6, 7]])
+    assert sums.tolist() == [volume[1:4, 2:5, :].sum(), volume.sum()]
+
+    coarse = _downsample_any(volume, (2, 4, 4))
+    assert coarse.shape == (3, 2, 2) and coarse[2, 1, 1] == volume[4:, 4:, 4:].any()
+
+
+def test_tile_dataset_reads_regions(tmpdir):
+    root = str(tmpdir)
+    image, mask = _make_images(root)
+
+    for ext in ('png', 'npy'):
+        dataset = TileDataset([os.path.join(root, 'image.' + ext)], [os.path.join(root, 'mask.' + ext)],
+                              tile_size=4, overlap=1, target_index_map={255: 1})
+        assert len(dataset) == 3 * 4
+        for index, (_, y, x) in enumerate(dataset.getdata()):
+            tile, target = dataset[index]
+            assert np.array_equal(np.asarray(tile), image[y:y + 4, x:x + 4])
+            assert np.array_equal(np.asarray(target), (mask[y:y + 4, x:x + 4] == 255).astype(np.float32))
+
+    # images smaller than a tile are zero padded
+    small = TileDataset([os.path.join(root, 'image.npy')], tile_size=16)
+    assert small[0].shape == (16, 16, 3) and np.array_equal(small[0][:10, :12], image)
+
+
+def test_tile_dataset_skips_empty_tiles(tmpdir):
+    root = str(tmpdir)
+    _make_images(root)
+    coverage_file = os.path.join(root, 'coverage.npz')
+
+    dataset = TileDataset([os.path.join(root, 'image.png')], [os.path.join(root, 'mask.png')], tile_size=4, overlap=1,
+                          skip_empty=True, coverage_file=coverage_file)
+    assert [tuple(t) for t in dataset.getdata()] == [(0, 6, 6), (0, 6, 8)]
+    assert os.path.exists(coverage_file)
+    # per-tile coverage matches a direct count (the mask is scanned in bands of tile height)
+    mask = np.asarray(Image.open(os.path.join(root, 'mask.png'))) != 0
+    expected = [mask[y:y + 4, x:x + 4].sum() / 16. for _, y, x in dataset._build_tiles()]
+    assert np.allclose(dataset.coverage, expected)
+    # tile origins (e.g. from ForegroundPatchSampler) can be used as indices directly
+    assert np.array_equal(np.asarray(dataset[(0, 6, 8)][1]), np.asarray(dataset[1][1]))
+
+    # the saved coverage index is reused without reading the masks again
+    reloaded = TileDataset([os.path.join(root, 'image.png')], ['missing.png'], tile_size=4, overlap=1,
+                           skip_empty=True, coverage_file=coverage_file)
+    assert np.array_equal(reloaded.getdata(), dataset.getdata())
@@ -0,0 +1,66 @@
+"""
+Tests for wick/datasets/tnt/table.py
+"""
+
+import numpy as np
+import torch as th
+from torch.utils.data import DataLoader
+
+from wick.datasets.tnt.batchdataset import BatchDataset
+from wick.datasets.tnt.table import BatchBufferRing, RingCollate, mergetensor
+from wick.datasets.tnt.transform import makebatch
+
+
+def test_mergetensor_into_buffer():
+    samples = [th.rand(3, 4) for _ in range(5)]
+    out = th.empty(5, 3, 4)
+    merged = mergetensor(samples, out=out)
+    assert merged.data_ptr() == out.data_ptr()
+    assert th.equal(merged, th.stack(samples))
+
+
+def test_buffer_ring_reuses_buffers():
+    ring = BatchBufferRing(size=2)
+    first = [ring.get((4, 3)).data_ptr() for _ in range(2)]
+    assert [ring.get((4, 3)).data_ptr() for _ in range(2)] == first
+    assert ring.get((2, 3)).data_ptr() not in first
+
+
+def test_makebatch_with_buffers():
+    ring = BatchBufferRing(size=1)
+    samples = [{'x': th.full((2,), float(i)), 'name': str(i)} for i in range(3)]
+    batch = makebatch(buffers=ring)(samples)
+    assert batch['name'] == ['0', '1', '2']
+    assert th.equal(batch['x'][:, 0], th.arange(3.))
+
+    # a batch that is still held is not overwritten, a dropped one is reused
+    other = makebatch(buffers=ring)([{'x': th.full((2,), -1.), 'name': ''} for _ in range(3)])
+    assert th.equal(batch['x'][:, 0], th.arange(3.)) and other['x'].data_ptr() != batch['x'].data_ptr()
+    ptr = other['x'].data_ptr()
+    del other
+    assert makebatch(buffers=ring)(samples)['x'].data_ptr() == ptr
+
+
+def test_makebatch_with_different_keys():
+    batch = makebatch()([{'x': th.zeros(2), 'a': 1}, {'x': th.ones(2), 'b': 2}])
+    assert batch['a'] == [1] and batch['b'] == [2] and batch['x'].shape == (2, 2)
+
+
+def test_ring_collate_matches_default_collate():
+    data = [(np.full((2, 2), i, dtype=np.float32), i) for i in range(10)]
+    loader = DataLoader(data, batch_size=4, collate_fn=RingCollate(BatchBufferRing(size=3)))
+    for (x, y), (ex, ey) in zip(loader, DataLoader(data, batch_size=4)):
+        assert th.equal(x, ex) and th.equal(y, ey)
+
+
+def test_batch_dataset_with_buffers():
+    class _Samples(object):
+        def __len__(self):
+            return 7
+
+        def __getitem__(self, idx):
+            return {'x': th.full((3,), float(idx))}
+
+    batches = BatchDataset(_Samples(), batchsize=3, buffers=BatchBufferRing(size=2))
+    assert th.equal(batches[2]['x'], th.full((1, 3), 6.))
+    assert th.equal(batches[1]['x'][:, 0], th.tensor([3., 4., 5.]))
@@ -0,0 +1,220 @@
+"""
+Tests for wick/modules/module_trainer.py
+"""
+
+import torch as th
+import torch.nn as nn
+from torch.utils.data import DataLoader, IterableDataset
+
+from wick.datasets.TensorDataset import TensorDataset
+from wick.modules import ModuleTrainer
+
+
+def _trainer():
+    model = nn.Sequential(nn.Conv2d(1, 2, kernel_size=1))
+    trainer = ModuleTrainer(model)
+    trainer.compile(optimizer='sgd', criterion='cross_entropy')
+    return trainer
+
+
+def test_fit_loader_applies_transforms():
+    x = th.rand(10, 1, 8, 8)
+    y = th.randint(0, 2, (10, 8, 8))
+    loader = DataLoader(TensorDataset(x, y), batch_size=4)
+
+    calls = []
+    def co_transform(input_batch, target_batch):
+        calls.append(input_batch.size(0))
+        return input_batch, target_batch
+
+    trainer = _trainer()
+    trainer.set_transforms((None, None, co_transform))
+    trainer.fit_loader(loader, num_epoch=2, verbose=0)
+    assert calls == [4, 4, 2] * 2
+
+
+def test_fit_loader_fetches_whole_batches():
+    calls = []
+    def input_transform(x):
+        calls.append(x.size(0))
+        return x
+    input_transform.batch = True
+
+    x = th.rand(10, 1, 8, 8)
+    y = th.randint(0, 2, (10, 8, 8))
+    loader = DataLoader(TensorDataset(x, y, input_transform=input_transform), batch_size=4, shuffle=True)
+
+    trainer = _trainer()
+    trainer.fit_loader(loader, num_epoch=1, verbose=0)
+    assert calls == [4, 4, 2]
+
+
+class _Stream(IterableDataset):
+    def __init__(self, with_targets=True):
+        self.with_targets = with_targets
+        self.num_passes = 0
+
+    def __iter__(self):
+        self.num_passes += 1
+        for _ in range(6):
+            if self.with_targets:
+                yield th.rand(1, 8, 8), th.randint(0, 2, (8, 8))
+            else:
+                yield th.rand(1, 8, 8)
+
+
+def test_fit_loader_iterable_dataset():
+    dataset = _Stream()
+    loader = DataLoader(dataset, batch_size=4)
+
+    batches = []
+    trainer = _trainer()
+    trainer.set_transforms((None, None, lambda x, y: (batches.append(x.size(0)) or x, y)))
+    trainer.fit_loader(loader, val_loader=DataLoader(_Stream(), batch_size=4), num_epoch=2, verbose=0)
+    assert batches == [4, 2] * 2
+    assert dataset.num_passes == 2
+
+    batches.clear()
+    trainer.fit_loader(loader, num_epoch=2, steps_per_epoch=3, verbose=0)
+    assert batches == [4, 2, 4, 2, 4, 2]
+    assert len(trainer.predict_loader(DataLoader(_Stream(with_targets=False), batch_size=4), verbose=0)) == 6
+
+
+def test_fit_loader_plain_generator():
+    def batches():
+        for _ in range(3):
+            yield th.rand(4, 1, 8, 8), th.randint(0, 2, (4, 8, 8))
+
+    seen = []
+    trainer = _trainer()
+    trainer.set_transforms((None, None, lambda x, y: (seen.append(x.size(0)) or x, y)))
+    trainer.fit_loader(batches(), val_loader=batches(), num_epoch=1, verbose=0)
+    assert seen == [4, 4, 4]
+    assert trainer.history.batch_size == 4
+
+
+def test_predict_tiled_matches_full_prediction():
+    import numpy as np
+    from wick.modules._utils import _tile_blend_weights
+
+    model = nn.Conv2d(3, 2, kernel_size=1)       # pointwise, so tiling must not change the result
+    trainer = ModuleTrainer(model)
+    x = th.rand(3, 21, 17)
+    expected = model(x.unsqueeze(0))[0].detach()
+
+    for blend in ('gaussian', 'linear', 'constant'):
+        out = trainer.predict_tiled(x, tile_size=8, overlap=3, batch_size=5, blend=blend, verbose=0)
+        assert out.shape == (2, 21, 17)
+        assert th.allclose(out, expected, atol=1e-5)
+
+    # inputs smaller than a tile and preallocated (memmap-backed) outputs
+    buffer = th.from_numpy(np.zeros((2, 21, 17), dtype=np.float32))
+    out = trainer.predict_tiled(x, tile_size=(32, 8), overlap=(0, 2), out=buffer, verbose=0)
+    assert out.data_ptr() == buffer.data_ptr() and th.allclose(buffer, expected, atol=1e-5)
+
+    weight = _tile_blend_weights((8, 8, 8), 'gaussian')
+    assert weight.shape == (8, 8, 8) and weight.min() > 0 and weight.max() == 1
+
+
+def test_predict_tiled_volume():
+    model = nn.Conv3d(1, 2, kernel_size=1)
+    trainer = ModuleTrainer(model)
+    x = th.rand(1, 9, 10, 11)
+    out = trainer.predict_tiled(x, tile_size=4, overlap=1, verbose=0)
+    assert th.allclose(out, model(x.unsqueeze(0))[0].detach(), atol=1e-5)
+
+
+def test_input_normalization_runs_on_uint8_batches():
+    from wick.transforms import DeviceNormalize
+    x = th.randint(0, 256, (6, 1, 4, 4), dtype=th.uint8)
+    model = nn.Conv2d(1, 2, kernel_size=1)
+    trainer = ModuleTrainer(model)
+    trainer.compile(optimizer='sgd', criterion='cross_entropy', input_normalization=DeviceNormalize([0.5], [0.25]))
+
+    expected = model((x.float() / 255 - 0.5) / 0.25).detach()
+    assert th.allclose(trainer.predict(x, batch_size=4, verbose=0), expected, atol=1e-5)
+    loader = DataLoader(TensorDataset(x), batch_size=4)
+    assert th.allclose(trainer.predict_loader(loader, verbose=0), expected, atol=1e-5)
+
+
+class _RecordInputs(nn.Module):
+    def __init__(self, module):
+        super(_RecordInputs, self).__init__()
+        self.module = module
+        self.inputs = []
+
+    def forward(self, x):
+        self.inputs.append(x.detach().clone())
+        return self.module(x)
+
+
+def test_batch_transforms_run_before_input_normalization():
+    from wick.transforms import DeviceNormalize, RandomBatchColor
+    x = th.randint(0, 256, (4, 1, 4, 4), dtype=th.uint8)
+    y = th.randint(0, 2, (4, 4, 4))
+    model = _RecordInputs(nn.Conv2d(1, 2, kernel_size=1))
+    trainer = ModuleTrainer(model)
+    trainer.compile(optimizer='sgd', criterion='cross_entropy', input_normalization=DeviceNormalize([0.5], [0.25]))
+    trainer.set_transforms(RandomBatchColor(brightness_range=(0, 0), contrast_range=(1, 1)))
+    trainer.fit_loader(DataLoader(TensorDataset(x, y), batch_size=4), num_epoch=1, verbose=0)
+
+    # the color transform sees the uint8 data, the model the normalized data (not clamped to [0, 1])
+    assert th.allclose(model.inputs[0], (x.float() / 255 - 0.5) / 0.25, atol=1e-5)
+    assert model.inputs[0].min() < 0 and model.inputs[0].max() > 1
+
+
+def test_channels_last_trainer_matches_contiguous():
+    model = nn.Sequential(nn.Conv2d(3, 4, kernel_size=3, padding=1), nn.ReLU(), nn.Conv2d(4, 2, kernel_size=1))
+    x = th.rand(5, 3, 8, 8)
+    expected = model(x).detach()
+
+    trainer = ModuleTrainer(model, channels_last=True)
+    assert model[0].weight.is_contiguous(memory_format=th.channels_last)
+    out = trainer.predict(x, batch_size=2, verbose=0)
+    assert th.allclose(out, expected, atol=1e-5)
+
+
+def test_fit_loader_caches_validation_batches(tmpdir):
+    x = th.rand(10, 1, 8, 8)
+    y = th.randint(0, 2, (10, 8, 8))
+    calls = []
+    def input_transform(x):
+        calls.append(1)
+        return x
+
+    val_loader = DataLoader(TensorDataset(x, y, input_transform=input_transform), batch_size=4)
+    trainer = _trainer()
+    trainer.fit_loader(DataLoader(TensorDataset(x, y), batch_size=4), val_loader=val_loader, num_epoch=3, verbose=0,
+                       cache_validation=True)
+    assert len(calls) == 10      # the validation samples were only transformed in the first epoch
+
+    expected = trainer.evaluate_loader(val_loader, verbose=0)
+    for mode in ('device', 'pinned', 'disk'):
+        cached = trainer.cache_loader(val_loader, mode=mode, cache_dir=str(tmpdir))
+        assert len(cached) == 3 and cached.mode == mode
+        assert abs(trainer.evaluate_loader(cached, verbose=0)['val_loss'] - expected['val_loss']) < 1e-6
+    assert th.equal(cached.batches[2][0], x[8:]) and th.equal(cached.batches[2][1], y[8:])
+    assert tmpdir.listdir() == []      # the disk cache lives on in the mapping only
+
+
+def test_cached_batches_are_copies():
+    buffer = th.rand(4, 1, 8, 8), th.randint(0, 2, (4, 8, 8))
+    trainer = _trainer()
+    for mode in ('device', 'pinned'):
+        cached = trainer.cache_loader(DataLoader([buffer], batch_size=None), mode=mode)
+        expected = cached.batches[0][0].clone()
+        buffer[0].fill_(0)      # the loader reuses its buffer for the next batch
+        assert th.equal(cached.batches[0][0], expected)
+        buffer[0].copy_(expected)
+
+
+def test_channels_last_is_applied_after_batch_transforms():
+    from wick.transforms import RandomBatchAffine
+    x = th.rand(4, 3, 8, 8).contiguous(memory_format=th.channels_last)
+    y = th.randint(0, 2, (4, 8, 8))
+    model = _RecordInputs(nn.Conv2d(3, 2, kernel_size=1))
+    trainer = ModuleTrainer(model, channels_last=True)
+    trainer.compile(optimizer='sgd', criterion='cross_entropy')
+    trainer.set_transforms((None, None, RandomBatchAffine(rotation_range=10)))
+    trainer.fit(x, y, batch_size=4, num_epoch=1, verbose=0)
+    assert model.inputs[0].is_contiguous(memory_format=th.channels_last)
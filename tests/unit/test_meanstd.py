@@ -0,0 +1,43 @@
+"""
+Tests for wick/meanstd.py
+"""
+
+
+import numpy as np
+from PIL import Image
+
+from wick.meanstd import get_dataset_mean_std
+
+
+def _dataset(num_images=10):
+    rng = np.random.RandomState(0)
+    return [(Image.fromarray(rng.randint(0, 256, (16, 16 + i, 3)).astype(np.uint8)), 0) for i in range(num_images)]
+
+
+def test_mean_std_matches_numpy():
+    dataset = _dataset()
+    pixels = np.concatenate([np.asarray(img, dtype=np.float64).reshape(-1, 3) for img, _ in dataset])
+
+    mean, std = get_dataset_mean_std(dataset, img_size=None, batch_size=3)
+    assert np.allclose(mean, pixels.mean(0) / 255.0)
+    assert np.allclose(std, pixels.std(0) / 255.0)
+
+
+def test_mean_std_with_workers_and_subsample():
+    dataset = _dataset()
+    mean, std = get_dataset_mean_std(dataset, img_size=8, num_workers=2, output_div=1.0)
+    sub_mean, _ = get_dataset_mean_std(dataset, img_size=8, subsample=0.5, random_seed=1, output_div=1.0)
+
+    pixels = np.concatenate([np.asarray(img.resize((8, 8)), dtype=np.float64).reshape(-1, 3) for img, _ in dataset])
+    assert np.allclose(mean, pixels.mean(0))
+    assert np.allclose(std, pixels.std(0))
+    assert sub_mean.shape == (3,)
+
+
+def test_mean_std_rejects_empty_data():
+    import pytest
+    with pytest.raises(ValueError):
+        get_dataset_mean_std([], img_size=None)
+    empty_images = [(Image.new('RGB', (0, 0)), 0), (Image.new('RGB', (0, 4)), 0)]
+    with pytest.raises(ValueError):
+        get_dataset_mean_std(empty_images, img_size=None)
@@ -0,0 +1,131 @@
+"""
+Tests for wick/samplers.py
+"""
+
+
+import numpy as np
+import torch as th
+
+from wick.samplers import StratifiedSampler, StratifiedBatchSampler, WeightedSampler, ClassBalancedSampler, BucketBatchSampler, \
+    ForegroundPatchSampler
+
+
+def _labels():
+    return th.tensor([0] * 60 + [1] * 30 + [2] * 10)
+
+
+def test_stratified_batches_keep_class_proportions():
+    y = _labels()
+    batches = list(StratifiedBatchSampler(y, 10, seed=0))
+    assert sorted(sum(batches, [])) == list(range(100))
+    for batch in batches:
+        assert th.bincount(y[th.tensor(batch)], minlength=3).tolist() == [6, 3, 1]
+
+
+def test_stratified_sampler_is_seeded_and_sharded():
+    y = _labels()
+    assert list(StratifiedSampler(y, 10, seed=3)) == list(StratifiedSampler(y, 10, seed=3))
+
+    shards = [list(StratifiedSampler(y, 10, seed=3, num_replicas=3, rank=r)) for r in range(3)]
+    assert all(len(shard) == 34 for shard in shards)
+    assert set(sum(shards, [])) == set(range(100))
+
+
+def test_class_balanced_sampler():
+    y = _labels()
+    for method in ('alias', 'multinomial'):
+        sampler = ClassBalancedSampler(y, num_samples=30000, method=method, seed=0)
+        counts = th.bincount(y[th.tensor(list(sampler))], minlength=3).float()
+        assert ((counts / 10000 - 1).abs() < 0.05).all()
+
+
+def test_weighted_sampler_without_replacement():
+    sampler = WeightedSampler([1, 0, 5, 2], num_samples=3, replacement=False, seed=0)
+    assert sorted(sampler) == [0, 2, 3]
+
+
+def test_bucket_batches_group_similar_sizes():
+    from wick.datasets.data_utils import PadCollate
+    g = th.Generator().manual_seed(0)
+    sizes = th.cat([th.randint(20, 40, (50, 1), generator=g).repeat(1, 2) + th.randint(0, 3, (50, 2), generator=g),    # ~square
+                    th.randint(10, 20, (30, 1), generator=g).repeat(1, 2) * th.tensor([1, 4])])    # wide
+    sampler = BucketBatchSampler(sizes, batch_size=8, num_buckets=2, seed=0)
+    batches = list(sampler)
+    assert len(batches) == len(sampler) == 7 + 4
+    assert sorted(sum(batches, [])) == list(range(80))
+    for batch in batches:
+        assert len(set(int(i) >= 50 for i in batch)) == 1      # buckets are never mixed
+
+    shards = [list(BucketBatchSampler(sizes, 8, num_buckets=2, seed=0, num_replicas=2, rank=r)) for r in range(2)]
+    assert len(shards[0]) == len(shards[1]) == 6
+
+    # padding collate: pads to the batch maximum (rounded up to size_divisor)
+    samples = [(th.ones(3, int(h), int(w)), th.ones(int(h), int(w)).long()) for h, w in sizes[batches[0]]]
+    x, y = PadCollate(target_pad_value=255, size_divisor=4)(samples)
+    height, width = sizes[batches[0]].max(0)[0].tolist()
+    assert x.shape[2:] == (height + -height % 4, width + -width % 4)
+    h0, w0 = sizes[batches[0][0]].tolist()
+    assert x[0, :, :h0, :w0].eq(1).all() and x[0].sum() == 3 * h0 * w0
+    assert y.max() == 255
+
+
+def test_batch_samplers_without_full_batches():
+    # fewer samples than batch_size with drop_last: no batch at all instead of a ZeroDivisionError
+    assert len(StratifiedBatchSampler(th.tensor([0, 1, 0]), batch_size=4, drop_last=True, seed=0)) == 0
+    assert list(StratifiedBatchSampler(th.tensor([0, 1, 0]), batch_size=4, drop_last=True, seed=0)) == []
+    assert list(StratifiedBatchSampler(th.zeros(0, dtype=th.long), batch_size=4, seed=0)) == []
+    sampler = BucketBatchSampler([[10, 10], [10, 40], [12, 12]], batch_size=4, drop_last=True, seed=0)
+    assert len(sampler) == 0 and list(sampler) == []
+    assert len(list(BucketBatchSampler([[10, 10], [10, 40]], batch_size=4, seed=0, num_replicas=2, rank=1))) == 1
+
+
+def test_foreground_patch_sampler_hits_sparse_masks(tmpdir):
+    mask = np.zeros((200, 300), dtype=np.uint8)
+    mask[150:153, 40:44] = 1
+    np.save(str(tmpdir.join('mask.npy')), mask)
+    empty = np.zeros((50, 60), dtype=np.uint8)
+
+    sampler = ForegroundPatchSampler([str(tmpdir.join('mask.npy')), empty], patch_size=(32, 48), num_samples=200,
+                                     foreground_ratio=1.0, downsample=8, seed=0)
+    patches = list(sampler)
+    assert len(patches) == 200 and all(len(p) == 3 for p in patches)
+    for image_idx, y, x in patches:
+        assert image_idx == 0 and 0 <= y <= 200 - 32 and 0 <= x <= 300 - 48
+        assert mask[y:y + 32, x:x + 48].any()
+    assert list(sampler) == patches
+
+    sampler = ForegroundPatchSampler([mask, empty], patch_size=16, num_samples=400, foreground_ratio=0.0, seed=0)
+    images = np.array([p[0] for p in sampler])
+    assert 0 < (images == 1).sum() < 100      # the small image holds 1/21 of the pixels
+
+
+def test_foreground_patch_sampler_volumes_and_coverage_file(tmpdir):
+    volume = np.zeros((20, 30, 30), dtype=np.uint8)
+    volume[10, 5:7, 20:23] = 1
+    coverage_file = str(tmpdir.join('fg.npz'))
+    for _ in range(2):
+        sampler = ForegroundPatchSampler([volume], patch_size=(8, 8, 8), num_samples=50, foreground_ratio=1.0,
+                                         downsample=4, coverage_file=coverage_file, seed=1)
+        for _, z, y, x in sampler:
+            assert volume[z:z + 8, y:y + 8, x:x + 8].any()
+
+
+def test_foreground_patch_sampler_coverage_at_the_border():
+    # a fully foreground image smaller than the patch: its in-bounds coverage is 1
+    small = np.ones((8, 8), dtype=np.uint8)
+    large = np.zeros((64, 64), dtype=np.uint8)
+    large[:8, :8] = 1       # a corner: the window is a full patch, 1/16 of it foreground
+    sampler = ForegroundPatchSampler([small, large], patch_size=32, num_samples=20, foreground_ratio=1.0,
+                                     downsample=4, min_coverage=0.9, seed=0)
+    assert set(sampler.fg_images.tolist()) == {0}
+
+    # the same corner at the high border is scored on the shifted (drawn) patch as well
+    large = large[::-1, ::-1].copy()
+    sampler = ForegroundPatchSampler([small, large], patch_size=32, num_samples=20, foreground_ratio=1.0,
+                                     downsample=4, min_coverage=0.9, seed=0)
+    assert set(sampler.fg_images.tolist()) == {0}
+    for min_coverage, num_cells in ((0.06, 4), (0.1, 0)):       # 2x2 of the 8x8 blocks of a patch
+        sampler = ForegroundPatchSampler([large], patch_size=32, num_samples=20, foreground_ratio=1.0,
+                                         downsample=4, min_coverage=min_coverage, seed=0)
+        assert len(sampler.fg_cells) == num_cells
+
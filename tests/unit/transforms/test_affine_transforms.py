@@ -12,6 +12,8 @@ Transforms:
 
 #import pytest
 
+import math
+
 import torch as th
 
 from wick.transforms import (RandomAffine, Affine,
@@ -19,6 +21,7 @@ from wick.transforms import (RandomAffine, Affine,
                              RandomTranslate, RandomChoiceTranslate, Translate,
                              RandomShear, RandomChoiceShear, Shear,
                              RandomZoom, RandomChoiceZoom, Zoom)
+from wick.utils import th_affine2d
 
 # ----------------------------------------------------
 # ----------------------------------------------------
@@ -151,6 +154,19 @@ def test_affine_transforms_runtime(verbose=1):
     print('# FAILURES: ' , len(failures))
 
 
+def test_affine2d_backends_agree():
+    x = th.rand(3, 40, 50)
+    theta = math.radians(30)
+    matrices = [th.FloatTensor([[0.8, 0.1, 1.], [0., 0.7, 0.]]),
+                th.FloatTensor([[math.cos(theta), -math.sin(theta), 7.], [math.sin(theta), math.cos(theta), -5.]])]
+    for matrix in matrices:
+        for center in (True, False):
+            for mode in ('bilinear', 'nearest'):
+                gather = th_affine2d(x, matrix, mode=mode, center=center, backend='gather')
+                grid = th_affine2d(x, matrix, mode=mode, center=center)
+                assert th.allclose(gather, grid, atol=1e-4)
+
+
 if __name__=='__main__':
     test_affine_transforms_runtime()
 
@@ -0,0 +1,77 @@
+"""
+Tests for wick/transforms/batch_transforms.py
+"""
+
+import json
+
+import numpy as np
+import torch as th
+
+from wick.transforms import RandomBatchAffine, RandomBatchColor, DeviceNormalize, ImageToByteTensor
+
+
+def test_batch_affine_identity():
+    x = th.rand(4, 3, 16, 20)
+    y = th.randint(0, 3, (4, 16, 20))
+    tform = RandomBatchAffine(rotation_range=0, translation_range=0., zoom_range=(1, 1))
+    xt, yt = tform(x, y)
+    assert th.allclose(xt, x, atol=1e-5)
+    assert th.equal(yt, y)
+    assert yt.dtype == y.dtype
+
+
+def test_batch_affine_flip_is_shared_by_image_and_mask():
+    x = th.arange(4 * 6 * 8).float().view(4, 1, 6, 8)
+    y = x.squeeze(1).long()
+    tform = RandomBatchAffine(h_flip=True, v_flip=True, p_flip=0.5)
+    xt, yt = tform(x, y)
+    assert th.allclose(xt.squeeze(1), yt.float(), atol=1e-4)
+
+    flips = tform.tform_matrix[:, :, :2].diagonal(dim1=1, dim2=2)
+    for i in range(4):
+        expected = x[i]
+        if flips[i, 0] < 0:
+            expected = expected.flip(-1)
+        if flips[i, 1] < 0:
+            expected = expected.flip(-2)
+        assert th.allclose(xt[i], expected, atol=1e-4)
+
+
+def test_batch_affine_rotation_keeps_shape():
+    x = th.rand(3, 3, 10, 14)
+    y = th.randint(0, 2, (3, 10, 14), dtype=th.uint8)
+    xt, yt = RandomBatchAffine(rotation_range=30, shear_range=10, zoom_range=(0.8, 1.2))(x, y)
+    assert xt.shape == x.shape and yt.shape == y.shape
+    assert set(yt.unique().tolist()) <= {0, 1}
+
+
+def test_batch_color_range():
+    x = th.rand(8, 3, 5, 5)
+    xt = RandomBatchColor(brightness_range=(-0.2, 0.2), contrast_range=(0.5, 1.5))(x)
+    assert xt.shape == x.shape
+    assert xt.min() >= 0 and xt.max() <= 1
+
+    x = th.randint(0, 256, (8, 3, 5, 5), dtype=th.uint8)
+    assert th.equal(RandomBatchColor(brightness_range=(0, 0))(x), x)
+    xt = RandomBatchColor(brightness_range=(0.5, 0.5))(x)
+    assert xt.dtype == th.uint8 and th.equal(xt, (x.float() + 127.5).clamp(0, 255).round().to(th.uint8))
+
+
+def test_device_normalize_matches_float_pipeline(tmpdir):
+    image = np.random.randint(0, 256, size=(6, 5, 3)).astype(np.uint8)
+    x = ImageToByteTensor()(image)
+    assert x.dtype == th.uint8 and x.shape == (3, 6, 5) and x.is_contiguous()
+    assert ImageToByteTensor()(image[:, :, 0]).shape == (1, 6, 5)
+
+    mean, std = [0.5, 0.4, 0.3], [0.2, 0.25, 0.3]
+    batch = x.unsqueeze(0).repeat(2, 1, 1, 1)
+    expected = (batch.float() / 255 - th.tensor(mean).view(1, 3, 1, 1)) / th.tensor(std).view(1, 3, 1, 1)
+    out = DeviceNormalize(mean, std)(batch)
+    assert out.dtype == th.float32 and th.allclose(out, expected, atol=1e-5)
+
+    # data_stats appends to its stats file, the last result wins
+    path = str(tmpdir.join('stats.json'))
+    with open(path, 'w') as f:
+        json.dump({'mean': [0, 0, 0], 'std': [1, 1, 1]}, f)
+        json.dump({'num_items': 2, 'mean': mean, 'std': std}, f)
+    assert th.allclose(DeviceNormalize.from_stats(path)(batch), expected, atol=1e-5)
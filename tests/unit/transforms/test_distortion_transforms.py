@@ -0,0 +1,51 @@
+"""
+Tests for wick/transforms/distortion_transforms.py
+"""
+
+
+import numpy as np
+import torch as th
+
+from wick.transforms.distortion_transforms import Blur, Scramble, _butterworth_filter
+
+
+def _block_sums(x, blocksize):
+    rows, cols = x.size(-2) // blocksize, x.size(-1) // blocksize
+    return sorted(x[..., i*blocksize:(i+1)*blocksize, j*blocksize:(j+1)*blocksize].sum().item()
+                  for i in range(rows) for j in range(cols))
+
+
+def test_scramble_permutes_blocks():
+    x = th.arange(3*8*12).float().view(3, 8, 12)
+    out = Scramble(4)(x)
+    assert out.size() == x.size()
+    assert _block_sums(out, 4) == _block_sums(x, 4)
+
+
+def test_scramble_batch_keeps_inputs_aligned():
+    x = th.rand(4, 2, 8, 8)
+    mask = x[:, 0].clone()
+    out, out_mask = Scramble(2, batch=True)(x, mask)
+    assert th.equal(out[:, 0], out_mask)
+    for i in range(4):
+        assert _block_sums(out[i], 2) == _block_sums(x[i], 2)
+
+
+def test_blur_matches_per_channel_numpy():
+    x = (th.rand(2, 3, 32, 32) * 255).floor()
+    H = _butterworth_filter(32, 32, (8 / 128.0) * 0.5, 5)
+    expected = np.zeros((3, 32, 32))
+    for c in range(3):
+        spectrum = np.fft.fftshift(np.fft.fft2(x[1, c].numpy()))
+        expected[c] = np.absolute(np.real(np.fft.ifft2(H * spectrum)))
+
+    out = Blur(8)(x)
+    assert out.size() == x.size()
+    assert np.allclose(out[1].numpy(), np.clip(expected, 0, 255), atol=1e-2)
+
+    # odd sizes: the filter is centered on the zero frequency bin
+    x = (th.rand(3, 31, 17) * 255).floor()
+    fy, fx = np.meshgrid(np.fft.fftfreq(31), np.fft.fftfreq(17), indexing='ij')
+    H = 1 / (1 + (np.sqrt(fx ** 2 + fy ** 2) / ((8 / 128.0) * 0.5)) ** 10)
+    expected = np.stack([np.absolute(np.real(np.fft.ifft2(H * np.fft.fft2(x[c].numpy())))) for c in range(3)])
+    assert np.allclose(Blur(8)(x).numpy(), np.clip(expected, 0, 255), atol=1e-2)
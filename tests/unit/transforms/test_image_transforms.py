@@ -9,7 +9,8 @@ from wick.transforms import (Grayscale, RandomGrayscale,
                              Gamma, RandomGamma, RandomChoiceGamma,
                              Brightness, RandomBrightness, RandomChoiceBrightness,
                              Saturation, RandomSaturation, RandomChoiceSaturation,
-                             Contrast, RandomContrast, RandomChoiceContrast)
+                             Contrast, RandomContrast, RandomChoiceContrast,
+                             ColorJitter, rgb_to_hsv, hsv_to_rgb)
 
 # ----------------------------------------------------
 # ----------------------------------------------------
@@ -188,5 +189,32 @@ def test_image_transforms_runtime(verbose=1):
     print('# FAILURES: ' , len(failures))
 
 
+def test_hsv_round_trip():
+    x = th.rand(2, 3, 10, 10)
+    x[0, :, 0, 0] = 0.5      # gray pixel, hue and saturation are undefined
+    hsv = rgb_to_hsv(x)
+    assert not th.isnan(hsv).any()
+    assert th.allclose(hsv_to_rgb(hsv), x, atol=1e-5)
+    assert th.allclose(rgb_to_hsv(x[1]), hsv[1])
+
+
+def test_color_jitter_matches_single_image_ops():
+    x = th.rand(4, 3, 12, 12)
+    jitter = ColorJitter(brightness=(-0.2, 0.2), contrast=(0.5, 1.5), saturation=(-0.5, 0.5))
+    out = jitter(x)
+
+    for i in range(4):
+        expected = Brightness(jitter.params['brightness'][i].item())(x[i])
+        expected = Contrast(jitter.params['contrast'][i].item())(expected)
+        expected = Saturation(jitter.params['saturation'][i].item())(expected)
+        assert th.allclose(out[i], expected, atol=1e-5)
+
+
+def test_color_jitter_identity_params():
+    x = th.rand(2, 3, 8, 8)
+    jitter = ColorJitter(hue=(-0.5, 0.5), gamma=(0.5, 2.0), p=0)
+    assert th.allclose(jitter(x), x, atol=1e-5)
+
+
 if __name__=='__main__':
     test_image_transforms_runtime()
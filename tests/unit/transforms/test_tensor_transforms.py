@@ -3,6 +3,9 @@ Tests for wick/transforms/image_transforms.py
 """
 
 
+import os
+
+import numpy as np
 import torch as th
 
 from wick.transforms import (ToTensor,
@@ -18,6 +21,10 @@ from wick.transforms import (ToTensor,
                              SpecialCrop,
                              Pad,
                              RandomFlip,
+                             Rot90,
+                             Slice2D,
+                             RandomRot90,
+                             RandomDihedral,
                              RandomOrder)
 
 # ----------------------------------------------------
@@ -234,6 +241,9 @@ def RandomFlip_setup():
     tforms['randomflip_hv_02'] = RandomFlip(h=True, v=True, p=0)
     tforms['randomflip_hv_03'] = RandomFlip(h=True, v=True, p=1)
     tforms['randomflip_hv_04'] = RandomFlip(h=True, v=True, p=0.3)
+    tforms['rot90_01'] = Rot90(1)
+    tforms['randomrot90_01'] = RandomRot90()
+    tforms['randomdihedral_01'] = RandomDihedral()
     return tforms
 
 def RandomOrder_setup():
@@ -293,5 +303,113 @@ def test_image_transforms_runtime(verbose=1):
     print('# FAILURES: ' , len(failures))
 
 
+def test_compose_fuses_pointwise_chain():
+    from wick.transforms import Compose, Brightness, Contrast, Gamma
+    x = th.rand(3, 16, 16)
+    x_orig = x.clone()
+    tforms = [Brightness(0.1), Contrast(0.8), Gamma(1.5), RangeNormalize(0, 1)]
+
+    fused = Compose(tforms)
+    assert len(fused._stages) == 1
+    expected = Compose(tforms, fuse=False)(x)
+    assert th.allclose(fused(x), expected, atol=1e-6)
+    assert th.equal(x, x_orig)      # input must not be modified in place
+
+
+def test_compose_fuses_affine_chain():
+    from wick.transforms import Compose, Rotate, Zoom, AffineCompose
+    x = th.rand(1, 20, 20)
+    fused = Compose([Rotate(20), Zoom(0.8)])
+    assert len(fused._stages) == 1
+
+    expected = AffineCompose([Rotate(20, lazy=True), Zoom(0.8, lazy=True)])(x)
+    assert th.allclose(fused(x), expected, atol=1e-5)
+
+
+def test_compose_splits_deterministic_prefix():
+    from wick.transforms import Compose, split_deterministic
+    tforms = [TypeCast('float'), RangeNormalize(0, 1), RandomFlip(p=1), AddChannel()]
+    prefix, suffix = Compose(tforms).split_deterministic()
+    assert prefix.transforms == tforms[:2] and suffix.transforms == tforms[2:]
+
+    x = th.randint(0, 255, (3, 8, 8)).byte()
+    assert th.allclose(suffix(prefix(x)), Compose(tforms)(x))
+
+    # an explicit prefix overrides the detection
+    prefix, suffix = Compose(tforms, deterministic_prefix=1).split_deterministic()
+    assert prefix.transforms == tforms[:1] and suffix.transforms == tforms[1:]
+
+    flip = RandomFlip()
+    assert split_deterministic(flip) == (None, flip)
+    assert split_deterministic(Compose(tforms[:2]))[1] is None
+    assert split_deterministic(None) == (None, None)
+
+
+def test_random_flip_matches_numpy():
+    x = th.arange(24).float().view(2, 3, 4)
+    y = x[0].clone()
+    fx, fy = RandomFlip(h=True, v=True, p=1)(x, y)
+    assert th.equal(fx, th.from_numpy(x.numpy()[:, ::-1, ::-1].copy()))
+    assert th.equal(fy, fx[0])
+
+
+def test_random_flip_batch_is_per_sample():
+    x = th.rand(64, 1, 5, 5)
+    out = RandomFlip(h=True, p=0.5, batch=True)(x)
+    flipped = [bool(th.equal(out[i], x[i].flip(-1))) for i in range(64)]
+    kept = [bool(th.equal(out[i], x[i])) for i in range(64)]
+    assert all(f or k for f, k in zip(flipped, kept))
+    assert any(flipped) and any(kept)
+
+
+def test_random_dihedral_batch_keeps_masks_aligned():
+    x = th.rand(16, 2, 6, 6)
+    mask = (x[:, 0] > 0.5).long()
+    out, out_mask = RandomDihedral(batch=True)(x, mask)
+    assert th.equal((out[:, 0] > 0.5).long(), out_mask)
+    assert th.equal(Rot90(2)(Rot90(2)(x)), x)
+
+
+def test_slice2d_reads_nonzero_slice_from_memmap(tmp_path):
+    from wick.datasets.data_utils import npy_loader, build_nonzero_slice_index
+
+    volume = np.zeros((6, 4, 5), dtype=np.float32)
+    mask = np.zeros((6, 4, 5), dtype=np.uint8)
+    volume[:] = np.arange(6)[:, None, None]
+    mask[[1, 4], 2, 3] = 1
+    np.save(str(tmp_path / 'x.npy'), volume)
+    np.save(str(tmp_path / 'y.npy'), mask)
+
+    x = npy_loader(str(tmp_path / 'x.npy'), mmap_mode='r')
+    y = npy_loader(str(tmp_path / 'y.npy'), mmap_mode='r')
+    transform = Slice2D(axis=0, reject_zeros=True)
+    for _ in range(10):
+        slice_x, slice_y = transform(x, y)
+        assert type(slice_x) is np.ndarray and slice_x.shape == (4, 5)
+        assert slice_y.sum() == 1 and slice_x[0, 0] in (1, 4)
+
+    index_file = str(tmp_path / 'index.npz')
+    index = build_nonzero_slice_index([str(tmp_path / 'y.npy')], axis=2, index_file=index_file)
+    assert index[str(tmp_path / 'y.npy')].tolist() == [3]
+    assert build_nonzero_slice_index([str(tmp_path / 'y.npy')], axis=2, index_file=index_file)[str(tmp_path / 'y.npy')].tolist() == [3]
+    _, slice_y = Slice2D(axis=2, reject_zeros=True, slice_index=index)(x, y)
+    assert slice_y.shape == (6, 4) and slice_y.sum() == 2
+
+    # rewriting the file invalidates the cached index
+    transform = Slice2D(axis=0, reject_zeros=True)
+    assert int(transform(x)[0, 0]) in range(1, 6)
+    zeros_but_first = np.zeros((6, 4, 5), dtype=np.float32)
+    zeros_but_first[0] = 7
+    np.save(str(tmp_path / 'x.npy'), zeros_but_first)
+    stat = os.stat(str(tmp_path / 'x.npy'))
+    os.utime(str(tmp_path / 'x.npy'), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    x = npy_loader(str(tmp_path / 'x.npy'), mmap_mode='r')
+    assert all(transform(x)[0, 0] == 7 for _ in range(5))
+    assert len(transform._cache) == 1
+
+    tensor_slice = Slice2D(axis=1, reject_zeros=True)(th.from_numpy(volume))
+    assert tensor_slice.shape == (6, 5)
+
+
 if __name__=='__main__':
     test_image_transforms_runtime()
@@ -3,26 +3,11 @@ import os
 import os.path
 import argparse
 
-from .functions.meanstd import get_dataset_mean_std
+from .meanstd import get_dataset_mean_std
 from .datasets.FolderDataset import FolderDataset, rgb_image_loader
 
-opt = dict()
-parser = argparse.ArgumentParser()
-parser.add_argument('--root_path', required=False, type=str, help='Path to root directory of the images')
-parser.add_argument('--output_path', required=False, type=str, help='Path to save computed statistics to. If not provided, will save inside root_path')
 
-opt = vars(parser.parse_args())
-
-# clean up the dictionary so it doesn't contain 'None' values
-removals = list()
-for key, val in opt.items():
-    if val is None:
-        removals.append(key)
-for rem in removals:
-    # print('removing: ', rem)
-    opt.pop(rem)
-
-def create_dataset_stats(data_path, output_path=None):
+def create_dataset_stats(data_path, output_path=None, num_workers=0, subsample=None, random_seed=None):
     '''
     Generates statistics for the given dataset and writes them to a JSON file. Expects the data to be in the following dir structure:
     dataroot
@@ -33,6 +18,9 @@ def create_dataset_stats(data_path, output_path=None):
 
     :param data_path: string - path to dataroot
     :param output_path: - path/filename to write the stats to (default: None - will output stats.json file in the dataroot)
+    :param num_workers: int - number of DataLoader workers used to load images (default: 0)
+    :param subsample: int or float - number or fraction of images to compute the stats on (default: None - all images)
+    :param random_seed: int - seed for the subsample selection (default: None)
 
     :return: None
     '''
@@ -44,7 +32,7 @@ def create_dataset_stats(data_path, output_path=None):
     dataset = FolderDataset(root=data_path, class_mode='label', default_loader=rgb_image_loader)
 
     stats['num_items'] = len(dataset)
-    mean, std = get_dataset_mean_std(dataset, img_size=256)
+    mean, std = get_dataset_mean_std(dataset, img_size=256, num_workers=num_workers, subsample=subsample, random_seed=random_seed)
     stats['mean'], stats['std'] = mean.tolist(), std.tolist()       # convert from numpy array to python
 
     print('------- Dataset Stats --------')
@@ -65,9 +53,30 @@ if __name__ == "__main__":
     sys.path.append("..")
     sys.path.append("../..")
 
+    opt = dict()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root_path', required=False, type=str, help='Path to root directory of the images')
+    parser.add_argument('--output_path', required=False, type=str, help='Path to save computed statistics to. If not provided, will save inside root_path')
+    parser.add_argument('--num_workers', required=False, type=int, help='Number of worker processes used to load images')
+    parser.add_argument('--subsample', required=False, type=float, help='Fraction (<= 1) or number (> 1) of images to compute the stats on')
+
+    opt = vars(parser.parse_args())
+
+    # clean up the dictionary so it doesn't contain 'None' values
+    removals = list()
+    for key, val in opt.items():
+        if val is None:
+            removals.append(key)
+    for rem in removals:
+        # print('removing: ', rem)
+        opt.pop(rem)
+
     # path = opt.get('root_path','/Users/Shared/test/images')
     path = opt.get('root_path','/Users/Shared/test/deleteme')
-    stats = create_dataset_stats(data_path=path, output_path=opt.get('output_path', None))
+    subsample = opt.get('subsample', None)
+    if subsample is not None and subsample > 1:
+        subsample = int(subsample)
+    stats = create_dataset_stats(data_path=path, output_path=opt.get('output_path', None), num_workers=opt.get('num_workers', 0), subsample=subsample)
     # print('----- RESULT -----')
     # print(stats)
     # print('------------------')
\ No newline at end of file
@@ -1,7 +1,11 @@
+import copy
+import os
+
 from .BaseDataset import BaseDataset
 import numpy as np
 import pandas as pd
-from .data_utils import _return_first_element_of_list, default_file_reader, _pass_through, _process_transform_argument, _process_co_transform_argument
+from .data_utils import _return_first_element_of_list, default_file_reader, _pass_through, _process_transform_argument, _process_co_transform_argument, \
+    _apply_transform_to_batch, _apply_co_transform_to_batch, _is_sample_list, SampleBatch
 
 
 class CSVDataset(BaseDataset):
@@ -13,16 +17,22 @@ class CSVDataset(BaseDataset):
                  input_transform=None,
                  target_transform=None,
                  co_transform=None,
-                 apply_transforms_individually=False):
+                 apply_transforms_individually=False,
+                 chunksize=100000,
+                 memory_map=False):
         """
         Initialize a Dataset from a CSV file/dataframe. This does NOT
         actually load the data into memory if the CSV contains filepaths.
 
+        Data is stored column-wise: only the input and target columns are read
+        (in chunks, for CSV files) into numpy arrays. Splits (split_by_column,
+        train_test_split, copy) are index views that share these arrays.
+
         Arguments
         ---------
         csv : string or pandas.DataFrame
-            if string, should be a path to a .csv file which
-            can be loaded as a pandas dataframe
+            if string, should be a path to a .csv file (or a .parquet or
+            .feather/.arrow file) holding the table
 
         input_cols : list of ints, or list of strings
             which column(s) to use as input arrays.
@@ -46,6 +56,13 @@ class CSVDataset(BaseDataset):
 
         apply_transforms_individually : Whether to apply transforms to individual inputs
             or to an input row as a whole (default: False)
+
+        chunksize : integer
+            number of CSV rows parsed at a time, bounds the memory used while reading
+
+        memory_map : boolean
+            memory-map .feather/.arrow files instead of reading them (requires pyarrow).
+            Numeric columns without missing values are then used without a copy.
         """
         assert(input_cols is not None)
 
@@ -54,9 +71,15 @@ class CSVDataset(BaseDataset):
 
         self.do_individual_transforms = apply_transforms_individually
 
-        self.df = _process_csv_argument(csv)
+        self.apply_transforms_individually = apply_transforms_individually
+        self.chunksize = chunksize
+        self.memory_map = memory_map
+
+        self.source = csv
+        self.indices = None     # row view into the column arrays (None = all rows)
+        self._columns = _ColumnStore(csv, chunksize=chunksize, memory_map=memory_map)
 
-        self.inputs = _select_dataframe_columns(self.df, self.input_cols)
+        self.inputs = self._columns.select(self.input_cols)
         self.num_inputs = self.inputs.shape[1]
         self.input_return_processor = _return_first_element_of_list if self.num_inputs==1 else _pass_through
 
@@ -64,7 +87,7 @@ class CSVDataset(BaseDataset):
             self.num_targets = 0
             self.has_target = False
         else:
-            self.targets = _select_dataframe_columns(self.df, self.target_cols)
+            self.targets = self._columns.select(self.target_cols)
             self.num_targets = self.targets.shape[1]
             self.target_return_processor = _return_first_element_of_list if self.num_targets==1 else _pass_through
             self.has_target = True
@@ -88,11 +111,23 @@ class CSVDataset(BaseDataset):
                 self.target_transform = _process_transform_argument(target_transform, 1)
                 self.co_transform = _process_co_transform_argument(co_transform, 1, 1)
 
+    @property
+    def df(self):
+        """
+        The table behind this dataset (restricted to the rows of this view) as a DataFrame.
+        A DataFrame source is returned as it is, file sources are only turned into a DataFrame on first access.
+        """
+        frame = self._columns.frame()
+        return frame if self.indices is None else frame.iloc[self.indices]
+
     def __getitem__(self, index):
         """
         Index the dataset and return the input + target
         """
 
+        if self.indices is not None:
+            index = self.indices[index]
+
         # input_sample = list()
         # for i in range(self.num_inputs):
         #     input_sample.append(self.input_transform[i](self.input_loader(self.inputs[index, i])))
@@ -118,13 +153,45 @@ class CSVDataset(BaseDataset):
         else:
             return self.input_return_processor(input_sample)
 
+    def __getitems__(self, indices):
+        """
+        Index a whole batch of rows at once. Row-wise transforms that support batches are called once
+        on the batch, other transforms are applied row by row.
+        When transforms are applied individually (typically file paths that need to be loaded) samples are fetched one by one.
+
+        :param indices: list of sample indices
+        :return: SampleBatch (list of samples that also carries the assembled batch) or list of samples
+            (also when the transformed samples cannot be stacked, e.g. they have different sizes)
+        """
+        if self.do_individual_transforms:
+            return [self[index] for index in indices]
+        indices = np.asarray(indices, dtype=np.int64)
+        if self.indices is not None:
+            indices = self.indices[indices]
+
+        input_batch = _apply_transform_to_batch(self.input_transform[0], self.inputs[indices])
+        if self.has_target:
+            target_batch = _apply_transform_to_batch(self.target_transform[0], self.targets[indices])
+            input_batch, target_batch = _apply_co_transform_to_batch(self.co_transform[0], input_batch, target_batch)
+            if _is_sample_list(input_batch, target_batch):
+                return [(self.input_return_processor(x), self.target_return_processor(y)) for x, y in zip(input_batch, target_batch)]
+            return SampleBatch((_return_processor_for_batch(self.input_return_processor, input_batch),
+                                _return_processor_for_batch(self.target_return_processor, target_batch)), len(indices))
+        else:
+            if _is_sample_list(input_batch):
+                return [self.input_return_processor(x) for x in input_batch]
+            return SampleBatch(_return_processor_for_batch(self.input_return_processor, input_batch), len(indices))
+
+    def __len__(self):
+        return len(self.inputs) if self.indices is None else len(self.indices)
+
     def split_by_column(self, col):
         """
         Split this dataset object into multiple dataset objects based on
         the unique factors of the given column. The number of returned
         datasets will be equal to the number of unique values in the given
-        column. The transforms and original dataframe will all be transferred
-        to the new datasets
+        column. The transforms and underlying column data will all be shared
+        with the new datasets (they are index views, no data is copied)
 
         Useful for splitting a dataset into train/val/test datasets.
 
@@ -139,76 +206,178 @@ class CSVDataset(BaseDataset):
         -------
         - list of new datasets with transforms copied
         """
-        if isinstance(col, int):
-            split_vals = self.df.iloc[:,col].values.flatten()
-
-            new_df_list = []
-            for unique_split_val in np.unique(split_vals):
-                new_df = self.df[:][self.df.iloc[:,col]==unique_split_val]
-                new_df_list.append(new_df)
-        elif isinstance(col, str):
-            split_vals = self.df.loc[:,col].values.flatten()
-
-            new_df_list = []
-            for unique_split_val in np.unique(split_vals):
-                new_df = self.df[:][self.df.loc[:,col]==unique_split_val]
-                new_df_list.append(new_df)
-        else:
+        if not isinstance(col, (int, str)):
             raise ValueError('col argument not valid - must be column name or index')
 
-        new_datasets = []
-        for new_df in new_df_list:
-            new_dataset = self.copy(new_df)
-            new_datasets.append(new_dataset)
+        split_vals = self._columns.column(col)
+        rows = np.arange(len(split_vals)) if self.indices is None else self.indices
+        split_vals = split_vals[rows]
+
+        # a single sort groups the rows of every unique value
+        _, inverse, counts = np.unique(split_vals, return_inverse=True, return_counts=True)
+        order = np.argsort(inverse, kind='stable')
+        groups = np.split(rows[order], np.cumsum(counts)[:-1])
 
-        return new_datasets
+        return [self._view(group) for group in groups]
 
     def train_test_split(self, train_size):
         if train_size < 1:
             train_size = int(train_size * len(self))
 
         train_indices = np.random.choice(len(self), train_size, replace=False)
-        test_indices = np.array([i for i in range(len(self)) if i not in train_indices])
-
-        train_df = self.df.iloc[train_indices,:]
-        test_df = self.df.iloc[test_indices,:]
+        is_train = np.zeros(len(self), dtype=bool)
+        is_train[train_indices] = True
+        test_indices = np.flatnonzero(~is_train)
 
-        train_dataset = self.copy(train_df)
-        test_dataset = self.copy(test_df)
+        train_dataset = self._view(self._absolute_indices(train_indices))
+        test_dataset = self._view(self._absolute_indices(test_indices))
 
         return train_dataset, test_dataset
 
     def copy(self, df=None):
         if df is None:
-            df = self.df
+            return self._view(self.indices)
 
         return CSVDataset(df,
                           input_cols=self.input_cols,
                           target_cols=self.target_cols,
                           input_transform=self.input_transform,
                           target_transform=self.target_transform,
-                          co_transform=self.co_transform)
+                          co_transform=self.co_transform,
+                          apply_transforms_individually=self.apply_transforms_individually,
+                          chunksize=self.chunksize,
+                          memory_map=self.memory_map)
+
+    def _absolute_indices(self, indices):
+        return indices if self.indices is None else self.indices[indices]
+
+    def _view(self, indices):
+        # shallow copy sharing the column arrays and transforms, restricted to the given rows
+        view = copy.copy(self)
+        view.indices = None if indices is None else np.asarray(indices, dtype=np.int64)
+        return view
+
+
+class _ColumnStore(object):
+    """
+    Lazily loaded, column-wise view of a table (DataFrame, CSV, Parquet or Feather file).
+    Every column is read at most once, and only when it is needed.
+    """
+
+    def __init__(self, source, chunksize=100000, memory_map=False):
+        if isinstance(source, str):
+            self.path = source
+            self.format = _table_format(source)
+            self.df = None
+        elif isinstance(source, pd.DataFrame):
+            self.path = None
+            self.format = 'dataframe'
+            self.df = source
+        else:
+            raise ValueError('csv argument must be string or dataframe')
+        self.chunksize = chunksize
+        self.memory_map = memory_map
+        self._names = None
+        self._cache = {}
+
+    @property
+    def names(self):
+        if self._names is None:
+            if self.df is not None:
+                self._names = list(self.df.columns)
+            elif self.format == 'csv':
+                self._names = list(pd.read_csv(self.path, nrows=0).columns)
+            else:
+                self._names = _arrow_column_names(self.path, self.format)
+        return self._names
+
+    def frame(self):
+        """
+        The whole table as a DataFrame (built from the column arrays once for file sources)
+        """
+        if self.df is None:
+            names = self.names
+            missing = [n for n in names if n not in self._cache]
+            if missing:
+                self._cache.update(self._read(missing))
+            self.df = pd.DataFrame({n: self._cache[n] for n in names}, columns=names)
+        return self.df
+
+    def column(self, col):
+        name = self.names[col] if isinstance(col, int) else col
+        if name not in self._cache:
+            self._cache.update(self._read([name]))
+        return self._cache[name]
+
+    def select(self, cols):
+        """
+        2-D array (rows x cols) of the given columns (no copy for a single column)
+        """
+        if not isinstance(cols[0], (str, int)):
+            raise ValueError('Provided columns should be string column names or integer column indices')
+        names = [self.names[c] if isinstance(c, int) else c for c in cols]
+        missing = [n for n in names if n not in self._cache]
+        if missing:
+            self._cache.update(self._read(missing))
+        arrays = [self._cache[n] for n in names]
+        if len(arrays) == 1:
+            return arrays[0].reshape(-1, 1)
+        return np.column_stack(arrays)
+
+    def _read(self, names):
+        # to_numpy: plain numpy arrays (object arrays for strings) rather than pandas extension arrays
+        if self.format == 'dataframe':
+            return {n: self.df[n].to_numpy() for n in names}
+        if self.format == 'csv':
+            chunks = {n: [] for n in names}
+            for chunk in pd.read_csv(self.path, usecols=names, chunksize=self.chunksize):
+                for n in names:
+                    chunks[n].append(chunk[n].to_numpy())
+            if any(len(c) == 0 for c in chunks.values()):
+                # no rows: keep the dtypes pandas reports for the header
+                header = pd.read_csv(self.path, usecols=names, nrows=0)
+                return {n: header[n].to_numpy() for n in names}
+            return {n: np.concatenate(c) for n, c in chunks.items()}
+        if self.format == 'feather' and self.memory_map:
+            try:
+                import pyarrow.feather as feather
+            except ImportError:
+                raise ImportError('Need pyarrow to memory-map feather files')
+            table = feather.read_table(self.path, columns=names, memory_map=True)
+            return {n: table.column(n).to_numpy() for n in names}
+        if self.format == 'feather':
+            df = pd.read_feather(self.path, columns=names)
+        else:
+            df = pd.read_parquet(self.path, columns=names)
+        return {n: df[n].to_numpy() for n in names}
+
+
+def _arrow_column_names(path, format):
+    # parquet and feather files are read through pyarrow anyway, their schema holds the column names
+    try:
+        import pyarrow.parquet as pq
+        import pyarrow.ipc as ipc
+    except ImportError:
+        raise ImportError('Need pyarrow to read parquet/feather files')
+    if format == 'parquet':
+        return list(pq.read_schema(path).names)
+    return list(ipc.open_file(path).schema.names)
 
 
+def _table_format(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.parquet', '.pq'):
+        return 'parquet'
+    if ext in ('.feather', '.arrow'):
+        return 'feather'
+    return 'csv'
+
+
+def _return_processor_for_batch(processor, batch):
+    # batch equivalent of applying the per-sample return processor to every row
+    return batch[:, 0] if processor is _return_first_element_of_list else batch
+
 def _process_cols_argument(cols):
     if isinstance(cols, tuple):
         cols = list(cols)
     return cols
-
-def _process_csv_argument(csv):
-    if isinstance(csv, str):
-        df = pd.read_csv(csv)
-    elif isinstance(csv, pd.DataFrame):
-        df = csv
-    else:
-        raise ValueError('csv argument must be string or dataframe')
-    return df
-
-def _select_dataframe_columns(df, cols):
-    if isinstance(cols[0], str):
-        inputs = df.loc[:,cols].values
-    elif isinstance(cols[0], int):
-        inputs = df.iloc[:,cols].values
-    else:
-        raise ValueError('Provided columns should be string column names or integer column indices')
-    return inputs
\ No newline at end of file
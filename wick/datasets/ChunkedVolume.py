@@ -0,0 +1,301 @@
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import struct
+import zlib
+
+import numpy as np
+import torch as th
+
+_MAGIC = b'WICKVOL1'
+VOLUME_EXTENSION = '.wvol'
+
+
+def _compressor(compression, level):
+    if compression == 'zlib':
+        return lambda data: zlib.compress(data, level), zlib.decompress
+    if compression == 'lz4':
+        try:
+            import lz4.frame
+        except ImportError:
+            raise ImportError('Need lz4 to read/write lz4 compressed volumes')
+        return lambda data: lz4.frame.compress(data, compression_level=level), lz4.frame.decompress
+    if compression is None or compression == 'none':
+        return bytes, bytes
+    raise ValueError('compression must be one of zlib, lz4 or None')
+
+
+class ChunkedVolume(object):
+    """
+    Chunked, compressed on-disk N-d array (e.g. a 3D CT/MRI volume).
+
+    The file holds a small JSON header, a table of chunk offsets and the chunks themselves, each compressed on its own
+    (zlib or lz4). Reading a region only decompresses the chunks that overlap it.
+
+    :param path: path to the volume file (see ChunkedVolume.create / npy_to_chunked)
+    :param cache: ChunkCache (default: None)\n
+        cache of decoded chunks. Share one cache between volumes (and DataLoader workers) to keep neighbouring patches cheap.
+    """
+    def __init__(self, path, cache=None):
+        self.path = path
+        self.cache = cache
+        with open(path, 'rb') as f:
+            if f.read(len(_MAGIC)) != _MAGIC:
+                raise ValueError('%s is not a chunked volume' % path)
+            header_length, = struct.unpack('<Q', f.read(8))
+            header = json.loads(f.read(header_length).decode('utf-8'))
+            self.shape = tuple(header['shape'])
+            self.dtype = np.dtype(header['dtype'])
+            self.chunks = tuple(header['chunks'])
+            self.compression = header['compression']
+            self.grid = tuple(-(-s // c) for s, c in zip(self.shape, self.chunks))
+            num_chunks = int(np.prod(self.grid))
+            self.offsets = np.frombuffer(f.read(8 * (num_chunks + 1)), dtype='<i8').astype(np.int64)
+            self._data_start = f.tell()
+        # stable across processes (unlike id()), used as the cache key
+        self.key = int.from_bytes(hashlib.sha1(os.path.abspath(path).encode('utf-8')).digest()[:7], 'little')
+        self._decompress = _compressor(self.compression, 0)[1]
+        self._file = None
+        self._pid = None
+
+    @staticmethod
+    def create(path, array, chunks=(64, 64, 64), compression='zlib', level=1):
+        """
+        Writes an array (numpy array or np.memmap) chunk by chunk, so it never has to be fully in memory.
+
+        :param path: output file
+        :param array: N-d array
+        :param chunks: chunk shape (one entry per dim)
+        :param compression: 'zlib', 'lz4' or None
+        :param level: compression level
+        :return: ChunkedVolume
+        """
+        chunks = tuple(int(c) for c in chunks)
+        if len(chunks) != array.ndim:
+            raise ValueError('chunks must have one entry per array dimension')
+        compress = _compressor(compression, level)[0]
+        header = json.dumps({'shape': list(array.shape), 'dtype': np.dtype(array.dtype).str, 'chunks': list(chunks),
+                             'compression': compression}).encode('utf-8')
+        grid = [range(0, s, c) for s, c in zip(array.shape, chunks)]
+        num_chunks = int(np.prod([len(g) for g in grid]))
+        offsets = np.zeros(num_chunks + 1, dtype='<i8')
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(_MAGIC + struct.pack('<Q', len(header)) + header)
+            table_start = f.tell()
+            f.write(offsets.tobytes())      # placeholder, rewritten once the chunk sizes are known
+            for i, origin in enumerate(itertools.product(*grid)):
+                region = tuple(slice(o, o + c) for o, c in zip(origin, chunks))
+                data = compress(np.ascontiguousarray(array[region]).tobytes())
+                f.write(data)
+                offsets[i + 1] = offsets[i] + len(data)
+            f.seek(table_start)
+            f.write(offsets.tobytes())
+        os.replace(tmp_path, path)
+        return ChunkedVolume(path)
+
+    def __getstate__(self):
+        # file handles are per process
+        state = self.__dict__.copy()
+        state['_file'] = None
+        state['_pid'] = None
+        return state
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def _read_raw(self, index):
+        if self._file is None or self._pid != os.getpid():
+            # forked workers must not share the file position of the parent
+            self._file = open(self.path, 'rb')
+            self._pid = os.getpid()
+        self._file.seek(self._data_start + self.offsets[index])
+        return self._file.read(self.offsets[index + 1] - self.offsets[index])
+
+    def _chunk_shape(self, position):
+        return tuple(min(c, s - p * c) for p, c, s in zip(position, self.chunks, self.shape))
+
+    def read_chunk(self, position):
+        """
+        :param position: chunk grid position (one int per dim)
+        :return: decoded chunk (edge chunks are smaller than the chunk shape)
+        """
+        index = int(np.ravel_multi_index(position, self.grid))
+        shape = self._chunk_shape(position)
+        if self.cache is not None:
+            chunk = self.cache.get(self.key, index, shape, self.dtype)
+            if chunk is not None:
+                return chunk
+        chunk = np.frombuffer(self._decompress(self._read_raw(index)), dtype=self.dtype).reshape(shape)
+        if self.cache is not None:
+            self.cache.put(self.key, index, chunk)
+        return chunk
+
+    def read(self, start, size, fill_value=0):
+        """
+        Reads a region. Parts of the region outside of the volume are filled with fill_value.
+
+        :param start: first index of the region along every dim (may be negative)
+        :param size: shape of the region
+        :param fill_value: value used outside of the volume
+        :return: numpy array of the given size
+        """
+        start = tuple(int(s) for s in start)
+        size = tuple(int(s) for s in size)
+        out = np.full(size, fill_value, dtype=self.dtype)
+        lo = [max(s, 0) for s in start]
+        hi = [min(s + n, dim) for s, n, dim in zip(start, size, self.shape)]
+        if any(l >= h for l, h in zip(lo, hi)):
+            return out
+
+        ranges = [range(l // c, (h - 1) // c + 1) for l, h, c in zip(lo, hi, self.chunks)]
+        for position in itertools.product(*ranges):
+            chunk = self.read_chunk(position)
+            chunk_start = [p * c for p, c in zip(position, self.chunks)]
+            src, dst = [], []
+            for d in range(self.ndim):
+                a = max(lo[d], chunk_start[d])
+                b = min(hi[d], chunk_start[d] + chunk.shape[d])
+                src.append(slice(a - chunk_start[d], b - chunk_start[d]))
+                dst.append(slice(a - start[d], b - start[d]))
+            out[tuple(dst)] = chunk[tuple(src)]
+        return out
+
+    def __getitem__(self, index):
+        # basic slicing (ints and slices with step 1) is translated into a region read
+        if not isinstance(index, tuple):
+            index = (index,)
+        index = index + (slice(None),) * (self.ndim - len(index))
+        start, size, squeeze = [], [], []
+        for d, (idx, dim) in enumerate(zip(index, self.shape)):
+            if isinstance(idx, slice):
+                a, b, step = idx.indices(dim)
+                if step != 1:
+                    raise IndexError('ChunkedVolume only supports slices with step 1')
+                start.append(a)
+                size.append(max(b - a, 0))
+            else:
+                idx = int(idx)
+                if not -dim <= idx < dim:
+                    raise IndexError('index %i is out of bounds for axis %i with size %i' % (idx, d, dim))
+                start.append(idx % dim)
+                size.append(1)
+                squeeze.append(d)
+        region = self.read(start, size)
+        return region.squeeze(axis=tuple(squeeze)) if squeeze else region
+
+
+class ChunkCache(object):
+    """
+    LRU cache of decoded chunks that is shared by all DataLoader workers.
+
+    The chunk data lives in a fixed pool of shared-memory slots that is allocated up front (max_bytes of /dev/shm),
+    so create the cache before the workers are started (e.g. when building the dataset).
+    Every lookup and insert takes one lock shared by all workers and scans all slots (O(slots)), so with many workers
+    or a large pool of small chunks the cache itself can become a point of contention; prefer larger chunks then.
+
+    :param max_bytes: size of the slot pool in bytes
+    :param chunk_bytes: size of one slot, i.e. the largest decoded chunk that will be cached
+    """
+    def __init__(self, max_bytes, chunk_bytes):
+        self.chunk_bytes = int(chunk_bytes)
+        num_slots = max(int(max_bytes) // self.chunk_bytes, 1)
+        self.slots = th.zeros(num_slots, self.chunk_bytes, dtype=th.uint8).share_memory_()
+        self.keys = th.full((num_slots, 2), -1, dtype=th.int64).share_memory_()       # (volume key, chunk index)
+        self.last_used = th.zeros(num_slots, dtype=th.int64).share_memory_()
+        self.clock = th.zeros(1, dtype=th.int64).share_memory_()
+        self.lock = multiprocessing.Lock()
+
+    def __len__(self):
+        return int((self.keys[:, 0] >= 0).sum())
+
+    def _find(self, volume_key, index):
+        hits = ((self.keys[:, 0] == volume_key) & (self.keys[:, 1] == index)).nonzero()
+        return int(hits[0, 0]) if len(hits) else None
+
+    def _touch(self, slot):
+        self.clock += 1
+        self.last_used[slot] = self.clock[0]
+
+    def get(self, volume_key, index, shape, dtype):
+        """
+        :return: a copy of the cached chunk or None
+        """
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        with self.lock:
+            slot = self._find(volume_key, index)
+            if slot is None:
+                return None
+            self._touch(slot)
+            data = self.slots[slot, :nbytes].numpy().copy()
+        return data.view(dtype).reshape(shape)
+
+    def put(self, volume_key, index, chunk):
+        data = np.ascontiguousarray(chunk).reshape(-1).view(np.uint8)
+        if len(data) > self.chunk_bytes:
+            return
+        with self.lock:
+            if self._find(volume_key, index) is not None:
+                return
+            slot = int(self.last_used.argmin())      # empty slots have never been used
+            self.slots[slot, :len(data)].numpy()[:] = data
+            self.keys[slot, 0] = volume_key
+            self.keys[slot, 1] = index
+            self._touch(slot)
+
+    def clear(self):
+        with self.lock:
+            self.keys.fill_(-1)
+            self.last_used.zero_()
+
+
+def npy_to_chunked(npy_path, out_path=None, chunks=(64, 64, 64), compression='zlib', level=1):
+    """
+    Converts a .npy file into a chunked volume. The .npy file is memory mapped, so volumes larger than memory work.
+
+    :param npy_path: input .npy file
+    :param out_path: output file (default: npy_path with the .wvol extension)
+    :param chunks: chunk shape
+    :param compression: 'zlib', 'lz4' or None
+    :param level: compression level
+    :return: path of the chunked volume
+    """
+    if out_path is None:
+        out_path = os.path.splitext(npy_path)[0] + VOLUME_EXTENSION
+    ChunkedVolume.create(out_path, np.load(npy_path, mmap_mode='r'), chunks=chunks, compression=compression, level=level)
+    return out_path
+
+
+def convert_npy_folder(root, out_root=None, chunks=(64, 64, 64), compression='zlib', level=1, overwrite=False):
+    """
+    Converts all .npy files below root into chunked volumes, keeping the folder structure.
+
+    :param root: input folder
+    :param out_root: output folder (default: next to the .npy files)
+    :param chunks: chunk shape
+    :param compression: 'zlib', 'lz4' or None
+    :param level: compression level
+    :param overwrite: if False, existing volumes are kept
+    :return: list of the chunked volume paths (sorted by input path)
+    """
+    root = os.path.expanduser(root)
+    out_root = root if out_root is None else os.path.expanduser(out_root)
+    converted = []
+    for dirpath, _, filenames in sorted(os.walk(root)):
+        for filename in sorted(filenames):
+            if not filename.endswith('.npy'):
+                continue
+            out_dir = os.path.join(out_root, os.path.relpath(dirpath, root))
+            out_path = os.path.join(out_dir, os.path.splitext(filename)[0] + VOLUME_EXTENSION)
+            if overwrite or not os.path.exists(out_path):
+                os.makedirs(out_dir, exist_ok=True)
+                npy_to_chunked(os.path.join(dirpath, filename), out_path, chunks=chunks, compression=compression, level=level)
+            converted.append(out_path)
+    return converted
@@ -1,5 +1,6 @@
 import random
 from .FolderDataset import FolderDataset
+from .data_utils import SampleIndex
 
 class ClonedFolderDataset(FolderDataset):
     def __init__(self, data, meta_data, **kwargs):
@@ -8,8 +9,8 @@ class ClonedFolderDataset(FolderDataset):
 
         Arguments
         ---------
-        :param data: list
-            list of data on which the dataset operates
+        :param data: list or SampleIndex
+            list of (input, target) items on which the dataset operates (stored as a compact SampleIndex)
 
         :param meta_data: dict
             parameters that correspond to the target dataset's attributes
@@ -20,7 +21,7 @@ class ClonedFolderDataset(FolderDataset):
         else:
             print('Initializing with %i data items' % len(data))
 
-        self.data = data
+        self.data = SampleIndex(data)
 
         # Source: https://stackoverflow.com/questions/2466191/set-attributes-from-dictionary-in-python
         # generic way of initializing the object
@@ -48,14 +49,15 @@ def random_split_dataset(orig_dataset, splitRatio=0.8, random_seed=None):
 
     # not cloning the dictionary at this point... maybe it should be?
     orig_dict = orig_dataset.getmeta_data()
+    data = SampleIndex(orig_dataset.getdata())
     part1 = []
     part2 = []
 
-
-    for i, item in enumerate(orig_dataset.getdata()):
+    for i in range(len(data)):
         if random.random() < splitRatio:
-            part1.append(item)
+            part1.append(i)
         else:
-            part2.append(item)
+            part2.append(i)
 
-    return ClonedFolderDataset(part1, orig_dict), ClonedFolderDataset(part2, orig_dict)
\ No newline at end of file
+    # split the compact index directly instead of materializing lists of tuples
+    return ClonedFolderDataset(data.select(part1), orig_dict), ClonedFolderDataset(data.select(part2), orig_dict)
\ No newline at end of file
@@ -1,9 +1,14 @@
 import numpy as np
 import os
+import pickle
+import random
+import warnings
 
 from PIL import Image
 from .UsefulDataset import UsefulDataset
-from .data_utils import npy_loader, pil_loader, _find_classes, _finds_inputs_and_targets
+from ..transforms.tensor_transforms import split_deterministic
+from .data_utils import npy_loader, npy_mmap_loader, pil_loader, _find_classes, _finds_inputs_and_targets, _build_index_lut, _remap_mask, SampleIndex, SampleCache, SampleQuarantine, \
+    _read_image_size
 
 # convenience loaders one can use (in order not to reinvent the wheel)
 rgb_image_loader = lambda path: Image.open(path).convert('RGB')   # a loader for images that require RGB color space
@@ -11,6 +16,17 @@ rgba_image_loader = lambda path: Image.open(path).convert('RGBA')   # a loader f
 bw_image_loader = lambda path: Image.open(path).convert('L')      # a loader for images that require B/W color space
 identity_x = lambda x: x
 
+# errors of loaders on missing, truncated or corrupt files (npy_loader reports broken .npy files as OSError).
+# A generic ValueError is not one of them: it usually is a bug in a loader and must not quarantine valid files.
+_READ_ERRORS = (OSError, getattr(Image, 'UnidentifiedImageError', OSError), EOFError, pickle.UnpicklingError)
+
+
+class _UnreadableSample(Exception):
+    # raised (only) by FolderDataset._read, so __getitem__ quarantines unreadable files and nothing else
+    def __init__(self, error):
+        super().__init__(str(error))
+        self.error = error
+
 
 class FolderDataset(UsefulDataset):
     def __init__(self,
@@ -29,7 +45,12 @@ class FolderDataset(UsefulDataset):
                  default_loader='pil',
                  target_loader=None,
                  exclusion_file=None,
-                 target_index_map=None):
+                 target_index_map=None,
+                 compact_targets=False,
+                 cache=None,
+                 cache_dir=None,
+                 quarantine=None,
+                 max_retries=10):
         """
         Dataset class for loading out-of-memory data. First, the relevant directory structures are traversed to find all necessary files.\n
         Then provided loader(s) is/(are) invoked on inputs and targets.\n
@@ -86,8 +107,9 @@ class FolderDataset(UsefulDataset):
         :param apply_co_transform_first: bool\n
             whether to apply the co-transform before or after individual transforms (default: True = before)
 
-        :param default_loader: string in `{'npy', 'pil'} or function  (default: pil)\n
+        :param default_loader: string in `{'npy', 'npy_mmap', 'pil'} or function  (default: pil)\n
             defines how to load samples from file. Will be applied to both input and target unless a separate target_loader is defined.\n
+            'npy_mmap' memory maps .npy files, so transforms that crop or slice (e.g. Slice2D) only read the region they keep.\n
             if a function is provided, it should take in a file path as input and return the loaded sample.
 
         param target_loader: string in `{'npy', 'pil'} or function  (default: pil)\n
@@ -103,6 +125,27 @@ class FolderDataset(UsefulDataset):
             Used in conjunction with 'image' class_mode to produce a label for semantic segmentation
             For semantic segmentation this is required so the default is a binary mask. However, if you want to turn off
             this feature then specify target_index_map=None
+
+        :param compact_targets: bool (default: False)\n
+            if True, remapped masks are kept as 8-bit ('L' mode) images of class indices instead of being converted to float32.\n
+            This keeps memory and worker IPC 4x smaller. Use MaskToTensor() as the target transform to get a uint8 or int64 class-index tensor.
+
+        :param cache: string in `{'memory', 'disk'}` or SampleCache (default: None)\n
+            if set, every sample is decoded only once: the loaded sample together with the output of the deterministic prefix of
+            transform and target_transform (see Compose.split_deterministic) is cached per file and only the remaining random
+            transforms run on later epochs. When the co-transform is applied first only the decoded samples are cached.\n
+            The memory tier needs persistent_workers=True when loading with workers (see SampleCache).
+
+        :param cache_dir: string\n
+            directory used by the disk cache
+
+        :param quarantine: string or SampleQuarantine (default: None)\n
+            samples whose files can't be read or decoded are added to this skip list and a randomly drawn replacement sample is returned
+            instead, so batches keep their shape. If a file path is given the skip list is shared by all workers and quarantined
+            files are left out when the folder is scanned again. By default failures are only remembered by the current process.
+
+        :param max_retries: int (default: 10)\n
+            number of replacement samples to try before giving up on an index
         """
 
         # call the super constructor first, then set our own parameters
@@ -110,6 +153,8 @@ class FolderDataset(UsefulDataset):
 
         if default_loader == 'npy':
             default_loader = npy_loader
+        elif default_loader == 'npy_mmap':
+            default_loader = npy_mmap_loader
         elif default_loader == 'pil':
             default_loader = pil_loader
         self.default_loader = default_loader
@@ -124,9 +169,15 @@ class FolderDataset(UsefulDataset):
             self.class_to_idx = class_to_idx
         else:
             self.classes, self.class_to_idx = _find_classes(root)
+        if not isinstance(quarantine, SampleQuarantine):
+            quarantine = SampleQuarantine(quarantine)
+        self.quarantine = quarantine
+        self.max_retries = max_retries
+
         data, _ = _finds_inputs_and_targets(root, class_mode=class_mode, class_to_idx=self.class_to_idx, input_regex=input_regex,
                                             rel_target_root=rel_target_root, target_prefix=target_prefix, target_postfix=target_postfix,
-                                            target_extension=target_extension, exclusion_file=exclusion_file)
+                                            target_extension=target_extension, exclusion_file=exclusion_file,
+                                            skip_paths=quarantine.paths())
 
         if len(data) == 0:
             raise (RuntimeError('Found 0 data items in subfolders of: %s' % root))
@@ -134,63 +185,146 @@ class FolderDataset(UsefulDataset):
             print('Found %i data items' % len(data))
 
         self.root = os.path.expanduser(root)
-        self.data = data
+        self.data = SampleIndex(data)      # compact (numpy-backed) index, shared copy-on-write with loader workers
         self.transform = transform
         self.target_transform = target_transform
         self.co_transform = co_transform
         self.apply_co_transform_first = apply_co_transform_first
         self.target_index_map = target_index_map
+        self.compact_targets = compact_targets
+        if isinstance(cache, str):
+            cache = SampleCache(tier=cache, cache_dir=cache_dir)
+        self.cache = cache
 
         self.class_mode = class_mode
 
-    def __getitem__(self, index):
-        # get paths
-        input_sample, target_sample = self.data[index]
-
-        in_base = input_sample
-        out_base = target_sample
+    def _get_target_lut(self):
+        # built lazily since cloned datasets are initialized from meta data only
+        if not hasattr(self, '_target_lut'):
+            dtype = np.uint8 if getattr(self, 'compact_targets', False) else np.float32
+            self._target_lut = _build_index_lut(self.target_index_map, dtype=dtype)
+        return self._target_lut
 
-        try:
-            if self.target_loader is not None:
-                target_sample = self.target_loader(target_sample)
-
-            ## DELETEME
-            # if len(self.classes) == 1 and self.class_mode == 'image':  # this is a binary segmentation map
-            #     target_sample = self.default_loader(target_sample, color_space='L')
-            # else:
-            #     if self.class_mode == 'image':
-            #         target_sample = self.default_loader(target_sample)
-            ## END DELETEME
-
-            # load samples into memory
-            input_sample = self.default_loader(input_sample)
-            if self.class_mode == 'image' and self.target_index_map is not None:   # if we're dealing with image masks, we need to change the underlying pixels
-                target_sample = np.array(target_sample)  # convert to np
-                for k, v in self.target_index_map.items():
-                    target_sample[target_sample == k] = v  # replace pixels with class values
-                target_sample = Image.fromarray(target_sample.astype(np.float32))  # convert back to image
-
-            # apply transforms
+    def _get_transform_split(self):
+        # (input prefix, input suffix, target prefix, target suffix), built lazily for the same reason as the target LUT
+        if not hasattr(self, '_transform_split'):
             if self.apply_co_transform_first and self.co_transform is not None:
-                input_sample, target_sample = self.co_transform(input_sample, target_sample)
-            if self.transform is not None:
-                # input_sample = self.transform(image=input_sample)     # needed for albumentations to work (but currently albumentations dies with multiple workers)
-                input_sample = self.transform(input_sample)
-            if self.target_transform is not None:
-                target_sample = self.target_transform(target_sample)
-            if not self.apply_co_transform_first and self.co_transform is not None:
-                input_sample, target_sample = self.co_transform(input_sample, target_sample)
-
-            return input_sample, target_sample
-        except Exception as e:
-            print('########## ERROR ########')
-            print(str(e))
-            print('=========================')
-            print("ERROR: Exception occurred while processing dataset with input {} and output {}".format(str(in_base), str(out_base)))
+                # the (random) co-transform runs before the individual transforms, so nothing after decoding can be cached
+                self._transform_split = (None, self.transform, None, self.target_transform)
+            else:
+                self._transform_split = split_deterministic(self.transform) + split_deterministic(self.target_transform)
+        return self._transform_split
+
+    @staticmethod
+    def _read(loader, path):
+        # only read/decode errors mark a file as broken, anything else (e.g. a bug in a transform) is raised
+        try:
+            return loader(path)
+        except _READ_ERRORS as e:
+            raise _UnreadableSample(e)
+
+    def _load_sample(self, input_sample, target_sample):
+        if self.target_loader is not None:
+            target_sample = self._read(self.target_loader, target_sample)
+
+        ## DELETEME
+        # if len(self.classes) == 1 and self.class_mode == 'image':  # this is a binary segmentation map
+        #     target_sample = self.default_loader(target_sample, color_space='L')
+        # else:
+        #     if self.class_mode == 'image':
+        #         target_sample = self.default_loader(target_sample)
+        ## END DELETEME
+
+        # load samples into memory
+        input_sample = self._read(self.default_loader, input_sample)
+        if self.class_mode == 'image' and self.target_index_map is not None:   # if we're dealing with image masks, we need to change the underlying pixels
+            dtype = np.uint8 if getattr(self, 'compact_targets', False) else np.float32
+            target_sample = np.asarray(target_sample)  # convert to np
+            target_sample = _remap_mask(target_sample, self.target_index_map, lut=self._get_target_lut(), dtype=dtype)  # replace pixels with class values
+            target_sample = Image.fromarray(target_sample)  # convert back to image
+        return input_sample, target_sample
+
+    def _load_cached_sample(self, input_sample, target_sample):
+        # decoded samples with the deterministic transform prefixes applied, computed once per file
+        key = (input_sample, target_sample)
+        cached = self.cache.get(key)
+        if cached is None:
+            input_prefix, _, target_prefix, _ = self._get_transform_split()
+            input_sample, target_sample = self._load_sample(input_sample, target_sample)
+            if input_prefix is not None:
+                input_sample = input_prefix(input_sample)
+            if target_prefix is not None:
+                target_sample = target_prefix(target_sample)
+            cached = (input_sample, target_sample)
+            self.cache.put(key, cached)
+        return cached
+
+    def _get_sample(self, input_sample, target_sample):
+        if getattr(self, 'cache', None) is not None:
+            input_sample, target_sample = self._load_cached_sample(input_sample, target_sample)
+            _, transform, _, target_transform = self._get_transform_split()
+        else:
+            input_sample, target_sample = self._load_sample(input_sample, target_sample)
+            transform, target_transform = self.transform, self.target_transform
+
+        # apply transforms
+        if self.apply_co_transform_first and self.co_transform is not None:
+            input_sample, target_sample = self.co_transform(input_sample, target_sample)
+        if transform is not None:
+            # input_sample = self.transform(image=input_sample)     # needed for albumentations to work (but currently albumentations dies with multiple workers)
+            input_sample = transform(input_sample)
+        if target_transform is not None:
+            target_sample = target_transform(target_sample)
+        if not self.apply_co_transform_first and self.co_transform is not None:
+            input_sample, target_sample = self.co_transform(input_sample, target_sample)
+
+        return input_sample, target_sample
+
+    def _get_quarantine(self):
+        # cloned datasets created from older meta data don't carry a quarantine
+        if getattr(self, 'quarantine', None) is None:
+            self.quarantine = SampleQuarantine()
+        return self.quarantine
+
+    def __getitem__(self, index):
+        quarantine = self._get_quarantine()
+        for _ in range(getattr(self, 'max_retries', 10) + 1):
+            # get paths
+            input_sample, target_sample = self.data[index]
+            if input_sample not in quarantine:
+                try:
+                    return self._get_sample(input_sample, target_sample)
+                except _UnreadableSample as e:
+                    warnings.warn('Quarantined sample with input {} and output {}: {}'.format(input_sample, target_sample, e.error))
+                    quarantine.add(input_sample, reason=e.error)
+            # draw a replacement so the batch keeps its shape
+            index = random.randrange(len(self.data))
+        raise RuntimeError('Could not load a valid sample after %i retries (%i samples quarantined)' % (getattr(self, 'max_retries', 10), len(quarantine)))
+
+    def __getitems__(self, indices):
+        """
+        Batch fetch (see SampleBatch). Samples are decoded from individual files so they are loaded one by one.
+
+        :param indices: list of sample indices
+        :return: list of samples
+        """
+        return [self[index] for index in indices]
 
     def __len__(self):
         return len(self.data)
 
+    def get_sample_sizes(self):
+        """
+        (height, width) of every input, read from the file headers once and then kept in the sample index
+        (e.g. for BucketBatchSampler).
+
+        :return: int32 numpy array of shape (N, 2)
+        """
+        if getattr(self.data, 'sizes', None) is None:
+            self.data.sizes = np.asarray([_read_image_size(self.data.inputs[i]) for i in range(len(self.data))],
+                                         dtype=np.int32).reshape(-1, 2)
+        return self.data.sizes
+
     def getdata(self):
         return self.data
 
@@ -206,6 +340,10 @@ class FolderDataset(UsefulDataset):
                 'default_loader': self.default_loader,
                 'target_loader': self.target_loader,
                 'apply_co_transform_first': self.apply_co_transform_first,
-                'target_index_map': self.target_index_map
+                'target_index_map': self.target_index_map,
+                'compact_targets': self.compact_targets,
+                'cache': getattr(self, 'cache', None),
+                'quarantine': self._get_quarantine(),
+                'max_retries': getattr(self, 'max_retries', 10)
                 }
         return meta
\ No newline at end of file
@@ -1,7 +1,7 @@
 from .FolderDataset import FolderDataset, identity_x
 
 class PredictFolderDataset(FolderDataset):
-    def __init__(self, root, input_regex='*', input_transform=None, input_loader=identity_x, target_loader=None,  exclusion_file=None):
+    def __init__(self, root, input_regex='*', input_transform=None, input_loader=identity_x, target_loader=None,  exclusion_file=None, quarantine=None):
         """
         Convenience class for loading out-of-memory data that is more geared toward prediction data loading (where ground truth is not available). \n
         If not transformed in any way (either via one of the loaders or transforms) the inputs and targets will be identical (paths to the discovered files)\n
@@ -32,8 +32,12 @@ class PredictFolderDataset(FolderDataset):
         :param exclusion_file: string\n
             list of files to exclude when enumerating all files.\n
             The list must be a full path relative to the root parameter
+
+        :param quarantine: string or SampleQuarantine (default: None)\n
+            skip list for files that fail to load (see FolderDataset)
         """
 
         super().__init__(root=root, class_mode='path', input_regex=input_regex, target_extension=None, transform=input_transform,
-                 default_loader=input_loader, target_loader=target_loader, exclusion_file=exclusion_file, target_index_map=None)
+                 default_loader=input_loader, target_loader=target_loader, exclusion_file=exclusion_file, target_index_map=None,
+                 quarantine=quarantine)
 
@@ -1,5 +1,6 @@
 from .BaseDataset import BaseDataset
-from .data_utils import _process_array_argument, _return_first_element_of_list, _process_transform_argument, _process_co_transform_argument, _pass_through
+from .data_utils import _process_array_argument, _return_first_element_of_list, _process_transform_argument, _process_co_transform_argument, _pass_through, \
+    _apply_transform_to_batch, _is_sample_list, SampleBatch
 
 class TensorDataset(BaseDataset):
 
@@ -59,4 +60,26 @@ class TensorDataset(BaseDataset):
 
             return self.input_return_processor(input_sample), self.target_return_processor(target_sample)
         else:
-            return self.input_return_processor(input_sample)
\ No newline at end of file
+            return self.input_return_processor(input_sample)
+
+    def __getitems__(self, indices):
+        """
+        Index a whole batch at once (one indexing op per array). Transforms that support batches
+        are called once on the batch, other transforms are applied sample by sample.
+
+        :param indices: list of sample indices
+        :return: SampleBatch (list of samples that also carries the assembled batch), or a list of samples
+            if the transformed samples cannot be stacked (e.g. they have different sizes)
+        """
+        input_batch = [_apply_transform_to_batch(self.input_transform[i], self.inputs[i][indices]) for i in range(self.num_inputs)]
+
+        if self.has_target:
+            target_batch = [_apply_transform_to_batch(self.target_transform[i], self.targets[i][indices]) for i in range(self.num_targets)]
+            if _is_sample_list(*input_batch, *target_batch):
+                return [(self.input_return_processor([b[j] for b in input_batch]),
+                         self.target_return_processor([b[j] for b in target_batch])) for j in range(len(indices))]
+            return SampleBatch((self.input_return_processor(input_batch), self.target_return_processor(target_batch)), len(indices))
+        else:
+            if _is_sample_list(*input_batch):
+                return [self.input_return_processor([b[j] for b in input_batch]) for j in range(len(indices))]
+            return SampleBatch(self.input_return_processor(input_batch), len(indices))
@@ -0,0 +1,231 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+from .UsefulDataset import UsefulDataset
+from .data_utils import _tile_origins, _build_index_lut, _remap_mask, _read_image_size
+
+
+class TileDataset(UsefulDataset):
+    def __init__(self,
+                 inputs,
+                 targets=None,
+                 tile_size=512,
+                 overlap=0,
+                 transform=None,
+                 target_transform=None,
+                 co_transform=None,
+                 target_index_map=None,
+                 skip_empty=False,
+                 min_coverage=0.0,
+                 coverage_file=None,
+                 max_open_images=2):
+        """
+        Dataset of fixed-size tiles cut out of (very) large images, e.g. for segmentation of gigapixel or 8K inputs.\n
+        Every item is one (image, tile origin) pair so only the needed region has to be read instead of loading whole images
+        and cropping most of them away.\n
+
+        Regions of .npy files are read through a memory map, so only the pages of the tile are touched.\n
+        Other files are opened lazily with PIL. Most image formats can only be decoded as a whole, so the last
+        max_open_images decoded images are kept per worker: tiles are indexed image by image, which makes sequential
+        access cheap. For random access over many huge images, convert them to .npy first.
+        (PIL refuses images above PIL.Image.MAX_IMAGE_PIXELS, raise that limit for gigapixel inputs.)
+
+        Arguments
+        ---------
+        :param inputs: list of strings\n
+            paths to the input images (.npy or any format PIL can open)
+
+        :param targets: list of strings (default: None)\n
+            paths to the matching masks. If None, only input tiles are returned.
+
+        :param tile_size: int or tuple (height, width)\n
+            size of the returned tiles. Tiles of images smaller than the tile size are zero-padded.
+
+        :param overlap: int or tuple (height, width) (default: 0)\n
+            number of pixels shared by neighbouring tiles
+
+        :param transform: torch transform\n
+            transform to apply to input tiles individually
+
+        :param target_transform: torch transform\n
+            transform to apply to target tiles individually
+
+        :param co_transform: torch transform\n
+            transform to apply to both the input and the target tile (after the individual transforms)
+
+        :param target_index_map: dict (default: None)\n
+            maps mask pixel values to class indices (see FolderDataset)
+
+        :param skip_empty: bool (default: False)\n
+            if True, only tiles whose fraction of non-zero mask pixels is larger than min_coverage are indexed.
+            Requires targets.
+
+        :param min_coverage: float (default: 0.0)\n
+            coverage threshold used by skip_empty
+
+        :param coverage_file: string (default: None)\n
+            .npz file holding the precomputed coverage index. It is created on the first run and loaded on later ones,
+            so masks are only scanned once. Delete it when the data, tile size or overlap change.
+
+        :param max_open_images: int (default: 2)\n
+            number of decoded (non-npy) images kept in memory per worker
+        """
+        super().__init__()
+        if targets is not None and len(targets) != len(inputs):
+            raise ValueError('inputs and targets must have the same length')
+        if skip_empty and targets is None:
+            raise ValueError('skip_empty requires targets')
+
+        self.inputs = list(inputs)
+        self.targets = list(targets) if targets is not None else None
+        self.tile_size = tuple(tile_size) if isinstance(tile_size, (tuple, list)) else (tile_size, tile_size)
+        self.overlap = tuple(overlap) if isinstance(overlap, (tuple, list)) else (overlap, overlap)
+        self.transform = transform
+        self.target_transform = target_transform
+        self.co_transform = co_transform
+        self.target_index_map = target_index_map
+        self.skip_empty = skip_empty
+        self.min_coverage = min_coverage
+        self.max_open_images = max_open_images
+        if targets is None:
+            self.num_targets = 0
+
+        if coverage_file is not None and os.path.exists(coverage_file):
+            index = np.load(coverage_file)
+            all_tiles, coverage = index['tiles'], index['coverage']
+        else:
+            all_tiles = self._build_tiles()
+            scan = self.targets is not None and (skip_empty or coverage_file is not None)
+            coverage = self._compute_coverage(all_tiles) if scan else None
+            if coverage_file is not None and coverage is not None:
+                np.savez(coverage_file, tiles=all_tiles, coverage=coverage)
+
+        # one (image index, y, x) row per tile
+        self.coverage = coverage
+        self.tiles = all_tiles[coverage > min_coverage] if skip_empty else all_tiles
+        if len(self.tiles) == 0:
+            raise RuntimeError('Found 0 tiles')
+
+        self._images = OrderedDict()
+
+    def __getstate__(self):
+        # decoded images are a per-process cache, don't ship them to workers
+        state = self.__dict__.copy()
+        state['_images'] = OrderedDict()
+        return state
+
+    def _build_tiles(self):
+        tiles = []
+        for image_idx, path in enumerate(self.inputs):
+            height, width = _read_image_size(path)
+            for y in _tile_origins(height, self.tile_size[0], self.overlap[0]):
+                for x in _tile_origins(width, self.tile_size[1], self.overlap[1]):
+                    tiles.append((image_idx, y, x))
+        return np.asarray(tiles, dtype=np.int64).reshape(-1, 3)
+
+    def _compute_coverage(self, tiles):
+        # fraction of non-zero mask pixels per tile. The mask is scanned one band of tile height at a time with a
+        # running count over the columns, so memory stays at one band instead of a full-resolution integral image
+        tile_h, tile_w = self.tile_size
+        coverage = np.zeros(len(tiles), dtype=np.float32)
+        for image_idx in np.unique(tiles[:, 0]):
+            rows = np.nonzero(tiles[:, 0] == image_idx)[0]
+            mask = _read_full(self.targets[image_idx])
+            for y in np.unique(tiles[rows, 1]):
+                band_rows = rows[tiles[rows, 1] == y]
+                band = np.asarray(mask[y:y + tile_h]) != 0
+                if band.ndim == 3:
+                    band = band.any(axis=2)
+                counts = np.zeros(band.shape[1] + 1, dtype=np.int64)
+                np.cumsum(band.sum(axis=0), out=counts[1:])
+                x0 = tiles[band_rows, 2]
+                x1 = np.minimum(x0 + tile_w, band.shape[1])
+                coverage[band_rows] = (counts[x1] - counts[x0]) / float(tile_h * tile_w)
+        return coverage
+
+    def _get_target_lut(self):
+        if not hasattr(self, '_target_lut'):
+            self._target_lut = _build_index_lut(self.target_index_map, dtype=np.float32)
+        return self._target_lut
+
+    def _read_tile(self, path, y, x):
+        tile_h, tile_w = self.tile_size
+        if path.endswith('.npy'):
+            array = np.load(path, mmap_mode='r')
+            region = np.array(array[y:y + tile_h, x:x + tile_w])
+            if region.shape[:2] != (tile_h, tile_w):
+                padded = np.zeros((tile_h, tile_w) + region.shape[2:], dtype=region.dtype)
+                padded[:region.shape[0], :region.shape[1]] = region
+                region = padded
+            return region
+
+        image = self._images.get(path)
+        if image is None:
+            image = Image.open(path)
+            image.load()
+            self._images[path] = image
+            while len(self._images) > self.max_open_images:
+                self._images.popitem(last=False)
+        else:
+            self._images.move_to_end(path)
+        return image.crop((x, y, x + tile_w, y + tile_h))      # regions outside the image are filled with zeros
+
+    def __getitem__(self, index):
+        # a tuple is a tile origin (image index, y, x) itself, e.g. drawn by ForegroundPatchSampler
+        image_idx, y, x = (int(v) for v in (index if isinstance(index, tuple) else self.tiles[index]))
+        input_sample = self._read_tile(self.inputs[image_idx], y, x)
+        if self.transform is not None:
+            input_sample = self.transform(input_sample)
+        if self.targets is None:
+            return input_sample
+
+        target_sample = self._read_tile(self.targets[image_idx], y, x)
+        if self.target_index_map is not None:
+            is_image = isinstance(target_sample, Image.Image)
+            target_sample = _remap_mask(np.asarray(target_sample), self.target_index_map, lut=self._get_target_lut())
+            if is_image:
+                target_sample = Image.fromarray(target_sample)
+        if self.target_transform is not None:
+            target_sample = self.target_transform(target_sample)
+        if self.co_transform is not None:
+            input_sample, target_sample = self.co_transform(input_sample, target_sample)
+        return input_sample, target_sample
+
+    def __getitems__(self, indices):
+        """
+        Batch fetch (see SampleBatch). Tiles are read one by one.
+
+        :param indices: list of sample indices
+        :return: list of samples
+        """
+        return [self[index] for index in indices]
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def getdata(self):
+        return self.tiles
+
+    def getmeta_data(self):
+        meta = {'num_inputs': self.num_inputs,
+                'num_targets': self.num_targets,
+                'inputs': self.inputs,
+                'targets': self.targets,
+                'tile_size': self.tile_size,
+                'overlap': self.overlap,
+                'transform': self.transform,
+                'target_transform': self.target_transform,
+                'co_transform': self.co_transform,
+                'target_index_map': self.target_index_map
+                }
+        return meta
+
+
+def _read_full(path):
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    with Image.open(path) as image:
+        return np.asarray(image)
@@ -0,0 +1,155 @@
+import itertools
+
+import numpy as np
+
+from .UsefulDataset import UsefulDataset
+from .ChunkedVolume import ChunkedVolume, ChunkCache
+from .data_utils import _tile_origins
+
+
+class VolumePatchDataset(UsefulDataset):
+    def __init__(self,
+                 inputs,
+                 targets=None,
+                 patch_size=64,
+                 overlap=0,
+                 patches=None,
+                 transform=None,
+                 target_transform=None,
+                 co_transform=None,
+                 cache_bytes=0):
+        """
+        Dataset of 3D patches read from chunked, compressed volumes (see ChunkedVolume and convert_npy_folder).\n
+        Only the chunks that overlap a patch are read and decompressed. Optionally (cache_bytes) decoded chunks
+        are kept in an LRU cache that is shared by all DataLoader workers, so neighbouring or overlapping patches
+        are cheap.
+
+        Arguments
+        ---------
+        :param inputs: list of strings\n
+            paths to the input volumes (.wvol)
+
+        :param targets: list of strings (default: None)\n
+            paths to the matching label volumes. If None, only input patches are returned.
+
+        :param patch_size: int or tuple (depth, height, width)\n
+            size of the returned patches. Patches reaching outside of a volume are zero-padded.
+
+        :param overlap: int or tuple (default: 0)\n
+            number of voxels shared by neighbouring patches of the default patch grid
+
+        :param patches: array of shape (N, 4) (default: None)\n
+            (volume index, z, y, x) start of every patch. Overrides the regular patch grid, e.g. to train on
+            patches drawn by a sampler.
+
+        :param transform: torch transform\n
+            transform to apply to input patches individually
+
+        :param target_transform: torch transform\n
+            transform to apply to target patches individually
+
+        :param co_transform: torch transform\n
+            transform to apply to both the input and the target patch (after the individual transforms)
+
+        :param cache_bytes: int (default: 0)\n
+            size of the shared decoded-chunk cache, 0 disables caching. The cache is allocated in shared memory
+            (/dev/shm) when the dataset is created, so keep it below the shared memory of the machine / container
+            (docker defaults to 64MB) for all datasets together, e.g. train and validation.
+        """
+        super().__init__()
+        if targets is not None and len(targets) != len(inputs):
+            raise ValueError('inputs and targets must have the same length')
+
+        self.inputs = list(inputs)
+        self.targets = list(targets) if targets is not None else None
+        self.transform = transform
+        self.target_transform = target_transform
+        self.co_transform = co_transform
+        if targets is None:
+            self.num_targets = 0
+
+        self.volumes = [ChunkedVolume(path) for path in self.inputs]
+        self.target_volumes = [ChunkedVolume(path) for path in self.targets] if targets is not None else None
+        all_volumes = self.volumes + (self.target_volumes or [])
+        ndim = all_volumes[0].ndim
+        self.patch_size = tuple(patch_size) if isinstance(patch_size, (tuple, list)) else (patch_size,) * ndim
+        self.overlap = tuple(overlap) if isinstance(overlap, (tuple, list)) else (overlap,) * ndim
+
+        self.cache = None
+        if cache_bytes:
+            chunk_bytes = max(int(np.prod(v.chunks)) * v.dtype.itemsize for v in all_volumes)
+            self.cache = ChunkCache(cache_bytes, chunk_bytes)      # allocated here, before any worker is started
+            for volume in all_volumes:
+                volume.cache = self.cache
+
+        # one (volume index, start...) row per patch
+        self.patches = np.asarray(patches, dtype=np.int64) if patches is not None else self._build_patches()
+        if len(self.patches) == 0:
+            raise RuntimeError('Found 0 patches')
+
+    def _build_patches(self):
+        patches = []
+        for volume_idx, volume in enumerate(self.volumes):
+            axes = [_tile_origins(s, p, o) for s, p, o in zip(volume.shape, self.patch_size, self.overlap)]
+            for origin in itertools.product(*axes):
+                patches.append((volume_idx,) + origin)
+        return np.asarray(patches, dtype=np.int64).reshape(-1, 1 + len(self.patch_size))
+
+    def read_patch(self, volume_idx, start, size=None):
+        """
+        Reads an arbitrary patch of one input volume (and its target).
+
+        :param volume_idx: index of the volume
+        :param start: first voxel of the patch (may reach outside of the volume)
+        :param size: patch shape (default: patch_size)
+        :return: input patch or (input patch, target patch)
+        """
+        size = self.patch_size if size is None else size
+        input_patch = self.volumes[volume_idx].read(start, size)
+        if self.target_volumes is None:
+            return input_patch
+        return input_patch, self.target_volumes[volume_idx].read(start, size)
+
+    def __getitem__(self, index):
+        # a tuple is a patch origin (volume index, z, y, x) itself, e.g. drawn by ForegroundPatchSampler
+        row = index if isinstance(index, tuple) else self.patches[index]
+        patch = self.read_patch(int(row[0]), row[1:])
+        if self.target_volumes is None:
+            return self.transform(patch) if self.transform is not None else patch
+
+        input_sample, target_sample = patch
+        if self.transform is not None:
+            input_sample = self.transform(input_sample)
+        if self.target_transform is not None:
+            target_sample = self.target_transform(target_sample)
+        if self.co_transform is not None:
+            input_sample, target_sample = self.co_transform(input_sample, target_sample)
+        return input_sample, target_sample
+
+    def __getitems__(self, indices):
+        """
+        Batch fetch (see SampleBatch). Patches are read one by one, patches sharing chunks hit the cache.
+
+        :param indices: list of sample indices
+        :return: list of samples
+        """
+        return [self[index] for index in indices]
+
+    def __len__(self):
+        return len(self.patches)
+
+    def getdata(self):
+        return self.patches
+
+    def getmeta_data(self):
+        meta = {'num_inputs': self.num_inputs,
+                'num_targets': self.num_targets,
+                'inputs': self.inputs,
+                'targets': self.targets,
+                'patch_size': self.patch_size,
+                'overlap': self.overlap,
+                'transform': self.transform,
+                'target_transform': self.target_transform,
+                'co_transform': self.co_transform
+                }
+        return meta
@@ -1,2 +1,2 @@
-from . import BaseDataset, ClonedDataset, CSVDataset, FolderDataset, PredictFolderDataset, UsefulDataset, data_utils
+from . import BaseDataset, ChunkedVolume, ClonedDataset, CSVDataset, FolderDataset, PredictFolderDataset, TileDataset, UsefulDataset, VolumePatchDataset, data_utils
 from .tnt import *
@@ -1,10 +1,16 @@
+import copy
 import fnmatch
+import hashlib
+import itertools
 import os
 import os.path
 import random
+import time
 import warnings
 
 import numpy as np
+import torch as th
+from torch.utils.data.dataloader import default_collate, default_convert
 
 try:
     from PIL import Image
@@ -29,9 +35,8 @@ def pil_loader(path, color_space=''):
             return Image.open(path).convert('1')
         else:
             return Image.open(path)
-    except OSError:
-        print("!!!  Could not read path: " + path)
-        exit(2)
+    except OSError as e:
+        raise OSError('Could not read path: ' + path) from e
 
 
 def pil_loader_rgb(path):
@@ -44,8 +49,123 @@ def pil_loader_bw(path):
         return Image.open(f).convert('L')
 
 
-def npy_loader(path, color_space=None):     # color space is unused here
-    return np.load(path)
+def npy_loader(path, color_space=None, mmap_mode=None):     # color space is unused here
+    """
+    Loads a .npy file.
+
+    :param path: path to the file
+    :param color_space: unused
+    :param mmap_mode: None or one of numpy's mmap modes ('r', 'r+', 'c').
+        With 'r' the array is memory mapped instead of read, so only the regions that are indexed later
+        (e.g. the slice picked by Slice2D) are actually read from disk.
+
+    :return: numpy array (np.memmap if mmap_mode is given)
+    """
+    try:
+        return np.load(path, mmap_mode=mmap_mode)
+    except ValueError as e:
+        # np.load raises ValueError on a broken header or a truncated file
+        raise OSError('Could not read path: ' + path) from e
+
+
+def npy_mmap_loader(path, color_space=None):
+    return npy_loader(path, color_space=color_space, mmap_mode='r')
+
+
+def nonzero_slices(volume, axis=0, chunk_size=16):
+    """
+    Indices of the slices along `axis` that contain at least one non-zero value.
+    Memory mapped volumes are scanned chunk by chunk, so at most chunk_size slices are in memory at once.
+
+    :param volume: numpy array, np.memmap or torch tensor
+    :param axis: axis along which slices are taken
+    :param chunk_size: number of slices scanned at once
+
+    :return: int64 numpy array of slice indices (sorted)
+    """
+    if th.is_tensor(volume):
+        volume = volume.numpy()
+    volume = np.moveaxis(volume, axis, 0)      # a view, nothing is read yet
+    found = []
+    for start in range(0, volume.shape[0], chunk_size):
+        chunk = np.asarray(volume[start:start + chunk_size]).reshape(min(chunk_size, volume.shape[0] - start), -1)
+        found.append(np.flatnonzero(chunk.any(axis=1)) + start)
+    if not found:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(found).astype(np.int64)
+
+
+def build_nonzero_slice_index(paths, axis=0, index_file=None):
+    """
+    Precomputes the non-empty slices of a list of .npy volumes (see Slice2D(slice_index=...)).
+    Volumes are memory mapped and scanned once. If index_file is given, the index is saved there
+    (.npz) on the first run and loaded on later runs. Delete it when the volumes change.
+
+    :param paths: list of .npy paths
+    :param axis: axis along which slices are taken
+    :param index_file: optional .npz file caching the index
+
+    :return: dict path -> int64 array of non-empty slice indices
+    """
+    paths = [os.path.abspath(p) for p in paths]
+    if index_file is not None and os.path.exists(index_file):
+        index = np.load(index_file)
+        if int(index['axis']) == axis:
+            stored = [str(p) for p in index['paths']]
+            offsets = index['offsets']
+            slices = {p: index['slices'][offsets[i]:offsets[i + 1]] for i, p in enumerate(stored)}
+            if all(p in slices for p in paths):
+                return {p: slices[p] for p in paths}
+
+    slices = {p: nonzero_slices(np.load(p, mmap_mode='r'), axis=axis) for p in paths}
+    if index_file is not None:
+        offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(slices[p]) for p in paths])
+        flat = np.concatenate([slices[p] for p in paths]) if paths else np.zeros(0, dtype=np.int64)
+        np.savez(index_file, axis=axis, paths=np.asarray(paths, dtype=str), offsets=offsets, slices=flat)
+    return slices
+
+
+def _build_index_lut(target_index_map, dtype=np.float32):
+    """
+    Builds a 256-entry lookup table that maps 8-bit mask pixel values to class indices.
+    Pixel values that are not present in target_index_map are mapped onto themselves.
+
+    :param target_index_map: dict - pixel value -> class index
+    :param dtype: numpy dtype of the lookup table (and therefore of the remapped mask)
+
+    :return: numpy array of shape (256,) or None if the map can't be expressed as an 8-bit LUT
+    """
+    if not all(0 <= int(k) <= 255 for k in target_index_map.keys()):
+        return None
+    if np.dtype(dtype) == np.uint8 and not all(0 <= int(v) <= 255 for v in target_index_map.values()):
+        raise ValueError('target_index_map values must be in [0, 255] to produce a uint8 mask')
+
+    lut = np.arange(256).astype(dtype)
+    for k, v in target_index_map.items():
+        lut[int(k)] = v
+    return lut
+
+
+def _remap_mask(mask, target_index_map, lut=None, dtype=np.float32):
+    """
+    Replaces pixel values of a mask with class indices in a single pass.
+
+    :param mask: numpy array (typically uint8)
+    :param target_index_map: dict - pixel value -> class index
+    :param lut: precomputed lookup table (see _build_index_lut). Only used for uint8 masks.
+    :param dtype: numpy dtype of the returned mask
+
+    :return: numpy array of the same shape as mask
+    """
+    if lut is not None and mask.dtype == np.uint8:
+        return np.take(lut, mask)
+
+    # masks with more than 8 bits per pixel can't go through the LUT
+    remapped = mask.astype(dtype, copy=True)
+    for k, v in target_index_map.items():
+        remapped[mask == k] = v
+    return remapped
 
 
 def _process_array_argument(x):
@@ -91,6 +211,537 @@ def _process_co_transform_argument(tform, num_inputs, num_targets):
     return tform
 
 
+class SampleBatch(list):
+    """
+    Result of a dataset's batch fetch (__getitems__). It is a list of per-sample views, so torch's DataLoader
+    and its default collate keep working, but it also carries the already assembled batch so that
+    collate_batch can hand it on without stacking the samples again.
+    """
+    def __init__(self, batch, num_samples):
+        super(SampleBatch, self).__init__(_unbind_batch(batch, num_samples))
+        self.batch = batch
+
+
+def collate_batch(samples):
+    """
+    Collate function for loaders over datasets that implement __getitems__ (see SampleBatch)
+    """
+    if isinstance(samples, SampleBatch):
+        return _convert_batch(samples.batch)
+    return default_collate(samples)
+
+
+def _convert_batch(batch):
+    # default_convert, except that object arrays (e.g. a CSV column of paths) become lists of their items,
+    # which is what default_collate returns for such samples
+    if isinstance(batch, np.ndarray) and batch.dtype == np.object_:
+        return batch.tolist()
+    if isinstance(batch, dict):
+        return {k: _convert_batch(v) for k, v in batch.items()}
+    if isinstance(batch, tuple) and hasattr(batch, '_fields'):     # namedtuple
+        return type(batch)(*(_convert_batch(b) for b in batch))
+    if isinstance(batch, (tuple, list)):
+        return type(batch)(_convert_batch(b) for b in batch)
+    return default_convert(batch)
+
+
+def collate_channels_last(samples):
+    """
+    Collate function that returns image batches directly in channels_last (NHWC) memory format, so models running
+    in channels_last (see ModuleTrainer(channels_last=True)) need no layout conversion at their input.
+    Every (C, H, W) tensor field is batched as an (N, C, H, W) tensor with channels_last strides, other fields
+    (labels, (H, W) masks) are collated as usual. Samples that are channels-first views of (H, W, C) data, as returned
+    by ChannelsFirst, are stacked in their original layout without any transpose copy.
+    Supports batches fetched with __getitems__ (see SampleBatch) as well.
+    """
+    if isinstance(samples, SampleBatch):
+        return _to_channels_last(_convert_batch(samples.batch))
+    return _collate_channels_last(samples)
+
+
+def _collate_channels_last(samples):
+    first = samples[0]
+    if isinstance(first, (tuple, list)):
+        return type(first)(_collate_channels_last([s[i] for s in samples]) for i in range(len(first)))
+    if isinstance(first, np.ndarray):
+        samples = [th.from_numpy(s) for s in samples]
+        first = samples[0]
+    if th.is_tensor(first) and first.dim() == 3:
+        if all(s.stride(0) == 1 and s.size(0) > 1 for s in samples):
+            # channels-first views of HWC memory: stack the HWC data, the permuted batch is channels_last for free
+            return th.stack([s.permute(1, 2, 0) for s in samples]).permute(0, 3, 1, 2)
+        return th.stack(samples).contiguous(memory_format=th.channels_last)
+    return default_collate(samples)
+
+
+def _to_channels_last(batch):
+    if isinstance(batch, (tuple, list)):
+        return type(batch)(_to_channels_last(b) for b in batch)
+    if th.is_tensor(batch) and batch.dim() == 4:
+        return batch.contiguous(memory_format=th.channels_last)
+    return batch
+
+
+def _unbind_batch(batch, num_samples):
+    # split an assembled batch back into per-sample views (no copies)
+    if isinstance(batch, dict):
+        fields = {k: _unbind_batch(v, num_samples) for k, v in batch.items()}
+        return [{k: v[i] for k, v in fields.items()} for i in range(num_samples)]
+    if isinstance(batch, (tuple, list)):
+        fields = [_unbind_batch(v, num_samples) for v in batch]
+        return [type(batch)(f[i] for f in fields) for i in range(num_samples)]
+    if th.is_tensor(batch):
+        return list(batch.unbind(0))
+    return list(batch)
+
+
+def _is_batch_transform(tform):
+    """
+    Whether a transform accepts a whole (N, ...) batch (transforms advertise this with a truthy `batch` attribute)
+    """
+    if tform is _pass_through or tform is _multi_arg_pass_through:
+        return True
+    if getattr(tform, 'batch', False) is True:
+        return True
+    transforms = getattr(tform, 'transforms', None)
+    return isinstance(transforms, (tuple, list)) and len(transforms) > 0 and all(_is_batch_transform(t) for t in transforms)
+
+
+class _SampleList(list):
+    """
+    Per-sample transform outputs that cannot be assembled into one batch (different shapes or not arrays/tensors).
+    Datasets then return the samples as a plain list, so a custom collate_fn (e.g. PadCollate) still gets them.
+    """
+
+
+def _stack_samples(samples):
+    first = samples[0]
+    if th.is_tensor(first):
+        if all(th.is_tensor(s) and s.shape == first.shape for s in samples):
+            return th.stack(samples)
+    elif isinstance(first, np.ndarray):
+        if all(isinstance(s, np.ndarray) and s.shape == first.shape for s in samples):
+            return np.stack(samples)
+    return _SampleList(samples)
+
+
+def _is_sample_list(*batches):
+    return any(isinstance(b, _SampleList) for b in batches)
+
+
+def _apply_transform_to_batch(tform, batch):
+    """
+    Apply a transform to every sample of a batch: in one call if the transform supports batches, otherwise sample by sample
+    """
+    if _is_batch_transform(tform):
+        return tform(batch)
+    return _stack_samples([tform(sample) for sample in batch])
+
+
+def _apply_co_transform_to_batch(tform, input_batch, target_batch):
+    if _is_batch_transform(tform):
+        return tform(input_batch, target_batch)
+    pairs = [tform(x, y) for x, y in zip(input_batch, target_batch)]
+    return _stack_samples([p[0] for p in pairs]), _stack_samples([p[1] for p in pairs])
+
+
+def _tile_origins(size, tile_size, overlap=0):
+    """
+    Start offsets of tiles along one axis so that the tiles cover [0, size) with (at least) the given overlap.
+    The last tile is aligned with the end of the axis instead of running past it.
+
+    :param size: int - length of the axis
+    :param tile_size: int - length of a tile
+    :param overlap: int - number of elements shared by neighbouring tiles
+    :return: list of int
+    """
+    stride = tile_size - overlap
+    if stride <= 0:
+        raise ValueError('overlap must be smaller than the tile size')
+    if size <= tile_size:
+        return [0]
+    origins = list(range(0, size - tile_size + 1, stride))
+    if origins[-1] + tile_size < size:
+        origins.append(size - tile_size)
+    return origins
+
+
+def _read_image_size(path):
+    """
+    (height, width) of an image from its header (or the npy header) without decoding the pixels
+    """
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r').shape[:2]
+    with Image.open(path) as image:
+        return image.size[1], image.size[0]
+
+
+def _open_mask(path):
+    """
+    Opens a mask without reading more than needed: .npy files are memory mapped, chunked volumes (.wvol) are
+    read chunk by chunk, other images are decoded with PIL.
+    """
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    if path.endswith('.wvol'):
+        from .ChunkedVolume import ChunkedVolume
+        return ChunkedVolume(path)
+    with Image.open(path) as image:
+        return np.asarray(image)
+
+
+class PadCollate(object):
+    """
+    Collate function for samples of different spatial sizes: every tensor or array with at least two dimensions
+    is padded (at the bottom/right) in its last two dimensions, i.e. channels-first (.., H, W) samples, to the
+    largest height and width within the batch before the samples are stacked.
+    Combine it with BucketBatchSampler so batches hold samples of similar size and little padding is needed.
+    """
+    def __init__(self, pad_value=0, target_pad_value=None, size_divisor=1):
+        """
+        :param pad_value: value used to pad inputs (the first element of every sample)
+        :param target_pad_value: value used to pad all other elements, e.g. an ignore index for masks (default: pad_value)
+        :param size_divisor: pad the height and width up to a multiple of this value (e.g. the total stride of a network)
+        """
+        self.pad_value = pad_value
+        self.target_pad_value = pad_value if target_pad_value is None else target_pad_value
+        self.size_divisor = size_divisor
+
+    def _pad_field(self, field, value):
+        field = [th.as_tensor(x) if isinstance(x, np.ndarray) else x for x in field]
+        if not th.is_tensor(field[0]) or field[0].dim() < 2:
+            return field
+        height = max(x.size(-2) for x in field)
+        width = max(x.size(-1) for x in field)
+        height = int(np.ceil(height / self.size_divisor)) * self.size_divisor
+        width = int(np.ceil(width / self.size_divisor)) * self.size_divisor
+        return [th.nn.functional.pad(x, (0, width - x.size(-1), 0, height - x.size(-2)), value=value)
+                if x.shape[-2:] != (height, width) else x for x in field]
+
+    def __call__(self, samples):
+        if isinstance(samples[0], (tuple, list)):
+            fields = [self._pad_field([s[i] for s in samples], self.pad_value if i == 0 else self.target_pad_value)
+                      for i in range(len(samples[0]))]
+            samples = [type(samples[0])(f[j] for f in fields) for j in range(len(samples))]
+        else:
+            samples = self._pad_field(samples, self.pad_value)
+        return default_collate(samples)
+
+
+def _integral_image(mask):
+    """
+    Summed-area table (of any number of dims) with a leading row/column of zeros, so the sum over mask[y0:y1, x0:x1] is
+    ii[y1, x1] - ii[y0, x1] - ii[y1, x0] + ii[y0, x0] (see _box_sums)
+    """
+    ii = np.zeros(tuple(s + 1 for s in mask.shape), dtype=np.int64)
+    inner = ii[(slice(1, None),) * mask.ndim]
+    inner[...] = mask
+    for axis in range(mask.ndim):
+        np.cumsum(inner, axis=axis, out=inner)
+    return ii
+
+
+def _box_sums(ii, lo, hi):
+    """
+    Sums over many boxes [lo, hi) of the array behind the integral image ii (inclusion-exclusion over the box corners).
+
+    :param ii: integral image (see _integral_image)
+    :param lo: int array (N, ndim) - first index of every box
+    :param hi: int array (N, ndim) - end (exclusive) of every box
+    :return: int64 array (N,)
+    """
+    lo, hi = np.asarray(lo, dtype=np.int64), np.asarray(hi, dtype=np.int64)
+    ndim = lo.shape[1]
+    sums = np.zeros(len(lo), dtype=np.int64)
+    for corner in itertools.product((0, 1), repeat=ndim):
+        index = tuple(hi[:, d] if upper else lo[:, d] for d, upper in enumerate(corner))
+        sign = 1 if (ndim - sum(corner)) % 2 == 0 else -1
+        sums += sign * ii[index]
+    return sums
+
+
+def _downsample_any(mask, factor, ndim=None):
+    """
+    Downsamples a mask by marking every block of factor pixels that holds a non-zero value.
+    The mask is read in bands along the first axis, so memory mapped (or chunked) masks are never fully in memory.
+
+    :param mask: array-like supporting shape and slicing along the first axis (numpy array, np.memmap, ChunkedVolume)
+    :param factor: tuple - block size along each of the first ndim axes
+    :param ndim: number of spatial axes (default: len(factor)). Trailing axes (e.g. channels) are reduced with any.
+    :return: bool array of shape ceil(shape / factor)
+    """
+    ndim = len(factor) if ndim is None else ndim
+    bands = []
+    for start in range(0, mask.shape[0], factor[0]):
+        band = np.asarray(mask[start:start + factor[0]]) != 0
+        if band.ndim > ndim:
+            band = band.reshape(band.shape[:ndim] + (-1,)).any(axis=-1)
+        band = band.any(axis=0)
+        band = np.pad(band, [(0, -s % f) for s, f in zip(band.shape, factor[1:])])
+        blocks = []
+        for s, f in zip(band.shape, factor[1:]):
+            blocks.extend((s // f, f))
+        band = band.reshape(blocks).any(axis=tuple(range(1, len(blocks), 2))) if blocks else band
+        bands.append(band)
+    return np.stack(bands)
+
+
+class SampleQuarantine(object):
+    """
+    Skip list of samples that failed to load (e.g. corrupt or truncated files).
+
+    Entries are appended to a file (one line per sample: path, a tab, and the error) so that DataLoader workers
+    share them while running and the dataset scanner leaves them out on the next start (see FolderDataset).
+    Without a file the skip list only lives in memory of the current process.
+    """
+    def __init__(self, path=None, refresh_interval=10.0):
+        """
+        :param path: string (default: None)\n
+            file that persists the skip list. It is created on the first failure.
+        :param refresh_interval: float (default: 10.0)\n
+            seconds between checks of the file for entries added by other workers. Lookups in between only touch
+            the in-memory set, so healthy samples don't cost a stat call each.
+        """
+        self.path = os.path.expanduser(path) if path is not None else None
+        self.refresh_interval = refresh_interval
+        self._paths = set()
+        self._file_pos = 0
+        self._last_refresh = None
+        self._refresh(force=True)
+
+    def _refresh(self, force=False):
+        # pick up entries appended by other workers since the last read
+        now = time.monotonic()
+        if not force and self._last_refresh is not None and now - self._last_refresh < self.refresh_interval:
+            return
+        self._last_refresh = now
+        if self.path is None or not os.path.exists(self.path) or os.path.getsize(self.path) == self._file_pos:
+            return
+        with open(self.path, 'rb') as qfile:
+            qfile.seek(self._file_pos)
+            for line in qfile:
+                if not line.endswith(b'\n'):      # a line that is still being written
+                    break
+                self._paths.add(os.fsdecode(line.split(b'\t')[0]))
+                self._file_pos += len(line)
+
+    def add(self, path, reason=''):
+        """
+        :param path: string - path of the sample that failed to load
+        :param reason: string - error that was raised (for the record only)
+        """
+        if path in self._paths:
+            return
+        self._paths.add(path)
+        if self.path is not None:
+            # a single small append is atomic, so concurrent workers don't interleave lines
+            with open(self.path, 'ab') as qfile:
+                qfile.write(os.fsencode(path) + b'\t' + ' '.join(str(reason).split()).encode('utf-8') + b'\n')
+
+    def __contains__(self, path):
+        if path not in self._paths:
+            self._refresh()
+        return path in self._paths
+
+    def __len__(self):
+        self._refresh(force=True)
+        return len(self._paths)
+
+    def paths(self):
+        self._refresh(force=True)
+        return set(self._paths)
+
+
+class _StringArray(object):
+    """
+    Immutable array of strings stored as one contiguous uint8 buffer plus int64 offsets.
+
+    Unlike a list of str it holds no per-item python objects, so reading it from a forked DataLoader
+    worker does not touch reference counts and the pages stay shared with the parent (copy-on-write).
+    """
+    def __init__(self, strings=(), buffer=None, offsets=None):
+        if buffer is None:
+            encoded = [os.fsencode(s) for s in strings]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            np.cumsum([len(s) for s in encoded], out=offsets[1:])
+            buffer = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        self.buffer = buffer
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return os.fsdecode(self.buffer[self.offsets[index]:self.offsets[index + 1]].tobytes())
+
+    def select(self, indices):
+        """
+        :param indices: array of positions to keep (in the given order)
+        :return: a new compact _StringArray
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        starts, ends = self.offsets[indices], self.offsets[indices + 1]
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(ends - starts, out=offsets[1:])
+        if len(indices) == 0:
+            return _StringArray(buffer=np.zeros(0, dtype=np.uint8), offsets=offsets)
+        # gather all byte ranges with one fancy index instead of a python loop
+        positions = np.arange(offsets[-1], dtype=np.int64) + np.repeat(starts - offsets[:-1], ends - starts)
+        return _StringArray(buffer=self.buffer[positions], offsets=offsets)
+
+
+def _compact_targets(targets):
+    # integer labels -> int64 array, strings (paths) -> _StringArray, anything else stays an object array
+    if all(isinstance(t, (int, np.integer)) and not isinstance(t, bool) for t in targets):
+        return np.asarray(targets, dtype=np.int64)
+    if all(isinstance(t, str) for t in targets):
+        return _StringArray(targets)
+    array = np.empty(len(targets), dtype=object)
+    array[:] = list(targets)
+    return array
+
+
+class SampleIndex(object):
+    """
+    Compact (input path, target) index used by folder datasets in place of a list of tuples.
+
+    Input paths are kept in a _StringArray, integer labels in an int64 array and target paths in a second
+    _StringArray (or not at all when they are the input paths themselves, as in class_mode='path').
+    This keeps the index a handful of numpy buffers, so per-worker memory stays flat for large datasets.
+    Indexing, slicing, iteration and concatenation (+) return the same (input, target) tuples / lists the list
+    did. The index itself is immutable, use tolist() for a list that can be modified.
+    Optionally the index also holds the (height, width) of every input (see FolderDataset.get_sample_sizes).
+    """
+    def __init__(self, items):
+        """
+        :param items: iterable of (input, target) pairs or another SampleIndex
+        """
+        self.sizes = None
+        if isinstance(items, SampleIndex):
+            self.inputs, self.targets, self.targets_are_inputs = items.inputs, items.targets, items.targets_are_inputs
+            self.sizes = items.sizes
+            return
+        items = list(items)
+        inputs = [item[0] for item in items]
+        targets = [item[1] for item in items]
+        self.inputs = _StringArray(inputs)
+        self.targets_are_inputs = len(items) > 0 and targets == inputs
+        self.targets = None if self.targets_are_inputs else _compact_targets(targets)
+
+    def __len__(self):
+        return len(self.inputs)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('sample index out of range')
+        input_sample = self.inputs[index]
+        if self.targets_are_inputs:
+            return input_sample, input_sample
+        target = self.targets[index]
+        return input_sample, target.item() if isinstance(target, np.generic) else target
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def select(self, indices):
+        """
+        :param indices: positions to keep (in the given order)
+        :return: a new SampleIndex that only contains the selected samples
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        index = SampleIndex.__new__(SampleIndex)
+        index.inputs = self.inputs.select(indices)
+        index.targets_are_inputs = self.targets_are_inputs
+        if self.targets_are_inputs:
+            index.targets = None
+        elif isinstance(self.targets, _StringArray):
+            index.targets = self.targets.select(indices)
+        else:
+            index.targets = self.targets[indices]
+        index.sizes = self.sizes[indices] if getattr(self, 'sizes', None) is not None else None
+        return index
+
+    def tolist(self):
+        return list(self)
+
+    def __add__(self, other):
+        return self.tolist() + list(other)
+
+    def __radd__(self, other):
+        return list(other) + self.tolist()
+
+
+class SampleCache(object):
+    """
+    Per-sample cache for the output of the deterministic part of a dataset's loading pipeline
+    (decoding plus the deterministic prefix of its transforms, see split_deterministic).
+    """
+    def __init__(self, tier='memory', cache_dir=None, max_items=None):
+        """
+        :param tier: string in `{'memory', 'disk'}`\n
+            `memory` = keep samples in a dict of the process that loads them. With DataLoader workers this requires
+            persistent_workers=True, otherwise the cache is discarded together with the workers after every epoch.\n
+            `disk` = store every sample as a torch file in cache_dir. Shared by all workers and kept across runs,
+            so the directory must be cleared (see clear()) whenever the loaders or deterministic transforms change.
+        :param cache_dir: string\n
+            directory for the disk tier
+        :param max_items: int (default: None)\n
+            stop adding samples to the memory tier once it holds this many
+        """
+        if tier not in ('memory', 'disk'):
+            raise ValueError('tier must be one of: {memory, disk}')
+        if tier == 'disk':
+            if cache_dir is None:
+                raise ValueError('cache_dir is required for the disk tier')
+            os.makedirs(os.path.expanduser(cache_dir), exist_ok=True)
+        self.tier = tier
+        self.cache_dir = os.path.expanduser(cache_dir) if cache_dir is not None else None
+        self.max_items = max_items
+        self._items = {}
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.pt')
+
+    def get(self, key, default=None):
+        if self.tier == 'memory':
+            # a copy, like the disk tier returns: transforms that modify their input in place must not alter the cache
+            return copy.deepcopy(self._items[key]) if key in self._items else default
+        path = self._path(key)
+        if not os.path.exists(path):
+            return default
+        try:
+            return th.load(path, weights_only=False)
+        except Exception:       # e.g. a file truncated by a killed run, simply recompute it
+            return default
+
+    def put(self, key, value):
+        if self.tier == 'memory':
+            if self.max_items is None or len(self._items) < self.max_items:
+                self._items[key] = copy.deepcopy(value)     # the caller goes on transforming value
+            return
+        path = self._path(key)
+        tmp_path = '%s.%i.tmp' % (path, os.getpid())
+        th.save(value, tmp_path)
+        os.replace(tmp_path, path)      # atomic, so concurrent workers never read a partial file
+
+    def __contains__(self, key):
+        if self.tier == 'memory':
+            return key in self._items
+        return os.path.exists(self._path(key))
+
+    def clear(self):
+        self._items = {}
+        if self.tier == 'disk':
+            for fname in os.listdir(self.cache_dir):
+                if fname.endswith('.pt'):
+                    os.remove(os.path.join(self.cache_dir, fname))
+
+
 def _return_first_element_of_list(x):
     return x[0]
 
@@ -112,7 +763,7 @@ def _is_image_file(filename):
 
 def _finds_inputs_and_targets(root, class_mode, class_to_idx=None, input_regex='*',
                               rel_target_root='', target_prefix='', target_postfix='', target_extension='png',
-                              splitRatio=1.0, random_seed=None, exclusion_file=None):
+                              splitRatio=1.0, random_seed=None, exclusion_file=None, skip_paths=None):
     """
     Map a dataset from a root folder. Optionally, split the dataset randomly into two partitions (e.g. train and val)
 
@@ -138,6 +789,8 @@ def _finds_inputs_and_targets(root, class_mode, class_to_idx=None, input_regex='
         list of files (one per line) to exclude when enumerating all files\n
         The list must contain paths relative to the root parameter\n
         each line may include the filename and additional comma-separated metadata, in which case the first item will be considered the path itself and the rest will be ignored
+    :param skip_paths: set of strings (default: None)\n
+        full input paths to leave out, e.g. the paths of a SampleQuarantine
 
     :return: partition1 (list of (input, target)), partition2 (list of (input, target))
     """
@@ -179,8 +832,8 @@ def _finds_inputs_and_targets(root, class_mode, class_to_idx=None, input_regex='
                             inputs = vallist_inputs
                             targets = vallist_targets
 
-                        if not os.path.join(subdir,fname) in exclusion_list:        # exclude any undesired files
-                            path = os.path.join(rootz, fname)
+                        path = os.path.join(rootz, fname)
+                        if not os.path.join(subdir,fname) in exclusion_list and not (skip_paths and path in skip_paths):        # exclude any undesired files
                             inputs.append(path)
                             if class_mode == 'path':
                                 targets.append(path)
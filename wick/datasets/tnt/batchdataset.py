@@ -1,6 +1,10 @@
 import math
+
+import torch
+
 from .dataset import Dataset
 from . import transform
+from ..data_utils import SampleBatch
 
 
 class BatchDataset(Dataset):
@@ -55,6 +59,10 @@ class BatchDataset(Dataset):
             batching. If `filter(sample)` is True, then sample is included for
             batching. Otherwise, it is excluded. By default, `filter(sample)`
             returns True for any `sample`.
+        buffers (BatchBufferRing, optional): ring of preallocated batch
+            buffers the default merge writes the samples into, instead of
+            allocating every batch. Returned batches are reused once the ring
+            wraps around. Default is None.
 
     """
 
@@ -64,14 +72,17 @@ class BatchDataset(Dataset):
                  perm=lambda idx, size: idx,
                  merge=None,
                  policy='include-last',
-                 filter=lambda sample: True):
+                 filter=lambda sample: True,
+                 buffers=None):
         super(BatchDataset, self).__init__()
         self.dataset = dataset
         self.perm = perm
         self.batchsize = batchsize
         self.policy = policy
         self.filter = filter
-        self.makebatch = transform.makebatch(merge)
+        self.merge = merge
+        self.buffers = buffers
+        self.makebatch = transform.makebatch(merge, buffers=buffers)
         len(self)
 
     def __len__(self):
@@ -91,17 +102,20 @@ class BatchDataset(Dataset):
         super(BatchDataset, self).__getitem__(idx)
         maxidx = len(self.dataset)
 
-        samples = []
-        for i in range(0, self.batchsize):
-            j = idx * self.batchsize + i
-            if j >= maxidx:
-                break
+        start = idx * self.batchsize
+        indices = [self.perm(j, maxidx) for j in range(start, min(start + self.batchsize, maxidx))]
 
-            j = self.perm(j, maxidx)
-            sample = self.dataset[j]
+        if hasattr(self.dataset, '__getitems__'):
+            # fetch the whole batch from the underlying dataset at once
+            fetched = self.dataset.__getitems__(indices)
+        else:
+            fetched = [self.dataset[j] for j in indices]
+        samples = [sample for sample in fetched if self.filter(sample)]
 
-            if self.filter(sample):
-                samples.append(sample)
+        # the batch assembled by the underlying dataset is exactly what the default merge would build
+        if isinstance(fetched, SampleBatch) and len(samples) == len(fetched) and getattr(self, 'merge', None) is None \
+                and isinstance(fetched.batch, dict) and all(torch.is_tensor(v) for v in fetched.batch.values()):
+            return dict(fetched.batch)
 
         samples = self.makebatch(samples)
         return samples
@@ -1,7 +1,3 @@
-from .batchdataset import BatchDataset
-from .transformdataset import TransformDataset
-from .shuffledataset import ShuffleDataset
-from .multipartitiondataset import MultiPartitionDataset
 from torch.utils.data import DataLoader
 
 
@@ -18,16 +14,21 @@ class Dataset(object):
         pass
 
     def batch(self, *args, **kwargs):
+        # imported here since these datasets subclass Dataset themselves
+        from .batchdataset import BatchDataset
         return BatchDataset(self, *args, **kwargs)
 
     def transform(self, *args, **kwargs):
+        from .transformdataset import TransformDataset
         return TransformDataset(self, *args, **kwargs)
 
     def shuffle(self, *args, **kwargs):
+        from .shuffledataset import ShuffleDataset
         return ShuffleDataset(self, *args, **kwargs)
 
     def parallel(self, *args, **kwargs):
         return DataLoader(self, *args, **kwargs)
 
     def partition(self, *args, **kwargs):
+        from .multipartitiondataset import MultiPartitionDataset
         return MultiPartitionDataset(self, *args, **kwargs)
@@ -1,4 +1,11 @@
+import sys
+
 import torch
+import numpy as np
+from torch.utils.data.dataloader import default_collate
+
+from ..data_utils import _convert_batch
+
 
 def canmergetensor(tbl):
     if not isinstance(tbl, list):
@@ -12,9 +19,123 @@ def canmergetensor(tbl):
         return True
     return False
 
-def mergetensor(tbl):
+def mergetensor(tbl, out=None):
+    """
+    Stack a list of equally sized tensors along a new first dimension.
+
+    Args:
+        tbl (list): tensors to merge.
+        out (Tensor, optional): preallocated tensor of size
+            `[len(tbl)] + tbl[0].size()` to write the samples into (see
+            `BatchBufferRing`). By default a new tensor is allocated.
+    """
     sz = [len(tbl)] + list(tbl[0].size())
-    res = tbl[0].new(torch.Size(sz))
-    for i,v in enumerate(tbl):
-        res[i].copy_(v)
-    return res
+    tbl = [v.view(tbl[0].size()) for v in tbl]
+    if out is None:
+        return torch.stack(tbl)
+    return torch.stack(tbl, out=out.view(sz))
+
+
+class BatchBufferRing(object):
+    """
+    Ring of preallocated batch buffers, keyed by batch shape and dtype.
+
+    Every key owns `size` buffers which are handed out in turn, so steady
+    state batching does not allocate at all. A buffer is reused `size` calls
+    later, unless the batch written into it (or any view of it) is still
+    referenced in this process, e.g. kept for logging: such a buffer is left
+    to its holder and replaced by a new one.
+    Batches that left the process (buffers filled in DataLoader workers) can
+    not be tracked, so for those `size` must exceed the number of batches in
+    flight (`prefetch_factor * num_workers` for a DataLoader) plus the batches
+    the main process keeps.
+
+    Args:
+        size (int, optional): number of buffers per key. Default is 4.
+        pin_memory (bool, optional): allocate page-locked buffers for fast
+            (non_blocking) host to device copies. Only valid in the main
+            process.
+        share_memory (bool, optional): allocate buffers in shared memory so
+            batches built in DataLoader workers are handed to the main process
+            without a copy.
+    """
+
+    def __init__(self, size=4, pin_memory=False, share_memory=False):
+        self.size = size
+        self.pin_memory = pin_memory
+        self.share_memory = share_memory
+        self._buffers = {}
+        self._next = {}
+
+    def _new_buffer(self, shape, dtype):
+        buf = torch.empty(shape, dtype=dtype)
+        if self.share_memory:
+            buf.share_memory_()
+        if self.pin_memory:
+            buf = buf.pin_memory()
+        return buf
+
+    def get(self, shape, dtype=torch.float32):
+        key = (tuple(shape), dtype)
+        ring = self._buffers.setdefault(key, [])
+        if len(ring) < self.size:
+            ring.append(self._new_buffer(key[0], dtype))
+            return ring[-1]
+
+        idx = self._next.get(key, 0)
+        self._next[key] = (idx + 1) % self.size
+        # views keep a reference to their base tensor, so any other reference
+        # than the ring's (and getrefcount's argument) means the batch is still in use
+        if sys.getrefcount(ring[idx]) > 2:
+            ring[idx] = self._new_buffer(key[0], dtype)
+        return ring[idx]
+
+    def clear(self):
+        self._buffers = {}
+        self._next = {}
+
+    def __getstate__(self):
+        # buffers are never shipped to worker processes, each process fills its own ring
+        state = dict(self.__dict__)
+        state['_buffers'] = {}
+        state['_next'] = {}
+        return state
+
+
+class RingCollate(object):
+    """
+    DataLoader `collate_fn` that writes samples straight into buffers taken
+    from a `BatchBufferRing` instead of allocating a new batch every time.
+
+    Tensors and numpy arrays are merged, dicts/lists/tuples are collated field
+    by field and everything else falls back to torch's default collate.
+    Batches already assembled by a dataset's `__getitems__` (SampleBatch) are
+    passed on as they are.
+
+    Args:
+        ring (BatchBufferRing, optional): buffers to use. By default a ring
+            with shared memory buffers is created (suitable for workers).
+    """
+
+    def __init__(self, ring=None):
+        self.ring = ring if ring is not None else BatchBufferRing(share_memory=True)
+
+    def __call__(self, samples):
+        batch = getattr(samples, 'batch', None)
+        if batch is not None:
+            return _convert_batch(batch)
+
+        elem = samples[0]
+        if isinstance(elem, np.ndarray) and elem.dtype != np.object_:
+            samples = [torch.as_tensor(s) for s in samples]
+            elem = samples[0]
+        if torch.is_tensor(elem):
+            if not canmergetensor(samples):
+                return default_collate(samples)
+            out = self.ring.get([len(samples)] + list(elem.size()), elem.dtype)
+            return mergetensor(samples, out=out)
+        if isinstance(elem, dict):
+            return {key: self([s[key] for s in samples]) for key in elem}
+        if isinstance(elem, (tuple, list)) and not isinstance(elem, str):
+            return [self(list(field)) for field in zip(*samples)]
+        return default_collate(samples)
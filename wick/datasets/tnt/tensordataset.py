@@ -2,6 +2,8 @@ from .dataset import Dataset
 import torch
 import numpy as np
 
+from ..data_utils import SampleBatch
+
 
 class TensorDataset(Dataset):
     """
@@ -58,3 +60,29 @@ class TensorDataset(Dataset):
             return [v[idx] for v in self.data]
         elif torch.is_tensor(self.data) or isinstance(self.data, np.ndarray):
             return self.data[idx]
+
+    def __getitems__(self, indices):
+        """
+        Index a whole batch with a single indexing op per field.
+
+        Returns a SampleBatch: a list of samples (as `__getitem__` would return them)
+        that also carries the assembled batch. Data with fields that can't be
+        fancy-indexed (e.g. python lists) is fetched sample by sample.
+        """
+        if _is_array(self.data):
+            return SampleBatch(self.data[_as_index(self.data, indices)], len(indices))
+        elif isinstance(self.data, dict) and all(_is_array(v) for v in self.data.values()):
+            return SampleBatch({k: v[_as_index(v, indices)] for k, v in self.data.items()}, len(indices))
+        elif isinstance(self.data, list) and all(_is_array(v) for v in self.data):
+            return SampleBatch([v[_as_index(v, indices)] for v in self.data], len(indices))
+        return [self[idx] for idx in indices]
+
+
+def _is_array(field):
+    return torch.is_tensor(field) or isinstance(field, np.ndarray)
+
+
+def _as_index(field, indices):
+    if torch.is_tensor(field):
+        return torch.as_tensor(indices, dtype=torch.long)
+    return np.asarray(indices, dtype=np.int64)
@@ -24,7 +24,11 @@ def tablemergekeys():
                     if not key in mergetbl:
                         mergetbl[key] = {}
                     mergetbl[key][idx] = value
-        elif isinstance(tbl, list):
+        elif isinstance(tbl, list) and len(tbl) > 0:
+            keys = tbl[0].keys()
+            if all(elem.keys() == keys for elem in tbl):
+                # samples share their keys, so the merged table is built in a single pass per key
+                return {key: [elem[key] for elem in tbl] for key in keys}
             for elem in tbl:
                 for key, value in elem.items():
                     if not key in mergetbl:
@@ -37,9 +41,17 @@ tableapply = lambda f: lambda d: dict(
     map(lambda kv: (kv[0], f(kv[1])), iteritems(d)))
 
 
-def makebatch(merge=None):
+def makebatch(merge=None, buffers=None):
     if merge:
         makebatch = compose([tablemergekeys(), merge])
+    elif buffers is not None:
+        # write the samples of every field straight into a preallocated batch buffer
+        def mergefield(field):
+            if not canmerge(field):
+                return field
+            out = buffers.get([len(field)] + list(field[0].size()), field[0].dtype)
+            return mergetensor(field, out=out)
+        makebatch = compose([tablemergekeys(), tableapply(mergefield)])
     else:
         makebatch = compose([
             tablemergekeys(),
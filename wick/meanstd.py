@@ -1,40 +1,94 @@
 import numpy as np
+from torch.utils.data import DataLoader, Dataset, Subset
 from tqdm import tqdm
 
-def get_dataset_mean_std(dataset, img_size=256, output_div=255.0):
+
+class _ImageMoments(Dataset):
+    '''
+    Wraps a dataset of (PIL image, target) items and returns per-image channel moments instead of the images,
+    so the (expensive) decoding and resizing happens inside the DataLoader workers.
+    '''
+
+    def __init__(self, dataset, img_size=None):
+        self.dataset = dataset
+        self.img_size = img_size
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        src = self.dataset[index][0]
+        if self.img_size is not None:
+            src = src.resize((self.img_size, self.img_size))      # resize to same size
+        src = np.asarray(src, dtype=np.float64)
+        src = src.reshape(-1, src.shape[-1] if src.ndim == 3 else 1)
+
+        if src.shape[0] == 0:       # empty image: contributes nothing to the moments
+            return np.float64(0), np.zeros(src.shape[1]), np.zeros(src.shape[1])
+        mean = src.mean(0)
+        m2 = np.square(src - mean).sum(0)       # sum of squared deviations from the mean
+        return np.float64(src.shape[0]), mean, m2
+
+
+def _merge_moments(count_a, mean_a, m2_a, count_b, mean_b, m2_b):
+    '''
+    Chan et al. parallel update of (count, mean, M2) for two disjoint sets of samples
+    '''
+    count = count_a + count_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (count_b / count)
+    m2 = m2_a + m2_b + np.square(delta) * (count_a * count_b / count)
+    return count, mean, m2
+
+
+def get_dataset_mean_std(dataset, img_size=256, output_div=255.0, batch_size=32, num_workers=0, subsample=None, random_seed=None):
     '''
-    Computes channel-wise mean and std of the dataset. The process is memory-intensive as the entire dataset must fit into memory.
-    Therefore, each image is scaled down to img_size first (default: 256).
+    Computes channel-wise mean and std of the dataset in a single streaming pass with bounded memory.
+    Per-image moments are computed in DataLoader workers and reduced with a numerically stable
+    parallel (Welford/Chan) update, so only a handful of values per channel are ever kept in memory.
 
     Assumptions: 1. dataset uses PIL to read images    2. Images are in RGB format.
 
     :param dataset: pytorch Dataset
-    :param img_size: scale of images at which to compute mean/std (default: 256)
+    :param img_size: scale of images at which to compute mean/std (default: 256). If None, images are used at their original size.
     :param output_div: float {1.0, 255.0} - Image values are naturally in 0-255 value range so the returned output is divided by output_div.
         For example, if output_div = 255.0 then mean/std will be in 0-1 range.
+    :param batch_size: int - number of images reduced per step
+    :param num_workers: int - number of DataLoader worker processes used to load images
+    :param subsample: int or float (default: None)\n
+        if an int, compute the statistics on this many randomly selected images.\n
+        if a float in (0, 1], compute them on this fraction of the dataset.
+    :param random_seed: int (default: None) - seed for the subsample selection
     :return: (mean, std) as per-channel values ([r,g,b], [r,g,b])
     '''
+    if len(dataset) == 0:
+        raise ValueError('Cannot compute mean/std of an empty dataset')
+    if subsample is not None:
+        num_items = int(round(subsample * len(dataset))) if isinstance(subsample, float) else int(subsample)
+        num_items = max(1, min(num_items, len(dataset)))
+        indices = np.random.RandomState(random_seed).choice(len(dataset), num_items, replace=False)
+        dataset = Subset(dataset, np.sort(indices).tolist())
 
-    total = np.zeros((3, (len(dataset)*img_size*img_size)), dtype=int)
-    position = 0        # keep track of position in the total array
-
-    for src, _ in tqdm(dataset, ascii=True, desc="Process", unit='images'):
-        src = src.resize((img_size, img_size))      # resize to same size
-        src = np.array(src)
-
-        # reshape into correct shape
-        src = src.reshape(img_size * img_size, 3)
-        src = src.swapaxes(1,0)
-
-        # np.concatenate((a, b, c), axis=1)  # NOPE NOPE NOPE -- makes a memory re-allocation for every concatenate operation
+    loader = DataLoader(_ImageMoments(dataset, img_size), batch_size=batch_size, shuffle=False, num_workers=num_workers)
 
-        # -- In-place value substitution -- #
-        place = img_size * img_size * position
-        total[0:src.shape[0], place:place+src.shape[1]] = src   # copies the src data into the total position at specified index
+    count, mean, m2 = 0., 0., 0.
+    with tqdm(total=len(dataset), ascii=True, desc="Process", unit='images') as pbar:
+        for counts, means, m2s in loader:
+            counts, means, m2s = counts.numpy(), means.numpy(), m2s.numpy()
 
-        position = position+1
+            # reduce the batch first (vectorized), then merge it into the running moments
+            batch_count = counts.sum()
+            if batch_count == 0:        # only empty images in this batch
+                pbar.update(len(counts))
+                continue
+            batch_mean = (means * counts[:, None]).sum(0) / batch_count
+            batch_m2 = m2s.sum(0) + (np.square(means - batch_mean) * counts[:, None]).sum(0)
+            count, mean, m2 = _merge_moments(count, mean, m2, batch_count, batch_mean, batch_m2)
+            pbar.update(len(counts))
 
-    return total.mean(1) / output_div, total.std(1) / output_div        # return channel-wise mean for the entire dataset
+    if count == 0:
+        raise ValueError('Cannot compute mean/std: the dataset holds no pixels (all %i images are empty)' % len(dataset))
+    return mean / output_div, np.sqrt(m2 / count) / output_div        # return channel-wise mean for the entire dataset
 
 
 if __name__ == "__main__":
@@ -1,5 +1,8 @@
 
 import datetime
+import itertools
+import os
+import tempfile
 import warnings
 
 try:
@@ -7,11 +10,16 @@ try:
 except:
     warnings.warn('inspect.signature not available... you should upgrade to Python 3.x')
 
+import numpy as np
+import torch as th
 import torch.nn.functional as F
 import torch.optim as optim
+from torch.utils.data import DataLoader
+from torch.utils.data.dataloader import default_collate
 
 from ..metrics import Metric, CategoricalAccuracy, BinaryAccuracy
 from ..initializers import GeneralInitializer
+from ..datasets.data_utils import collate_batch, _tile_origins
 
 def _add_regularizer_to_loss_fn(loss_fn,
                                 regularizer_container):
@@ -20,12 +28,261 @@ def _add_regularizer_to_loss_fn(loss_fn,
     return new_loss_fn
 
 
-def _parse_num_inputs_and_targets_from_loader(loader):
-    """ NOT IMPLEMENTED """
-    #batch = next(iter(loader))
-    num_inputs = loader.dataset.num_inputs
-    num_targets = loader.dataset.num_targets
-    return num_inputs, num_targets
+def _identity(x):
+    return x
+
+def _multi_identity(*x):
+    return x
+
+def _tile_blend_weights(tile_size, blend='gaussian', sigma_scale=0.125, device=None):
+    """
+    Weight map used to blend overlapping tile predictions, so the seams between tiles (where the
+    network sees the least context) contribute least.
+
+    :param tile_size: tuple of ints - spatial size of a tile
+    :param blend: string in `{'gaussian', 'linear', 'constant'}`
+    :param sigma_scale: float - std of the gaussian relative to the tile size
+    :return: float tensor of size tile_size
+    """
+    weights = []
+    for size in tile_size:
+        coords = th.arange(size, dtype=th.float32, device=device) + 0.5
+        if blend == 'gaussian':
+            w = th.exp(-0.5 * ((coords - size / 2.) / (sigma_scale * size)) ** 2)
+        elif blend == 'linear':
+            w = 1. - (2. * coords / size - 1.).abs()
+        elif blend == 'constant':
+            w = th.ones(size, device=device)
+        else:
+            raise ValueError('blend must be one of: {gaussian, linear, constant}')
+        weights.append(w)
+
+    weight = weights[0]
+    for w in weights[1:]:
+        weight = weight.unsqueeze(-1) * w       # separable: outer product over all spatial dims
+    weight = weight / weight.max()
+    # keep the borders strictly positive so pixels covered by a single tile are still defined
+    return weight.clamp_(min=1e-3)
+
+
+def _tile_slices(spatial_size, tile_size, overlap):
+    """
+    Slices (one per spatial dim) of all tiles needed to cover spatial_size
+    """
+    origins = [_tile_origins(size, tile, ov) for size, tile, ov in zip(spatial_size, tile_size, overlap)]
+    for origin in itertools.product(*origins):
+        yield tuple(slice(o, o + t) for o, t in zip(origin, tile_size))
+
+
+def _batch_fetch_loader(loader):
+    """
+    Returns a loader that hands the batches assembled by the dataset's `__getitems__` (see datasets.data_utils.SampleBatch)
+    straight to the trainer instead of collating them again sample by sample.
+    Anything that is not a DataLoader (generators, cached batches, ...), loaders without a batch sampler, with a custom
+    collate_fn or over datasets without `__getitems__` are returned as they are.
+    """
+    if not isinstance(loader, DataLoader) or not hasattr(loader.dataset, '__getitems__') or loader.batch_sampler is None \
+            or loader.collate_fn is not default_collate:
+        return loader
+    # forward every constructor option of the user's loader (seeding, worker setup, pinning, ...), only the collate
+    # changes. batch_size/shuffle/sampler/drop_last are already part of the batch sampler
+    kwargs = {name: getattr(loader, name) for name in signature(DataLoader.__init__).parameters
+              if name not in ('self', 'batch_size', 'shuffle', 'sampler', 'drop_last', 'collate_fn') and hasattr(loader, name)}
+    return DataLoader(collate_fn=collate_batch, **kwargs)
+
+class _LoaderStream(object):
+    """
+    Iterator over the batches of a loader that is kept alive across epochs (so worker processes of
+    streaming loaders aren't torn down and restarted every epoch). A new pass over the loader is only
+    started once the previous one raised StopIteration. Batches can be peeked at without being lost.
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+        self._iter = None
+        self._peeked = []
+
+    def peek(self):
+        if not self._peeked:
+            self._peeked.append(next(self))
+        return self._peeked[0]
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._peeked:
+            return self._peeked.pop()
+        if self._iter is None:
+            self._iter = iter(self.loader)
+        try:
+            return next(self._iter)
+        except StopIteration:
+            self._iter = None
+            raise
+
+
+def _map_tensors(batch, fn):
+    # applies fn to every tensor of a (nested) batch, other leaves are kept as they are
+    if th.is_tensor(batch):
+        return fn(batch)
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(_map_tensors(b, fn) for b in batch)
+    if isinstance(batch, dict):
+        return {k: _map_tensors(v, fn) for k, v in batch.items()}
+    return batch
+
+
+def _batch_nbytes(batch):
+    sizes = []
+    _map_tensors(batch, lambda t: sizes.append(t.numel() * t.element_size()))
+    return sum(sizes)
+
+
+class _DiskTensor(object):
+    # placeholder for a tensor of the disk cache until the file is mapped
+    def __init__(self, index):
+        self.index = index
+
+
+class _CachedBatches(object):
+    """
+    The batches of one pass over a loader, materialized once so that later passes skip reading, decoding and
+    transforming the samples (see ModuleTrainer.cache_loader). Batches are cached as the loader returns them,
+    i.e. before move_to_device and input normalization, so uint8 batches stay compact.
+
+    mode:
+        'device' - on the training device
+        'pinned' - in pinned host memory (plain host memory without CUDA), fast non-blocking copies to the device
+        'disk'   - in a memory mapped file in cache_dir, paged in by the OS on every pass
+        'auto'   - 'device' if the pass fits into max_device_bytes, else 'disk' if a cache_dir is given, else 'pinned'
+    """
+    modes = ('auto', 'device', 'pinned', 'disk')
+
+    def __init__(self, loader, mode='auto', device='cpu', cache_dir=None, max_device_bytes=None, steps=None):
+        if mode not in self.modes:
+            raise ValueError('mode must be one of: {%s}' % ', '.join(self.modes))
+        if mode == 'disk' and cache_dir is None:
+            raise ValueError('disk caching needs a cache_dir')
+        source = loader.loader if isinstance(loader, _LoaderStream) else loader
+        self.dataset = getattr(source, 'dataset', None)
+        self.batch_size = getattr(source, 'batch_size', None)
+        stream = loader if isinstance(loader, _LoaderStream) else _LoaderStream(_batch_fetch_loader(loader))
+        num_batches = _num_batches_from_loader(source, steps)
+
+        self.batches = []
+        self._pending = []     # (offset, dtype, shape) of tensors written to the disk cache
+        self._file = None
+        for batch_idx in (range(num_batches) if num_batches is not None else itertools.count()):
+            try:
+                batch = next(stream)
+            except StopIteration:
+                break
+            if batch_idx == 0 and mode == 'auto':
+                mode = self._choose_mode(_batch_nbytes(batch) * (num_batches or 1), device, cache_dir, max_device_bytes,
+                                         known_length=num_batches is not None)
+            self.batches.append(self._store(batch, mode, device, cache_dir))
+        self.mode = mode
+        if self._file is not None:
+            self._map_disk_cache()
+
+    @staticmethod
+    def _choose_mode(nbytes, device, cache_dir, max_device_bytes, known_length):
+        if str(device).startswith('cuda'):
+            if max_device_bytes is None:
+                free, _ = th.cuda.mem_get_info(th.device(device))
+                max_device_bytes = free // 2      # leave room for activations
+            if known_length and nbytes <= max_device_bytes:
+                return 'device'
+        elif cache_dir is None:
+            return 'device'     # the device is the host
+        return 'disk' if cache_dir is not None else 'pinned'
+
+    def _store(self, batch, mode, device, cache_dir):
+        # always copy: loaders may hand out reused buffers (e.g. RingCollate), which would overwrite cached batches
+        if mode == 'device':
+            return _map_tensors(batch, lambda t: t.to(device, copy=True))
+        if mode == 'pinned':
+            return _map_tensors(batch, lambda t: t.pin_memory() if th.cuda.is_available() else t.clone())
+        if self._file is None:
+            self._file = tempfile.NamedTemporaryFile(dir=cache_dir, prefix='val_batches_', suffix='.bin', delete=False)
+
+        def write(t):
+            offset = -self._file.tell() % 64 + self._file.tell()        # keep every tensor 64-byte aligned
+            self._file.seek(offset)
+            array = t.detach().cpu().contiguous().numpy()
+            self._file.write(array.tobytes())
+            self._pending.append((offset, array.dtype, array.shape))
+            return _DiskTensor(len(self._pending) - 1)
+        return _map_tensors(batch, write)
+
+    def _map_disk_cache(self):
+        path = self._file.name
+        size = self._file.tell()
+        self._file.close()
+        # copy-on-write mapping: the tensors are writable (torch needs that) but the file never changes
+        mapped = np.memmap(path, mode='c', dtype=np.uint8, shape=(size,)) if size > 0 else None
+        views = [th.from_numpy(np.ndarray(shape, dtype=dtype, buffer=mapped, offset=offset) if mapped is not None
+                               else np.zeros(shape, dtype=dtype))
+                 for offset, dtype, shape in self._pending]
+        try:
+            os.remove(path)     # the mapping keeps the data alive, nothing is left behind on disk
+        except OSError:
+            pass
+        self.batches = [self._resolve(batch, views) for batch in self.batches]
+        self._pending, self._file = [], None
+
+    def _resolve(self, batch, views):
+        if isinstance(batch, _DiskTensor):
+            return views[batch.index]
+        if isinstance(batch, (list, tuple)):
+            return type(batch)(self._resolve(b, views) for b in batch)
+        if isinstance(batch, dict):
+            return {k: self._resolve(v, views) for k, v in batch.items()}
+        return batch
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def _num_batches_from_loader(loader, steps=None):
+    """
+    Number of batches to run per epoch: `steps` if given, else the length of the loader
+    (None for loaders of unknown length, e.g. over an IterableDataset)
+    """
+    if steps is not None:
+        return steps
+    try:
+        return len(loader)
+    except TypeError:
+        return None
+
+
+def _parse_num_inputs_and_targets_from_batch(batch):
+    """
+    Infer the input/target arity from a batch as produced by a loader: (inputs, targets) or just inputs
+    """
+    if isinstance(batch, (list, tuple)) and len(batch) == 2:
+        return _parse_num_inputs_and_targets(batch[0], batch[1])
+    return _parse_num_inputs_and_targets(batch)
+
+
+def _parse_num_inputs_and_targets_from_loader(loader, stream=None):
+    """
+    Input/target arity of a loader. Read from the dataset if it declares it (num_inputs/num_targets),
+    otherwise inferred from the first batch, peeked from `stream` so it isn't lost for training.
+    """
+    dataset = getattr(loader, 'dataset', None)
+    num_inputs = getattr(dataset, 'num_inputs', None)
+    num_targets = getattr(dataset, 'num_targets', None)
+    if num_inputs is not None and num_targets is not None:
+        return num_inputs, num_targets
+    if stream is None:
+        stream = _LoaderStream(loader)
+    return _parse_num_inputs_and_targets_from_batch(stream.peek())
 
 def _parse_num_inputs_and_targets(inputs, targets=None):
     if isinstance(inputs, (list, tuple)):
@@ -3,6 +3,7 @@ ModuleTrainer for high level training on Pytorch models
 """
 
 import functools
+import itertools
 import math
 from collections import OrderedDict
 
@@ -14,7 +15,8 @@ import torch.backends.cudnn as cudnn
 from ._utils import (_validate_loss_input, _validate_metric_input,
                      _validate_optimizer_input, _validate_initializer_input,
                      _parse_num_inputs_and_targets, _parse_num_inputs_and_targets_from_loader,
-                     _add_regularizer_to_loss_fn)
+                     _add_regularizer_to_loss_fn, _identity, _multi_identity, _batch_fetch_loader,
+                     _LoaderStream, _CachedBatches, _num_batches_from_loader, _tile_blend_weights, _tile_slices)
 
 from ..conditions import ConditionsContainer, CondType
 from ..callbacks import CallbackContainer, History, TQDM
@@ -29,7 +31,7 @@ from tqdm import tqdm
 
 class ModuleTrainer(object):
 
-    def __init__(self, model, cuda_devices=[]):
+    def __init__(self, model, cuda_devices=[], channels_last=False):
         """
         ModelTrainer for high-level training of Pytorch models
 
@@ -46,10 +48,17 @@ class ModuleTrainer(object):
         - constraints
         - metrics
         - callbacks
+
+        :param model: torch.nn.Module
+        :param cuda_devices: list of cuda device indices (empty list: cpu)
+        :param channels_last: bool - run the model in channels_last (NHWC) memory format. 4D input batches are converted
+            on the device right before the forward pass, after the batch transforms (which may return NCHW batches),
+            unless they already come in that layout (see data_utils.collate_channels_last)
         """
         if not isinstance(model, nn.Module):
             raise ValueError('model argument must inherit from torch.nn.Module')
         self.model = model
+        self.channels_last = channels_last
         self.device = "cuda:" + str(cuda_devices[0]) if cuda_devices else "cpu"     # Empty lists in python are False
 
         # custom loss weights
@@ -87,6 +96,7 @@ class ModuleTrainer(object):
         # transforms
         self._transforms = []
         self._has_transforms = False
+        self._input_normalization = None
 
         # losses
         self._criterion = None
@@ -103,6 +113,8 @@ class ModuleTrainer(object):
                 self.model = th.nn.DataParallel(self.model, device_ids=cuda_devices)
         # TODO: This might not be correct. If things break, check here (below line used to be part of the 'if' block above)
         self.model = self.model.to(self.device)
+        if channels_last:
+            self.model = self.model.to(memory_format=th.channels_last)
 
     def set_criterion(self, criterion):
         self._criterion = criterion
@@ -160,19 +172,57 @@ class ModuleTrainer(object):
         self._has_postconditions = True
 
     def set_transforms(self, transforms):
+        '''
+        Transforms applied to every training batch AFTER it has been moved to the training device
+        (e.g. the batched augmentations in wick.transforms.batch_transforms).
+
+        :param transforms: a transform or a tuple of (input_transform, target_transform, co_transform).\n
+            The co_transform is called as co_transform(input_batch, *target_batch) so that inputs and targets
+            receive the same (geometric) transform. Any of the entries may be None.
+        '''
         if not is_tuple_or_list(transforms):
-            transforms = (transforms, lambda x: x, lambda x,y: (x,y))
-        if len(transforms) == 1:
-            transforms = (transforms, lambda x: x, lambda x,y: (x,y))
-        elif len(transforms) == 2:
-            transforms = (transforms, transforms, lambda x,y: (x,y))
+            transforms = (transforms,)
+        transforms = tuple(transforms) + (None,) * (3 - len(transforms))
 
         self._has_input_transform = transforms[0] is not None
         self._has_target_transform = transforms[1] is not None
         self._has_co_transform = transforms[2] is not None
 
         self._has_transforms = True
-        self._transforms = transforms
+        self._transforms = (transforms[0] if transforms[0] is not None else _identity,
+                            transforms[1] if transforms[1] is not None else _identity,
+                            transforms[2] if transforms[2] is not None else _multi_identity)
+
+    def set_input_normalization(self, normalization):
+        '''
+        Applied to every input batch on the device, in training as well as in evaluation and prediction.
+        Together with loaders that return uint8 tensors (see ImageToByteTensor) this keeps worker IPC and
+        host-to-device copies 4x smaller than float32 batches.
+        Note that it runs after the transforms of set_transforms, so batch augmentations (e.g. RandomBatchColor)
+        see the data in its original range, not normalized data.
+
+        :param normalization: a transform (typically wick.transforms.DeviceNormalize), the path of a stats JSON
+            file written by data_stats.create_dataset_stats, or None to turn it off
+        '''
+        if isinstance(normalization, str):
+            from ..transforms.batch_transforms import DeviceNormalize
+            normalization = DeviceNormalize.from_stats(normalization)
+        self._input_normalization = normalization
+
+    def _prepare_input(self, input_):
+        normalization = getattr(self, '_input_normalization', None)
+        if normalization is not None:
+            input_ = normalization(input_)
+        # the layout conversion comes last, so nothing after it hands the model an NCHW batch again
+        if getattr(self, 'channels_last', False) and input_.dim() == 4:
+            input_ = input_.contiguous(memory_format=th.channels_last)     # no-op for batches that already are
+        return input_
+
+    def _prepare_inputs(self, input_batch):
+        # last stage on the device before the forward pass: normalization and memory format
+        if is_tuple_or_list(input_batch):
+            return [self._prepare_input(input_) for input_ in input_batch]
+        return self._prepare_input(input_batch)
 
     def compile(self,
                 optimizer,
@@ -186,7 +236,8 @@ class ModuleTrainer(object):
                 initializers=None,
                 constraints=None,
                 metrics=None,
-                transforms=None):
+                transforms=None,
+                input_normalization=None):
         '''
         :param optimizer: the optimizer to use for learning
         :param criterion: the criterion to use for calculating loss
@@ -199,7 +250,8 @@ class ModuleTrainer(object):
         :param initializers: (type: list) Initializers to use when calling the fit* functions
         :param constraints: (type: list) Constraints to use when calling the fit* functions
         :param metrics: (type: list) Metrics to use when calling the fit* functions
-        :param transforms: (type: list) Unused at the moment
+        :param transforms: (type: list) (input, target, co) transforms applied on-device to each training batch (see set_transforms)
+        :param input_normalization: on-device conversion/normalization applied to every input batch (see set_input_normalization)
 
         :return:
         '''
@@ -254,6 +306,9 @@ class ModuleTrainer(object):
         else:
             self._has_transforms = False
 
+        if input_normalization is not None:
+            self.set_input_normalization(input_normalization)
+
     def fit(self,
             inputs,
             targets=None,
@@ -333,6 +388,7 @@ class ModuleTrainer(object):
                         input_batch, target_batch = fit_helper.move_to_device(self.device, input_batch, target_batch)
                         if self._has_transforms:
                             input_batch, target_batch = fit_helper.apply_transforms(self._transforms, input_batch, target_batch)
+                        input_batch = self._prepare_inputs(input_batch)
 
                         # ---------------------------------------------
                         self._optimizer.zero_grad()
@@ -378,24 +434,49 @@ class ModuleTrainer(object):
                    initial_epoch=0,
                    num_epoch=100,
                    fit_helper_name = None,
-                   verbose=1):
+                   verbose=1,
+                   steps_per_epoch=None,
+                   validation_steps=None,
+                   cache_validation=None,
+                   validation_cache_dir=None):
         """
-        Fit a model on in-memory tensors using ModuleTrainer
+        Fit a model on data provided by a loader using ModuleTrainer
+
+        :param loader: DataLoader (or any iterable of batches) providing training batches.
+            Loaders of unknown length (e.g. over an IterableDataset) are supported as well
+        :param val_loader: DataLoader providing validation batches (optional)
+        :param steps_per_epoch: number of batches per epoch. If None, an epoch is one pass over the loader.
+            When given, the loader is iterated continuously (and restarted once exhausted), which allows infinite loaders
+        :param validation_steps: number of validation batches per epoch (default: one pass over val_loader)
+        :param cache_validation: None/False, True (= 'auto') or one of {'auto', 'device', 'pinned', 'disk'}.
+            The validation batches are materialized during the first validation and reused in later epochs instead of
+            being read, decoded and transformed again (see cache_loader). Only use it with deterministic validation
+            transforms. With validation_steps, every epoch then evaluates the same batches
+        :param validation_cache_dir: directory of the 'disk' validation cache ('auto' uses it when the batches don't fit on the device)
+
+        The loader's iterator (and thus its worker processes) is kept across epochs.
+        The number of inputs/targets is taken from the dataset if it declares it (num_inputs/num_targets)
+        and otherwise inferred from the first batch.
         """
         self.model.train(mode=True)
         # ----------------------------------------------------------------------
-        num_inputs = loader.dataset.num_inputs
-        num_targets = loader.dataset.num_targets
-        len_inputs = len(loader.sampler) if loader.sampler else len(loader.dataset)
-        batch_size = loader.batch_size
+        # datasets that can fetch whole batches (__getitems__) skip the per-sample collate step
+        train_stream = _LoaderStream(_batch_fetch_loader(loader))
+        num_inputs, num_targets = _parse_num_inputs_and_targets_from_loader(loader, train_stream)
+        batch_size = getattr(loader, 'batch_size', None)
+        if batch_size is None:
+            # plain iterables of batches (or batch samplers): the first batch tells the size used to average the logs
+            input_batch = train_stream.peek()
+            input_batch = input_batch[0] if is_tuple_or_list(input_batch) else input_batch
+            batch_size = len(input_batch[0] if is_tuple_or_list(input_batch) else input_batch)
 
         if val_loader is not None:
-            num_val_inputs = val_loader.dataset.num_inputs
-            num_val_targets = val_loader.dataset.num_targets
+            val_stream = _LoaderStream(_batch_fetch_loader(val_loader))
+            num_val_inputs, num_val_targets = _parse_num_inputs_and_targets_from_loader(val_loader, val_stream)
             if (num_inputs != num_val_inputs) or (num_targets != num_val_targets):
                 raise ValueError('num_inputs != num_val_inputs or num_targets != num_val_targets')
         has_val_data = val_loader is not None
-        num_batches = int(math.ceil(len_inputs / batch_size))
+        num_batches = _num_batches_from_loader(loader, steps_per_epoch)
         # ----------------------------------------------------------------------
 
         fit_helper = _get_helper(self, num_inputs, num_targets, helper_name=fit_helper_name)
@@ -417,7 +498,7 @@ class ModuleTrainer(object):
 
             callback_container = CallbackContainer(self._callbacks+tmp_callbacks)
             callback_container.set_trainer(self)
-            callback_container.on_train_begin({'batch_size': loader.batch_size,
+            callback_container.on_train_begin({'batch_size': batch_size,
                                                'num_batches': num_batches,
                                                'num_epoch': num_epoch,
                                                'has_val_data': has_val_data,
@@ -428,19 +509,24 @@ class ModuleTrainer(object):
                 for epoch_idx in range(initial_epoch, num_epoch):
                     epoch_logs = {}
                     callback_container.on_epoch_begin(epoch_idx, epoch_logs)
-                    loader_iter = iter(loader)
-                    for batch_idx in range(num_batches):
+                    for batch_idx in (range(num_batches) if num_batches is not None else itertools.count()):
                         # if batch_idx == 5000 or batch_idx == 10000:
                         #     pdb.set_trace()
+                        try:
+                            input_batch, target_batch = _grab_batch(fit_helper, train_stream, num_batches)
+                        except StopIteration:
+                            break       # end of a pass over a loader of unknown length
+
                         batch_logs = {}
                         callback_container.on_batch_begin(batch_idx, batch_logs)
 
-                        input_batch, target_batch = fit_helper.grab_batch_from_loader(loader_iter)
-
                         if self._has_preconditions:
                             precond_logs = self._conditions_container(CondType.PRE, epoch_num=epoch_idx, batch_num=batch_idx, net=self.model, input_batch=input_batch, target_batch=target_batch)
                             batch_logs.update(precond_logs)
                         input_batch, target_batch = fit_helper.move_to_device(self.device, input_batch, target_batch)
+                        if self._has_transforms:
+                            input_batch, target_batch = fit_helper.apply_transforms(self._transforms, input_batch, target_batch)
+                        input_batch = self._prepare_inputs(input_batch)
 
                         # ---------------------------------------------
                         self._optimizer.zero_grad()
@@ -464,7 +550,10 @@ class ModuleTrainer(object):
 
                     epoch_logs.update(self.history.batch_metrics)
                     if has_val_data:
-                        val_epoch_logs = self.evaluate_loader(val_loader, verbose=verbose)
+                        if cache_validation and not isinstance(val_stream, _CachedBatches):
+                            val_stream = self.cache_loader(val_stream, mode='auto' if cache_validation is True else cache_validation,
+                                                           cache_dir=validation_cache_dir, steps=validation_steps)
+                        val_epoch_logs = self.evaluate_loader(val_stream, verbose=verbose, steps=validation_steps)
                         self._in_train_loop = False
                         #self.history.batch_metrics.update(val_epoch_logs)
                         #epoch_logs.update(val_epoch_logs)
@@ -501,7 +590,8 @@ class ModuleTrainer(object):
         with th.no_grad():          # locally disable grad calculations for forward-pass only
             for batch_idx in range(num_batches):
                 input_batch, _ = predict_helper.grab_batch(batch_idx, batch_size, inputs, None)
-                inputs = predict_helper.move_to_device(self.device, inputs)
+                input_batch, _ = predict_helper.move_to_device(self.device, input_batch)
+                input_batch = self._prepare_inputs(input_batch)
                 output_batch = pred_forward_fn(input_batch)
 
                 if batch_idx == 0:
@@ -524,23 +614,25 @@ class ModuleTrainer(object):
                        verbose=1):
         self.model.train(mode=False)
         # --------------------------------------------------------
-        num_inputs, num_targets = _parse_num_inputs_and_targets_from_loader(loader)
-        batch_size = loader.batch_size
-        len_inputs = len(loader.sampler) if loader.sampler else len(loader.dataset)
-        num_batches = int(math.ceil(len_inputs / batch_size))
+        stream = _LoaderStream(loader)
+        num_inputs, num_targets = _parse_num_inputs_and_targets_from_loader(loader, stream)
+        num_batches = _num_batches_from_loader(loader)     # None for loaders of unknown length
         # --------------------------------------------------------
 
         predict_helper = _get_helper(self, num_inputs, num_targets=0, helper_name=pred_helper_name)
         pred_forward_fn = predict_helper.get_partial_forward_fn(self.model)
 
-        loader_iter = iter(loader)
-
-        _range = tqdm(range(num_batches)) if verbose > 0 else range(num_batches)
+        _range = range(num_batches) if num_batches is not None else itertools.count()
+        _range = tqdm(_range, total=num_batches) if verbose > 0 else _range
 
         with th.no_grad():  # locally disable grad calculations for forward-pass only
             for batch_idx in _range:
-                input_batch, _ = predict_helper.grab_batch_from_loader(loader_iter)
+                try:
+                    input_batch, _ = predict_helper.grab_batch_from_loader(stream)
+                except StopIteration:
+                    break
                 input_batch, _ = predict_helper.move_to_device(self.device, input_batch)
+                input_batch = self._prepare_inputs(input_batch)
 
                 output_batch = pred_forward_fn(input_batch)
 
@@ -558,6 +650,88 @@ class ModuleTrainer(object):
         self.model.train(mode=True)
         return final_pred_list if len_outputs > 1 else final_pred_list[0]
 
+    def predict_tiled(self,
+                      inputs,
+                      tile_size,
+                      overlap=0,
+                      batch_size=16,
+                      blend='gaussian',
+                      sigma_scale=0.125,
+                      out=None,
+                      verbose=1):
+        """
+        Sliding-window prediction of a single 2D image or 3D volume that is too large to go through the model at once
+        (typically with a segmentation network from get_model('segmentation', ...)).
+        The input is cut into overlapping tiles that are run through the model in batches and the outputs are blended
+        back with per-pixel weights, so nothing needs to be resized.
+
+        :param inputs: tensor or numpy array of size (C, H, W) or (C, D, H, W). It stays where it is (e.g. on the cpu or
+            as a memmap) and only the tiles of the current batch are moved to the device
+        :param tile_size: int or tuple - spatial size of the tiles (the model must return outputs of the same spatial size)
+        :param overlap: int or tuple - number of pixels shared by neighbouring tiles
+        :param batch_size: number of tiles per forward pass
+        :param blend: string in {'gaussian', 'linear', 'constant'} - weighting of the tile outputs.
+            Gaussian and linear weights favor the tile centers, constant averages the overlapping outputs
+        :param sigma_scale: std of the gaussian weights relative to the tile size
+        :param out: float tensor of size (K, H, W) or (K, D, H, W) (optional) that receives the blended output, e.g. a
+            preallocated tensor or th.from_numpy() of a np.memmap for outputs that don't fit into memory.
+            If None, a cpu tensor is allocated once the number of output channels is known
+        :return: blended model output (the first output if the model returns several)
+        """
+        self.model.train(mode=False)
+        inputs = th.as_tensor(inputs)
+        spatial_size = tuple(inputs.shape[1:])
+        num_dims = len(spatial_size)
+        tile_size = tuple(tile_size) if is_tuple_or_list(tile_size) else (tile_size,) * num_dims
+        overlap = tuple(overlap) if is_tuple_or_list(overlap) else (overlap,) * num_dims
+
+        # inputs smaller than a tile are zero padded (and the padding is cropped off the output)
+        padded_size = tuple(max(s, t) for s, t in zip(spatial_size, tile_size))
+        if padded_size != spatial_size:
+            padding = []
+            for s, p in zip(reversed(spatial_size), reversed(padded_size)):
+                padding += [0, p - s]
+            inputs = th.nn.functional.pad(inputs, padding)
+
+        tiles = list(_tile_slices(padded_size, tile_size, overlap))
+        num_batches = int(math.ceil(len(tiles) / batch_size))
+        # the normalization only depends on the tiling, so it is accumulated up front
+        weight = _tile_blend_weights(tile_size, blend, sigma_scale)
+        weight_sum = th.zeros(padded_size, dtype=th.float32)
+        for tile in tiles:
+            weight_sum[tile] += weight
+        output = None
+
+        _range = tqdm(range(num_batches)) if verbose > 0 else range(num_batches)
+        with th.no_grad():
+            for batch_idx in _range:
+                batch_tiles = tiles[batch_idx * batch_size:(batch_idx + 1) * batch_size]
+                input_batch = th.stack([inputs[(slice(None),) + tile] for tile in batch_tiles]).to(self.device)
+                input_batch = self._prepare_inputs(input_batch)
+                output_batch = self.model(input_batch)
+                if is_tuple_or_list(output_batch):
+                    output_batch = output_batch[0]
+
+                if output is None:
+                    if out is not None and padded_size == spatial_size:
+                        output = out.zero_()
+                    else:
+                        output = th.zeros((output_batch.size(1),) + padded_size, dtype=th.float32)
+                    weight = weight.to(output_batch.device)
+
+                # weight on the device, then accumulate on the output's device
+                output_batch = (output_batch.float() * weight).to(output.device)
+                for tile, tile_output in zip(batch_tiles, output_batch):
+                    output[(slice(None),) + tile] += tile_output
+
+        output /= weight_sum.to(output.device)
+        if padded_size != spatial_size:
+            output = output[(slice(None),) + tuple(slice(0, s) for s in spatial_size)]
+            if out is not None:
+                output = out.copy_(output)
+        self.model.train(mode=True)
+        return output
+
     def evaluate(self,
                  inputs,
                  targets=None,
@@ -597,6 +771,7 @@ class ModuleTrainer(object):
                     cond_logs = conditions_container(CondType.PRE, epoch_num=None, batch_num=batch_idx, net=self.model, input_batch=input_batch, target_batch=target_batch)
                     eval_logs.update(cond_logs)
                 input_batch, target_batch = evaluate_helper.move_to_device(self.device, input_batch, target_batch)
+                input_batch = self._prepare_inputs(input_batch)
 
                 self._optimizer.zero_grad()
                 output_batch = eval_forward_fn(input_batch)
@@ -616,19 +791,46 @@ class ModuleTrainer(object):
         self.model.train(mode=True)
         return eval_logs
 
-    def evaluate_loader(self, loader, eval_helper_name=None, verbose=1):
+    def cache_loader(self, loader, mode='auto', cache_dir=None, max_device_bytes=None, steps=None):
+        """
+        Materializes one pass over a loader, e.g. a validation loader with deterministic transforms, so that later
+        passes iterate the cached batches instead of reading, decoding and transforming every sample again.
+        The result can be passed to evaluate_loader or as val_loader to fit_loader.
+
+        :param loader: DataLoader (or any iterable of batches)
+        :param mode: where the batches are kept, one of\n
+            'device' - on the trainer's device\n
+            'pinned' - in pinned host memory (fast copies to the GPU)\n
+            'disk' - in a memory mapped file in cache_dir (the file is unlinked right away, its space is freed with the cache)\n
+            'auto' - on the device if the pass fits into max_device_bytes, otherwise on disk if cache_dir is given, else pinned
+        :param cache_dir: directory of the disk cache
+        :param max_device_bytes: device memory budget of 'auto' (default: half of the free GPU memory)
+        :param steps: number of batches to cache (default: one pass over the loader)
+
+        :return: an iterable of the cached batches
+        """
+        return _CachedBatches(loader, mode=mode, device=self.device, cache_dir=cache_dir,
+                              max_device_bytes=max_device_bytes, steps=steps)
+
+    def evaluate_loader(self, loader, eval_helper_name=None, verbose=1, steps=None):
+        """
+        Evaluate a model on data provided by a loader
 
+        :param loader: DataLoader (or any iterable of batches), loaders of unknown length are supported as well.
+            Batches cached with cache_loader are evaluated without touching the underlying dataset
+        :param steps: number of batches to evaluate (default: one pass over the loader)
+        """
         self.model.train(mode=False)
-        num_inputs, num_targets = _parse_num_inputs_and_targets_from_loader(loader)
-        batch_size = loader.batch_size
-        len_inputs = len(loader.sampler) if loader.sampler else len(loader.dataset)
-        num_batches = int(math.ceil(len_inputs / batch_size))
+        # fit_loader hands in the stream it keeps across epochs
+        stream = loader if isinstance(loader, _LoaderStream) else _LoaderStream(_batch_fetch_loader(loader))
+        loader = loader.loader if isinstance(loader, _LoaderStream) else loader
+        num_inputs, num_targets = _parse_num_inputs_and_targets_from_loader(loader, stream)
+        num_batches = _num_batches_from_loader(loader, steps)
 
         evaluate_helper = _get_helper(self, num_inputs, num_targets, helper_name=eval_helper_name)
         eval_loss_fn = evaluate_helper.get_partial_loss_fn(self._criterion_fn)
         eval_forward_fn = evaluate_helper.get_partial_forward_fn(self.model)
         eval_logs= {'val_loss': 0.}
-        loader_iter = iter(loader)
 
         if self._has_metrics:
             metric_container = MetricContainer(self._metrics, prefix='val_')
@@ -647,12 +849,16 @@ class ModuleTrainer(object):
 
         samples_seen = 0
         with th.no_grad():  # locally disable grad calculations for forward-pass only
-            for batch_idx in range(num_batches):
-                input_batch, target_batch = evaluate_helper.grab_batch_from_loader(loader_iter)
+            for batch_idx in (range(num_batches) if num_batches is not None else itertools.count()):
+                try:
+                    input_batch, target_batch = _grab_batch(evaluate_helper, stream, num_batches)
+                except StopIteration:
+                    break
                 if conditions_container:
                     cond_logs = conditions_container(CondType.PRE, epoch_num=None, batch_num=batch_idx, net=self.model, input_batch=input_batch, target_batch=target_batch)
                     eval_logs.update(cond_logs)
                 input_batch, target_batch = evaluate_helper.move_to_device(self.device, input_batch, target_batch)
+                input_batch = self._prepare_inputs(input_batch)
 
                 self._optimizer.zero_grad()
                 output_batch = eval_forward_fn(input_batch)
@@ -720,6 +926,19 @@ class ModuleTrainer(object):
 
         return summary
 
+def _grab_batch(helper, stream, num_batches):
+    """
+    Next batch from a _LoaderStream. When the number of batches per epoch is known, a loader that runs out
+    (i.e. the previous epoch ended exactly at the end of a pass) is restarted. Otherwise StopIteration ends the epoch.
+    """
+    try:
+        return helper.grab_batch_from_loader(stream)
+    except StopIteration:
+        if num_batches is None:
+            raise
+        return helper.grab_batch_from_loader(stream)
+
+
 def _get_helper(trainer, num_inputs, num_targets, helper_name=None):
     '''
     :param trainer:
@@ -846,7 +1065,8 @@ class SingleInput_MultiTarget_Helper(object):
     def apply_transforms(self, tforms, input_batch, target_batch):
         input_batch = tforms[0](input_batch)
         target_batch = [tforms[1](target_) for target_ in target_batch]
-        return input_batch, target_batch
+        transformed = tforms[2](input_batch, *target_batch)
+        return transformed[0], list(transformed[1:])
 
     def forward_pass(self, input_batch, model):
         return model(input_batch)
@@ -883,7 +1103,8 @@ class MultiInput_SingleTarget_Helper(object):
     def apply_transforms(self, tforms, input_batch, target_batch):
         input_batch = [tforms[0](input_) for input_ in input_batch]
         target_batch = tforms[1](target_batch)
-        return input_batch, target_batch
+        transformed = tforms[2](*input_batch, target_batch)
+        return list(transformed[:-1]), transformed[-1]
 
     def forward_pass(self, input_batch, model):
         return model(*input_batch)
@@ -920,7 +1141,8 @@ class MultiInput_MultiTarget_Helper(object):
     def apply_transforms(self, tforms, input_batch, target_batch):
         input_batch = [tforms[0](input_) for input_ in input_batch]
         target_batch = [tforms[1](target_) for target_ in target_batch]
-        return input_batch, target_batch
+        transformed = tforms[2](*input_batch, *target_batch)
+        return list(transformed[:len(input_batch)]), list(transformed[len(input_batch):])
 
     def forward_pass(self, input_batch, model):
         return model(*input_batch)
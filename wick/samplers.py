@@ -1,7 +1,10 @@
 
+import os
+import numpy as np
 import torch as th
 import math
 from .utils import th_random_choice
+from .datasets.data_utils import _downsample_any, _integral_image, _box_sums, _open_mask
 
 class Sampler(object):
     """Base class for all Samplers.
@@ -20,12 +23,53 @@ class Sampler(object):
     def __len__(self):
         raise NotImplementedError
 
+def _make_generator(seed, epoch):
+    # every replica builds the same generator so they agree on the global order
+    generator = th.Generator()
+    if seed is None:
+        generator.seed()
+    else:
+        generator.manual_seed(seed + epoch)
+    return generator
+
+
+def _check_shard(seed, num_replicas, rank):
+    if num_replicas > 1 and seed is None:
+        raise ValueError('A seed is required when sampling for several replicas so they agree on the order')
+    if not 0 <= rank < num_replicas:
+        raise ValueError('rank must be in [0, num_replicas)')
+
+
+def _stratified_order(class_vector, generator):
+    """
+    Shuffled order of all indices in which every class is spread evenly, so any
+    contiguous window has (up to one sample per class) the class proportions of the whole set
+    """
+    class_vector = th.as_tensor(class_vector).long().view(-1)
+    n = class_vector.size(0)
+
+    # per-class pools: one stable sort groups the (shuffled) indices by class
+    perm = th.randperm(n, generator=generator)
+    labels = class_vector[perm]
+    order = th.argsort(labels, stable=True)
+    pooled = perm[order]
+    counts = th.bincount(labels)
+    starts = th.cumsum(counts, 0) - counts
+
+    # position of every sample inside its pool, spread over [0, 1) with a random phase per class
+    sorted_labels = labels[order]
+    rank_in_class = th.arange(n) - starts[sorted_labels]
+    phase = th.rand(counts.size(0), generator=generator)
+    key = (rank_in_class.double() + phase[sorted_labels].double()) / counts[sorted_labels].double()
+    return pooled[th.argsort(key, stable=True)]
+
+
 class StratifiedSampler(Sampler):
     """Stratified Sampling
 
     Provides equal representation of target classes in each batch
     """
-    def __init__(self, class_vector, batch_size):
+    def __init__(self, class_vector, batch_size, seed=None, num_replicas=1, rank=0):
         """
         Arguments
         ---------
@@ -33,30 +77,426 @@ class StratifiedSampler(Sampler):
             a vector of class labels
         batch_size : integer
             batch_size
+        seed : integer
+            if given, the order is reproducible (and changes with set_epoch)
+        num_replicas : integer
+            number of processes taking part in distributed training
+        rank : integer
+            rank of the current process. Every replica gets a strided, equally sized
+            share of the stratified order
         """
-        self.n_splits = int(class_vector.size(0) / batch_size)
+        _check_shard(seed, num_replicas, rank)
         self.class_vector = class_vector
+        self.batch_size = batch_size
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.num_samples = int(math.ceil(len(class_vector) / num_replicas))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
 
     def gen_sample_array(self):
-        try:
-            from sklearn.model_selection import StratifiedShuffleSplit
-        except:
-            print('Need scikit-learn for this functionality')
-        import numpy as np
-        
-        s = StratifiedShuffleSplit(n_splits=self.n_splits, test_size=0.5)
-        X = th.randn(self.class_vector.size(0),2).numpy()
-        y = self.class_vector.numpy()
-        s.get_n_splits(X, y)
+        order = _stratified_order(self.class_vector, _make_generator(self.seed, self.epoch))
+        # pad (by wrapping around) so every replica gets the same number of samples
+        total_size = self.num_samples * self.num_replicas
+        if total_size > len(order):
+            order = th.cat([order, order[:total_size - len(order)]])
+        return order[self.rank:total_size:self.num_replicas]
 
-        train_index, test_index = next(s.split(X, y))
-        return np.hstack([train_index, test_index])
+    def __iter__(self):
+        return iter(self.gen_sample_array().tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+
+class StratifiedBatchSampler(Sampler):
+    """Stratified batch sampling
+
+    Yields batches of indices in which every class is represented according to
+    its frequency in the whole dataset (within one sample per class)
+    """
+    def __init__(self, class_vector, batch_size, drop_last=False, seed=None, num_replicas=1, rank=0):
+        """
+        Arguments
+        ---------
+        class_vector : torch tensor
+            a vector of class labels
+        batch_size : integer
+            batch_size
+        drop_last : boolean
+            whether to drop the last incomplete batch
+        seed : integer
+            if given, the batches are reproducible (and change with set_epoch)
+        num_replicas : integer
+            number of processes taking part in distributed training
+        rank : integer
+            rank of the current process. Whole batches are dealt out to replicas round-robin
+        """
+        _check_shard(seed, num_replicas, rank)
+        self.class_vector = class_vector
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+        n = len(class_vector)
+        num_batches = n // batch_size if drop_last else int(math.ceil(n / batch_size))
+        self.num_batches = int(math.ceil(num_batches / num_replicas))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
 
     def __iter__(self):
-        return iter(self.gen_sample_array())
+        order = _stratified_order(self.class_vector, _make_generator(self.seed, self.epoch))
+        batches = list(th.split(order, self.batch_size))
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        if not batches:
+            return      # no (full) batch can be formed, len() is 0 as well
+        # pad (by wrapping around) so every replica gets the same number of batches
+        total = self.num_batches * self.num_replicas
+        batches = (batches * int(math.ceil(total / len(batches))))[:total]
+        for batch in batches[self.rank::self.num_replicas]:
+            yield batch.tolist()
 
     def __len__(self):
-        return len(self.class_vector)
+        return self.num_batches
+
+
+class BucketBatchSampler(Sampler):
+    """Size / aspect-ratio bucketed batch sampling
+
+    Yields batches of indices whose samples have a similar aspect ratio and size,
+    so a padding collate (see data_utils.PadCollate) only pads to the largest sample
+    of the batch instead of the largest sample of the dataset
+    """
+    def __init__(self, sizes, batch_size, num_buckets=8, pool_size=32, drop_last=False, shuffle=True,
+                 seed=None, num_replicas=1, rank=0):
+        """
+        Arguments
+        ---------
+        sizes : array-like of shape (N, 2)
+            (height, width) of every sample, e.g. from FolderDataset.get_sample_sizes()
+        batch_size : integer
+            batch_size
+        num_buckets : integer
+            number of aspect-ratio buckets (spread evenly over the log aspect ratios of the data).
+            Batches never mix buckets
+        pool_size : integer
+            number of batches that are drawn together and sorted by area before being split,
+            trading randomness of the batch composition for less padding
+        drop_last : boolean
+            whether to drop the incomplete last batch of every bucket
+        shuffle : boolean
+            whether to shuffle samples and batches on every epoch
+        seed : integer
+            if given, the batches are reproducible (and change with set_epoch)
+        num_replicas : integer
+            number of processes taking part in distributed training
+        rank : integer
+            rank of the current process. Whole batches are dealt out to replicas round-robin
+        """
+        _check_shard(seed, num_replicas, rank)
+        sizes = th.as_tensor(sizes, dtype=th.double).view(-1, 2)
+        self.batch_size = batch_size
+        self.pool_size = pool_size
+        self.drop_last = drop_last
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+        self.area = sizes[:, 0] * sizes[:, 1]
+        log_aspect = th.log(sizes[:, 1] / sizes[:, 0])
+        low, high = log_aspect.min(), log_aspect.max()
+        if high > low:
+            self.bucket_ids = ((log_aspect - low) / (high - low) * num_buckets).long().clamp_(max=num_buckets - 1)
+        else:
+            self.bucket_ids = th.zeros(len(sizes), dtype=th.long)
+
+        counts = th.bincount(self.bucket_ids).tolist()
+        num_batches = sum(c // batch_size if drop_last else int(math.ceil(c / batch_size)) for c in counts)
+        self.num_batches = int(math.ceil(num_batches / num_replicas))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _bucket_batches(self, generator):
+        batches = []
+        for bucket in th.unique(self.bucket_ids).tolist():
+            indices = th.nonzero(self.bucket_ids == bucket).view(-1)
+            if self.shuffle:
+                indices = indices[th.randperm(len(indices), generator=generator)]
+            # sort pools of similar samples by area, so every batch holds samples of about the same size
+            pool_len = self.batch_size * self.pool_size
+            for pool in th.split(indices, pool_len):
+                pool = pool[th.argsort(self.area[pool], stable=True)]
+                batches.extend(th.split(pool, self.batch_size))
+            if self.drop_last and len(batches[-1]) < self.batch_size:
+                batches.pop()
+        return batches
+
+    def __iter__(self):
+        generator = _make_generator(self.seed, self.epoch)
+        batches = self._bucket_batches(generator)
+        if self.shuffle:
+            batches = [batches[i] for i in th.randperm(len(batches), generator=generator).tolist()]
+        if not batches:
+            return      # no (full) batch can be formed, len() is 0 as well
+        # pad (by wrapping around) so every replica gets the same number of batches
+        total = self.num_batches * self.num_replicas
+        batches = (batches * int(math.ceil(total / len(batches))))[:total]
+        for batch in batches[self.rank::self.num_replicas]:
+            yield batch.tolist()
+
+    def __len__(self):
+        return self.num_batches
+
+
+def _build_alias_table(weights):
+    """
+    Vose's alias method: O(K) construction, O(1) per draw
+    """
+    weights = th.as_tensor(weights, dtype=th.double).view(-1)
+    k = weights.size(0)
+    prob = (weights * k / weights.sum()).tolist()
+    alias = [0] * k
+    small = [i for i, p in enumerate(prob) if p < 1.0]
+    large = [i for i, p in enumerate(prob) if p >= 1.0]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        alias[s] = l
+        prob[l] = prob[l] + prob[s] - 1.0
+        (small if prob[l] < 1.0 else large).append(l)
+    for i in small + large:      # leftovers are 1 up to rounding
+        prob[i] = 1.0
+    return th.tensor(prob, dtype=th.double), th.tensor(alias, dtype=th.long)
+
+
+class WeightedSampler(Sampler):
+    """Samples elements with given (not necessarily normalized) weights
+    """
+    def __init__(self, weights, num_samples=None, replacement=True, method='alias', seed=None, num_replicas=1, rank=0):
+        """
+        Arguments
+        ---------
+        weights : 1-D array-like
+            sampling weight of every element of the dataset
+        num_samples : integer
+            number of samples to draw per epoch (over all replicas). Defaults to len(weights)
+        replacement : boolean
+            whether to draw with replacement. Sampling without replacement always uses torch.multinomial
+        method : string in {'alias', 'multinomial'}
+            'alias' builds an alias table once so every draw costs O(1),
+            'multinomial' uses torch.multinomial on every epoch
+        seed : integer
+            if given, the samples are reproducible (and change with set_epoch)
+        num_replicas : integer
+            number of processes taking part in distributed training
+        rank : integer
+            rank of the current process. Every replica gets a strided share of the draw
+        """
+        if method not in ('alias', 'multinomial'):
+            raise ValueError('method must be one of: {alias, multinomial}')
+        _check_shard(seed, num_replicas, rank)
+        self.weights = th.as_tensor(weights, dtype=th.double).view(-1)
+        total_samples = len(self.weights) if num_samples is None else num_samples
+        if not replacement and total_samples > len(self.weights):
+            raise ValueError('num_samples can not exceed the number of weights when sampling without replacement')
+        self.replacement = replacement
+        self.method = method if replacement else 'multinomial'
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.num_samples = int(math.ceil(total_samples / num_replicas))
+        self.total_samples = total_samples
+
+        if self.method == 'alias':
+            self.alias_prob, self.alias = _build_alias_table(self.weights)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def gen_sample_array(self):
+        generator = _make_generator(self.seed, self.epoch)
+        total_size = self.num_samples * self.num_replicas
+        if self.method == 'alias':
+            bins = th.randint(len(self.weights), (total_size,), generator=generator)
+            keep = th.rand(total_size, generator=generator, dtype=th.double) < self.alias_prob[bins]
+            idx = th.where(keep, bins, self.alias[bins])
+        else:
+            idx = th.multinomial(self.weights, self.total_samples, self.replacement, generator=generator)
+            if total_size > len(idx):
+                idx = th.cat([idx, idx[:total_size - len(idx)]])
+        return idx[self.rank:total_size:self.num_replicas]
+
+    def __iter__(self):
+        return iter(self.gen_sample_array().tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+
+class ClassBalancedSampler(WeightedSampler):
+    """Samples elements so that every class is drawn equally often (in expectation)
+    """
+    def __init__(self, class_vector, num_samples=None, replacement=True, method='alias', seed=None, num_replicas=1, rank=0):
+        """
+        Arguments
+        ---------
+        class_vector : torch tensor
+            a vector of class labels
+        num_samples, replacement, method, seed, num_replicas, rank :
+            see WeightedSampler
+        """
+        class_vector = th.as_tensor(class_vector).long().view(-1)
+        counts = th.bincount(class_vector).double()
+        weights = 1.0 / counts[class_vector]
+        super(ClassBalancedSampler, self).__init__(weights, num_samples=num_samples, replacement=replacement, method=method,
+                                                   seed=seed, num_replicas=num_replicas, rank=rank)
+
+
+class ForegroundPatchSampler(Sampler):
+    """Foreground-biased patch sampling for segmentation on sparse masks
+
+    Yields patch origins (image index, y, x) - or (image index, z, y, x) for volumes - of which a given
+    fraction contains foreground. TileDataset and VolumePatchDataset take these tuples as indices,
+    which replaces rejection loops like Slice2D(reject_zeros=True) or retrying random crops.
+
+    Every mask is scanned once: it is downsampled to a coarse foreground grid and the grid cells whose
+    patch-sized neighbourhood reaches min_coverage are found with an integral image. Afterwards every
+    draw costs O(1), independent of the image size and the foreground sparsity.
+    """
+    def __init__(self, masks, patch_size, num_samples, foreground_ratio=0.5, downsample=8, min_coverage=0.0,
+                 coverage_file=None, seed=None, num_replicas=1, rank=0):
+        """
+        Arguments
+        ---------
+        masks : list of strings or arrays
+            the masks (.npy, .wvol or image paths, or arrays). Paths are memory mapped / read in bands.
+            Trailing dims beyond the patch dims (e.g. channels) count as foreground if any of them is non-zero
+        patch_size : integer or tuple
+            patch size, (height, width) or (depth, height, width). An integer means a 2D patch
+        num_samples : integer
+            number of patches per epoch (over all replicas)
+        foreground_ratio : float
+            fraction of patches centred on foreground. The others are drawn uniformly over all images
+        downsample : integer or tuple
+            block size of the coarse foreground grid. Foreground patches are centred on a random pixel of a
+            foreground block, so smaller blocks follow thin structures more closely at the cost of memory
+        min_coverage : float
+            minimum fraction of foreground blocks within the patch around a block for it to be used as a centre.
+            Near the border the patch is shifted inside the mask, as the drawn patches are. For masks smaller
+            than the patch the fraction is taken over the whole mask
+        coverage_file : string
+            .npz file caching the scan. Created on the first run and loaded on later ones.
+            Delete it when the masks, patch size, downsampling or min_coverage change
+        seed : integer
+            if given, the patches are reproducible (and change with set_epoch)
+        num_replicas : integer
+            number of processes taking part in distributed training
+        rank : integer
+            rank of the current process. Every replica gets a strided share of the draw
+        """
+        _check_shard(seed, num_replicas, rank)
+        patch_size = tuple(patch_size) if isinstance(patch_size, (tuple, list)) else (patch_size, patch_size)
+        ndim = len(patch_size)
+        downsample = tuple(downsample) if isinstance(downsample, (tuple, list)) else (downsample,) * ndim
+        self.patch_size = th.tensor(patch_size, dtype=th.long)
+        self.downsample = th.tensor(downsample, dtype=th.long)
+        self.foreground_ratio = foreground_ratio
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.num_samples = int(math.ceil(num_samples / num_replicas))
+
+        if coverage_file is not None and os.path.exists(coverage_file):
+            index = np.load(coverage_file)
+            shapes, fg_images, fg_cells = index['shapes'], index['fg_images'], index['fg_cells']
+        else:
+            window = np.array([-(-p // f) for p, f in zip(patch_size, downsample)])
+            shapes, fg_images, fg_cells = [], [], []
+            for image_idx, mask in enumerate(masks):
+                if isinstance(mask, str):
+                    mask = _open_mask(mask)
+                shapes.append(mask.shape[:ndim])
+                coarse = _downsample_any(mask, downsample, ndim=ndim)
+                cells = np.argwhere(coarse)
+                if len(cells) and min_coverage > 0:
+                    # windows are shifted inside the mask at both borders, like the patches drawn by draw(),
+                    # and only clipped for masks smaller than the patch (normalized by their in-bounds extent)
+                    lo = np.clip(cells - window // 2, 0, np.maximum(np.array(coarse.shape) - window, 0))
+                    hi = np.minimum(lo + window, coarse.shape)
+                    coverage = _box_sums(_integral_image(coarse), lo, hi) / np.prod(hi - lo, axis=1).astype(np.float64)
+                    cells = cells[coverage >= min_coverage]
+                fg_images.append(np.full(len(cells), image_idx, dtype=np.int64))
+                fg_cells.append(cells.astype(np.int64).reshape(-1, ndim))
+            shapes = np.asarray(shapes, dtype=np.int64).reshape(-1, ndim)
+            fg_images, fg_cells = np.concatenate(fg_images), np.concatenate(fg_cells)
+            if coverage_file is not None:
+                np.savez(coverage_file, shapes=shapes, fg_images=fg_images, fg_cells=fg_cells)
+
+        self.shapes = th.from_numpy(np.asarray(shapes))
+        self.fg_images = th.from_numpy(np.asarray(fg_images))
+        self.fg_cells = th.from_numpy(np.asarray(fg_cells))
+        # background draws are uniform over all pixels, i.e. images are weighted by their area
+        self.image_prob, self.image_alias = _build_alias_table(self.shapes.double().prod(1))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def draw(self, n, generator=None):
+        """
+        Draws n patch origins
+
+        Arguments
+        ---------
+        n : integer
+            number of patches
+        generator : torch.Generator
+            random generator (default: the global one)
+
+        Returns
+        -------
+        torch.LongTensor of shape (n, 1 + ndim): image index followed by the patch origin
+        """
+        ndim = self.shapes.size(1)
+        use_fg = th.rand(n, generator=generator) < self.foreground_ratio
+        if len(self.fg_images) == 0:
+            use_fg.zero_()
+
+        bins = th.randint(len(self.shapes), (n,), generator=generator)
+        keep = th.rand(n, generator=generator, dtype=th.double) < self.image_prob[bins]
+        images = th.where(keep, bins, self.image_alias[bins])
+        centres = (th.rand(n, ndim, generator=generator, dtype=th.double) * self.shapes[images].double()).long()
+
+        if use_fg.any():
+            picks = th.randint(max(len(self.fg_images), 1), (n,), generator=generator)[use_fg]
+            jitter = (th.rand(len(picks), ndim, generator=generator, dtype=th.double) * self.downsample.double()).long()
+            images[use_fg] = self.fg_images[picks]
+            centres[use_fg] = self.fg_cells[picks] * self.downsample + jitter
+
+        shapes = self.shapes[images]
+        centres = th.min(centres, shapes - 1)
+        origins = th.max(th.min(centres - self.patch_size // 2, shapes - self.patch_size), th.zeros_like(centres))
+        return th.cat([images.view(-1, 1), origins], 1)
+
+    def __iter__(self):
+        total_size = self.num_samples * self.num_replicas
+        patches = self.draw(total_size, _make_generator(self.seed, self.epoch))[self.rank:total_size:self.num_replicas]
+        return iter([tuple(row) for row in patches.tolist()])
+
+    def __len__(self):
+        return self.num_samples
+
 
 class MultiSampler(Sampler):
     """Samples elements more than once in a single pass through the data.
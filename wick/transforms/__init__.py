@@ -1,4 +1,4 @@
-
 from .affine_transforms import *
+from .batch_transforms import *
 from .image_transforms import *
 from .tensor_transforms import *
\ No newline at end of file
@@ -7,7 +7,25 @@ import math
 import random
 import torch as th
 
-from ..utils import th_affine2d, th_random_choice
+from ..utils import th_affine2d_grid, th_grid_sample2d, th_random_choice
+
+
+def _apply_affine(inputs, tform_matrix, interp, center=True):
+    """
+    Apply the same affine matrix to every input. The sampling grid is computed
+    once per input size and shared (e.g. between an image and its mask).
+    """
+    if not isinstance(interp, (tuple,list)):
+        interp = [interp]*len(inputs)
+
+    grids = {}
+    outputs = []
+    for idx, _input in enumerate(inputs):
+        key = (tuple(_input.size()[1:]), _input.device)
+        if key not in grids:
+            grids[key] = th_affine2d_grid(tform_matrix, _input.size()[1:], center=center, device=_input.device)
+        outputs.append(th_grid_sample2d(_input, grids[key], mode=interp[idx]))
+    return outputs if idx >= 1 else outputs[0]
 
 
 class RandomAffine(object):
@@ -95,6 +113,8 @@ class RandomAffine(object):
 
 class Affine(object):
 
+    deterministic = True
+
     def __init__(self, 
                  tform_matrix,
                  interp='bilinear'):
@@ -118,18 +138,7 @@ class Affine(object):
         self.interp = interp
 
     def __call__(self, *inputs):
-        if not isinstance(self.interp, (tuple,list)):
-            interp = [self.interp]*len(inputs)
-        else:
-            interp = self.interp
-
-        outputs = []
-        for idx, _input in enumerate(inputs):
-            input_tf = th_affine2d(_input,
-                                   self.tform_matrix,
-                                   mode=interp[idx])
-            outputs.append(input_tf)
-        return outputs if idx >= 1 else outputs[0]
+        return _apply_affine(inputs, self.tform_matrix, self.interp)
 
 
 class AffineCompose(object):
@@ -169,18 +178,7 @@ class AffineCompose(object):
         for tform in self.transforms[1:]:
             tform_matrix = tform_matrix.mm(tform(inputs[0])) 
 
-        if not isinstance(self.interp, (tuple,list)):
-            interp = [self.interp]*len(inputs)
-        else:
-            interp = self.interp
-
-        outputs = []
-        for idx, _input in enumerate(inputs):
-            input_tf = th_affine2d(_input,
-                                   tform_matrix,
-                                   mode=interp[idx])
-            outputs.append(input_tf)
-        return outputs if idx >= 1 else outputs[0]
+        return _apply_affine(inputs, tform_matrix, self.interp)
 
 
 class RandomRotate(object):
@@ -275,6 +273,8 @@ class RandomChoiceRotate(object):
 
 class Rotate(object):
 
+    deterministic = True
+
     def __init__(self, 
                  value,
                  interp='bilinear',
@@ -314,14 +314,7 @@ class Rotate(object):
         if self.lazy:
             return rotation_matrix
         else:
-            outputs = []
-            for idx, _input in enumerate(inputs):
-                input_tf = th_affine2d(_input,
-                                       rotation_matrix,
-                                       mode=interp[idx],
-                                       center=True)
-                outputs.append(input_tf)
-            return outputs if idx >= 1 else outputs[0]
+            return _apply_affine(inputs, rotation_matrix, interp)
 
 
 class RandomTranslate(object):
@@ -435,6 +428,8 @@ class RandomChoiceTranslate(object):
 
 class Translate(object):
 
+    deterministic = True
+
     def __init__(self, 
                  value, 
                  interp='bilinear',
@@ -481,14 +476,7 @@ class Translate(object):
         if self.lazy:
             return translation_matrix
         else:
-            outputs = []
-            for idx, _input in enumerate(inputs):
-                input_tf = th_affine2d(_input,
-                                       translation_matrix,
-                                       mode=interp[idx],
-                                       center=True)
-                outputs.append(input_tf)
-            return outputs if idx >= 1 else outputs[0]
+            return _apply_affine(inputs, translation_matrix, interp)
 
 
 class RandomShear(object):
@@ -582,6 +570,8 @@ class RandomChoiceShear(object):
 
 class Shear(object):
 
+    deterministic = True
+
     def __init__(self,
                  value,
                  interp='bilinear',
@@ -603,14 +593,7 @@ class Shear(object):
         if self.lazy:
             return shear_matrix
         else:
-            outputs = []
-            for idx, _input in enumerate(inputs):
-                input_tf = th_affine2d(_input,
-                                       shear_matrix,
-                                       mode=interp[idx],
-                                       center=True)
-                outputs.append(input_tf)
-            return outputs if idx >= 1 else outputs[0]
+            return _apply_affine(inputs, shear_matrix, interp)
 
 
 class RandomSquareZoom(object):
@@ -754,6 +737,8 @@ class RandomChoiceZoom(object):
 
 class Zoom(object):
 
+    deterministic = True
+
     def __init__(self,
                  value,
                  interp='bilinear',
@@ -796,13 +781,6 @@ class Zoom(object):
         if self.lazy:
             return zoom_matrix
         else:
-            outputs = []
-            for idx, _input in enumerate(inputs):
-                input_tf = th_affine2d(_input,
-                                       zoom_matrix,
-                                       mode=interp[idx],
-                                       center=True)
-                outputs.append(input_tf)
-            return outputs if idx >= 1 else outputs[0]
+            return _apply_affine(inputs, zoom_matrix, interp)
 
 
@@ -0,0 +1,311 @@
+"""
+Transforms that operate on whole (N, C, H, W) batches at once.
+
+These are meant to run on the training device (see ModuleTrainer.set_transforms)
+after the batch has been transferred, so random parameters are sampled per sample
+but applied with a single vectorized op per batch.
+"""
+
+import json
+import math
+
+import torch as th
+import torch.nn.functional as F
+
+
+def _sample_uniform(n, low, high, device):
+    return th.rand(n, device=device) * (high - low) + low
+
+
+def _expand_interp(interp, num_inputs):
+    if not isinstance(interp, (tuple, list)):
+        return [interp] * num_inputs
+    # reuse the last given interpolation for any remaining inputs (e.g. several masks)
+    return [interp[min(i, len(interp) - 1)] for i in range(num_inputs)]
+
+
+def batch_grid_sample(x, grid, mode='bilinear'):
+    """
+    Resample a batch with a precomputed sampling grid.
+
+    Integer tensors (e.g. class-index masks) are always resampled with
+    nearest interpolation and returned with their original dtype.
+    (N, H, W) masks are supported as well as (N, C, H, W) tensors.
+
+    Arguments
+    ---------
+    x : torch tensor of size (N, C, H, W) or (N, H, W)
+
+    grid : torch tensor of size (N, H, W, 2)
+        sampling grid as produced by F.affine_grid
+
+    mode : string in {'bilinear', 'nearest'}
+    """
+    no_channel = x.dim() == 3
+    if no_channel:
+        x = x.unsqueeze(1)
+
+    dtype = x.dtype
+    if not dtype.is_floating_point:
+        mode = 'nearest'
+        x = x.float()
+
+    out = F.grid_sample(x, grid.to(x.dtype), mode=mode, padding_mode='zeros', align_corners=False)
+
+    if not dtype.is_floating_point:
+        out = out.round_().to(dtype)
+    if no_channel:
+        out = out.squeeze(1)
+    return out
+
+
+class RandomBatchAffine(object):
+
+    batch = True        # operates on whole (N, ...) batches
+
+    def __init__(self,
+                 rotation_range=None,
+                 translation_range=None,
+                 shear_range=None,
+                 zoom_range=None,
+                 h_flip=False,
+                 v_flip=False,
+                 p_flip=0.5,
+                 interp=('bilinear', 'nearest')):
+        """
+        Apply a different random affine transform (and optional flips) to every
+        sample of a batch using a single grid_sample per input.
+
+        All inputs (e.g. an image batch and its mask batch) receive exactly the
+        same geometric transform, so this is typically used as a co-transform.
+
+        Arguments
+        ---------
+        rotation_range : integer or float
+            each sample is rotated randomly between (-degrees, degrees)
+
+        translation_range : a float or a tuple/list with 2 floats between [0, 1)
+            fractional bounds of total height / width to shift each sample
+
+        shear_range : float
+            each sample is sheared randomly between (-degrees, degrees)
+
+        zoom_range : list/tuple with two floats between [0, infinity)
+            lower and upper bounds on percent zoom.
+            Anything less than 1.0 will zoom in, greater than 1.0 will zoom out
+
+        h_flip : boolean
+            whether to horizontally flip each sample w/ probability p_flip
+
+        v_flip : boolean
+            whether to vertically flip each sample w/ probability p_flip
+
+        p_flip : float between [0,1]
+            probability with which to apply allowed flipping operations
+
+        interp : string in {'bilinear', 'nearest'} or list of strings
+            type of interpolation to use for each input. If fewer values than
+            inputs are given, the last value is reused. Integer inputs are
+            always interpolated with 'nearest'.
+        """
+        if translation_range is not None and not isinstance(translation_range, (tuple, list)):
+            translation_range = (translation_range, translation_range)
+        if zoom_range is not None and not isinstance(zoom_range, (tuple, list)):
+            raise ValueError('zoom_range must be tuple or list with 2 values')
+        if all(r is None for r in (rotation_range, translation_range, shear_range, zoom_range)) and not (h_flip or v_flip):
+            raise ValueError('Must give at least one transform parameter')
+
+        self.rotation_range = rotation_range
+        self.translation_range = translation_range
+        self.shear_range = shear_range
+        self.zoom_range = zoom_range
+        self.h_flip = h_flip
+        self.v_flip = v_flip
+        self.p_flip = p_flip
+        self.interp = interp
+
+    def sample_matrices(self, n, height, width, device=None):
+        """
+        Sample n random affine matrices in the normalized coordinates expected by F.affine_grid
+
+        :return: torch tensor of size (n, 2, 3)
+        """
+        # linear part in pixel coordinates (x = width axis, y = height axis)
+        A = th.eye(2, device=device).repeat(n, 1, 1)
+
+        if self.rotation_range is not None:
+            theta = _sample_uniform(n, -self.rotation_range, self.rotation_range, device) * math.pi / 180
+            cos, sin = th.cos(theta), th.sin(theta)
+            rot = th.stack([th.stack([cos, -sin], 1), th.stack([sin, cos], 1)], 1)
+            A = A.bmm(rot)
+
+        if self.shear_range is not None:
+            theta = _sample_uniform(n, -self.shear_range, self.shear_range, device) * math.pi / 180
+            shear = th.stack([th.stack([th.ones_like(theta), -th.sin(theta)], 1),
+                              th.stack([th.zeros_like(theta), th.cos(theta)], 1)], 1)
+            A = A.bmm(shear)
+
+        if self.zoom_range is not None:
+            zx = _sample_uniform(n, self.zoom_range[0], self.zoom_range[1], device)
+            zy = _sample_uniform(n, self.zoom_range[0], self.zoom_range[1], device)
+            A = A * th.stack([zx, zy], 1).unsqueeze(1)
+
+        if self.h_flip or self.v_flip:
+            flips = th.ones(n, 2, device=device)
+            if self.h_flip:
+                flips[:, 0] = th.where(th.rand(n, device=device) < self.p_flip, -1., 1.)
+            if self.v_flip:
+                flips[:, 1] = th.where(th.rand(n, device=device) < self.p_flip, -1., 1.)
+            A = A * flips.unsqueeze(1)
+
+        b = th.zeros(n, 2, device=device)
+        if self.translation_range is not None:
+            b[:, 1] = _sample_uniform(n, -self.translation_range[0], self.translation_range[0], device) * 2
+            b[:, 0] = _sample_uniform(n, -self.translation_range[1], self.translation_range[1], device) * 2
+
+        # convert the pixel-space linear part to normalized coordinates so non-square images aren't distorted
+        scale = th.tensor([width, height], dtype=A.dtype, device=device)
+        A = A * scale.view(1, 1, 2) / scale.view(1, 2, 1)
+
+        return th.cat([A, b.unsqueeze(2)], 2)
+
+    def __call__(self, *inputs):
+        x = inputs[0]
+        n, height, width = x.size(0), x.size(-2), x.size(-1)
+
+        matrix = self.sample_matrices(n, height, width, device=x.device)
+        self.tform_matrix = matrix
+        # one grid per batch, shared by every input
+        grid = F.affine_grid(matrix, [n, 1, height, width], align_corners=False)
+
+        interp = _expand_interp(self.interp, len(inputs))
+        outputs = []
+        for idx, _input in enumerate(inputs):
+            outputs.append(batch_grid_sample(_input, grid, mode=interp[idx]))
+        return outputs if idx >= 1 else outputs[0]
+
+
+class RandomBatchColor(object):
+
+    batch = True        # operates on whole (N, ...) batches
+
+    def __init__(self,
+                 brightness_range=None,
+                 contrast_range=None,
+                 p=1.0):
+        """
+        Randomly alter brightness and contrast of every sample of a batch in a single
+        pass. Values are sampled per sample. Assumes intensities between 0 and 1, or between
+        0 and the maximum of the dtype for integer (e.g. uint8) batches, which keep their dtype.
+
+        Arguments
+        ---------
+        brightness_range : tuple/list of 2 floats between [-1, 1]
+            additive brightness factor bounds (0 = no change)
+
+        contrast_range : tuple/list of 2 floats
+            contrast factor bounds (1 = no change)
+
+        p : float between [0,1]
+            probability with which a sample is altered at all
+        """
+        if brightness_range is None and contrast_range is None:
+            raise ValueError('Must give at least one transform parameter')
+        self.brightness_range = brightness_range
+        self.contrast_range = contrast_range
+        self.p = p
+
+    def __call__(self, *inputs):
+        outputs = []
+        for idx, _input in enumerate(inputs):
+            n = _input.size(0)
+            view = [n] + [1] * (_input.dim() - 1)
+            apply = (th.rand(n, device=_input.device) < self.p).view(view)
+
+            dtype = _input.dtype
+            max_value = 1.0 if dtype.is_floating_point else float(th.iinfo(dtype).max)
+            out = _input = _input if dtype.is_floating_point else _input.float()
+            if self.contrast_range is not None:
+                contrast = _sample_uniform(n, self.contrast_range[0], self.contrast_range[1], _input.device).view(view)
+                contrast = th.where(apply, contrast, th.ones_like(contrast))
+                means = _input.mean(dim=(-2, -1), keepdim=True)
+                out = th.lerp(means, out, contrast)
+            if self.brightness_range is not None:
+                brightness = _sample_uniform(n, self.brightness_range[0], self.brightness_range[1], _input.device).view(view)
+                out = out + th.where(apply, brightness, th.zeros_like(brightness)) * max_value
+            out = out.clamp_(0, max_value)
+            outputs.append(out if dtype.is_floating_point else out.round_().to(dtype))
+        return outputs if idx >= 1 else outputs[0]
+
+
+class DeviceNormalize(object):
+
+    batch = True        # operates on whole (N, ...) batches
+
+    def __init__(self, mean, std, input_range=255.0, dtype=th.float32):
+        """
+        Convert an integer (typically uint8) batch to floating point and normalize it
+        per channel in a single fused pass: (x / input_range - mean) / std.
+
+        Meant as the first stage on the training device (see ModuleTrainer.set_input_normalization),
+        so loader workers can return compact uint8 tensors (see ImageToByteTensor).
+
+        Arguments
+        ---------
+        mean : float or list of floats
+            per-channel mean of the data in [0, 1] (as computed by meanstd / data_stats)
+
+        std : float or list of floats
+            per-channel std of the data in [0, 1]
+
+        input_range : float
+            value that corresponds to 1.0 in the input (255 for 8-bit images)
+
+        dtype : torch dtype
+            floating point type of the output
+        """
+        self.mean = th.as_tensor(mean, dtype=th.float64).view(-1)
+        self.std = th.as_tensor(std, dtype=th.float64).view(-1)
+        self.input_range = input_range
+        self.dtype = dtype
+        # x * scale + shift == (x / input_range - mean) / std
+        self.scale = (1.0 / (input_range * self.std)).to(dtype)
+        self.shift = (-self.mean / self.std).to(dtype)
+        self._device_params = {}
+
+    @classmethod
+    def from_stats(cls, stats, input_range=255.0, dtype=th.float32):
+        """
+        Create the transform from the statistics written by data_stats.create_dataset_stats
+
+        :param stats: dict with 'mean' and 'std' or path to the stats JSON file. If the file holds several
+            appended results, the last one is used.
+        """
+        if isinstance(stats, str):
+            with open(stats, 'r') as statsfile:
+                content = statsfile.read().strip()
+            decoder = json.JSONDecoder()
+            pos = 0
+            while pos < len(content):
+                stats, pos = decoder.raw_decode(content, pos)
+                while pos < len(content) and content[pos].isspace():
+                    pos += 1
+        return cls(stats['mean'], stats['std'], input_range=input_range, dtype=dtype)
+
+    def _params(self, x):
+        # keep one copy of the parameters per device/layout so nothing is transferred per batch
+        key = (x.device, x.dim())
+        if key not in self._device_params:
+            view = [1, -1] + [1] * (x.dim() - 2)
+            self._device_params[key] = (self.scale.to(x.device).view(view), self.shift.to(x.device).view(view))
+        return self._device_params[key]
+
+    def __call__(self, *inputs):
+        outputs = []
+        for idx, _input in enumerate(inputs):
+            scale, shift = self._params(_input)
+            if _input.is_floating_point():
+                _input = _input.to(self.dtype)
+            # integer inputs are promoted inside the kernel, so conversion and normalization are a single pass
+            outputs.append(th.addcmul(shift, _input, scale))
+        return outputs if idx >= 1 else outputs[0]
@@ -3,38 +3,67 @@ Transforms to distort local or global information of an image
 """
 
 
-import torch as th
-import numpy as np
+import functools
 import random
 
+import numpy as np
+import torch as th
+
 
 class Scramble(object):
     """
     Create blocks of an image and scramble them
     """
-    def __init__(self, blocksize):
+    def __init__(self, blocksize, batch=False):
+        """
+        Arguments
+        ---------
+        blocksize : integer
+            height and width of the square blocks to shuffle. Pixels beyond the last
+            full block (if the image size is not a multiple of blocksize) are left in place
+
+        batch : boolean
+            if true, inputs are (N, C, H, W) batches and every sample gets its own permutation.
+            All inputs share the same permutation(s) so images and masks stay aligned.
+        """
         self.blocksize = blocksize
+        self.batch = batch
 
     def __call__(self, *inputs):
+        bs = self.blocksize
+        size = inputs[0].size()
+        x_blocks = int(size[-2] / bs)
+        y_blocks = int(size[-1] / bs)
+        num_blocks = x_blocks * y_blocks
+
+        if self.batch:
+            # one permutation per sample
+            ind = th.rand(size[0], num_blocks).argsort(dim=1)
+        else:
+            ind = th.randperm(num_blocks)
+
         outputs = []
         for idx, _input in enumerate(inputs):
-            size = _input.size()
-            img_height = size[1]
-            img_width = size[2]
-
-            x_blocks = int(img_height/self.blocksize) # number of x blocks
-            y_blocks = int(img_width/self.blocksize)
-            ind = th.randperm(x_blocks*y_blocks)
-
-            new = th.zeros(_input.size())
-            count = 0
-            for i in range(x_blocks):
-                for j in range (y_blocks):
-                    row = int(ind[count] / x_blocks)
-                    column = ind[count] % x_blocks
-                    new[:, i*self.blocksize:(i+1)*self.blocksize, j*self.blocksize:(j+1)*self.blocksize] = \
-                    _input[:, row*self.blocksize:(row+1)*self.blocksize, column*self.blocksize:(column+1)*self.blocksize]
-                    count += 1
+            ind = ind.to(_input.device)
+            lead = [size[0], -1] if self.batch else [-1]
+            crop = _input[..., :x_blocks*bs, :y_blocks*bs].reshape(lead + [x_blocks, bs, y_blocks, bs])
+            nd = crop.dim()
+            # (..., C, xb, bs, yb, bs) -> (..., xb*yb, C, bs, bs)
+            order = list(range(nd - 5)) + [nd - 4, nd - 2, nd - 5, nd - 3, nd - 1]
+            blocks = crop.permute(*order).reshape(lead[:-1] + [num_blocks, -1, bs, bs])
+
+            if self.batch:
+                blocks = blocks[th.arange(size[0], device=ind.device).unsqueeze(1), ind]
+            else:
+                blocks = blocks[ind]
+
+            # and back to (..., C, xb*bs, yb*bs)
+            blocks = blocks.reshape(lead[:-1] + [x_blocks, y_blocks, -1, bs, bs])
+            inverse = list(range(nd - 5)) + [nd - 3, nd - 5, nd - 2, nd - 4, nd - 1]
+            blocks = blocks.permute(*inverse).reshape(lead + [x_blocks*bs, y_blocks*bs])
+
+            new = _input.clone()
+            new[..., :x_blocks*bs, :y_blocks*bs] = blocks.reshape(new[..., :x_blocks*bs, :y_blocks*bs].size())
             outputs.append(new)
         return outputs if idx >= 1 else outputs[0]
  
@@ -51,30 +80,15 @@ class RandomChoiceScramble(object):
 
 
 def _blur_image(image, H):
-    # break image up into its color components
-    size = image.shape
-    imr = image[0,:,:]
-    img = image[1,:,:]
-    imb = image[2,:,:]
-
-    # compute Fourier transform and frequqnecy spectrum
-    Fim1r = np.fft.fftshift(np.fft.fft2(imr))
-    Fim1g  = np.fft.fftshift(np.fft.fft2(img))
-    Fim1b  = np.fft.fftshift(np.fft.fft2(imb))
-    
-    # Apply the lowpass filter to the Fourier spectrum of the image
-    filtered_imager = np.multiply(H, Fim1r)
-    filtered_imageg = np.multiply(H, Fim1g)
-    filtered_imageb = np.multiply(H, Fim1b)
-    
-    newim = np.zeros(size)
-
-    # convert the result to the spatial domain.
-    newim[0,:,:] = np.absolute(np.real(np.fft.ifft2(filtered_imager)))
-    newim[1,:,:] = np.absolute(np.real(np.fft.ifft2(filtered_imageg)))
-    newim[2,:,:] = np.absolute(np.real(np.fft.ifft2(filtered_imageb)))
-
-    return newim.astype('uint8')
+    """
+    Low-pass filter all channels (and samples) of an image at once
+
+    :param image: torch tensor of size (..., rows, cols)
+    :param H: real filter of size (rows, cols//2 + 1) laid out for rfft2 (zero frequency at [0, 0])
+    """
+    spectrum = th.fft.rfft2(image.float())
+    filtered = th.fft.irfft2(spectrum * H, s=image.shape[-2:])
+    return filtered.abs_()
 
 def _butterworth_filter(rows, cols, thresh, order):
     # X and Y matrices with ranges normalised to +/- 0.5
@@ -101,11 +115,25 @@ def _butterworth_filter(rows, cols, thresh, order):
     return f
 
 
+@functools.lru_cache(maxsize=32)
+def _butterworth_rfilter(rows, cols, thresh, order, device=None):
+    # same filter as _butterworth_filter, built on the frequency grid of rfft2 (zero frequency at [0, 0]),
+    # which also puts the zero frequency exactly on a bin for odd sizes
+    y = np.fft.fftfreq(rows).reshape(-1, 1)
+    x = np.fft.rfftfreq(cols).reshape(1, -1)
+    radius = np.sqrt(np.square(x) + np.square(y))
+    H = np.reciprocal(1 + np.power(radius / thresh, 2 * order))
+    return th.from_numpy(H.astype(np.float32)).to(device)
+
+
 class Blur(object):
     """
     Blur an image with a Butterworth filter with a frequency
     cutoff matching local block size
     """
+
+    deterministic = True
+
     def __init__(self, threshold, order=5):
         """
         scramble blocksize of 128 => filter threshold of 64
@@ -113,6 +141,9 @@ class Blur(object):
         scramble blocksize of 32 => filter threshold of 16
         scramble blocksize of 16 => filter threshold of 8
         scramble blocksize of 8 => filter threshold of 4
+
+        Inputs can be (C, H, W) images or (N, C, H, W) batches, all channels and
+        samples are filtered in a single FFT.
         """
         self.threshold = threshold
         self.order = order
@@ -123,15 +154,14 @@ class Blur(object):
         """
         outputs = []
         for idx, _input in enumerate(inputs):
-            rows = _input.size(1)
-            cols = _input.size(2)
+            rows = _input.size(-2)
+            cols = _input.size(-1)
             fc = self.threshold # threshold
             fs = 128.0 # max frequency
             n  = self.order # filter order
             fc_rad = (fc/fs)*0.5
-            H = _butterworth_filter(rows, cols, fc_rad, n)
-            _input_blurred = _blur_image(_input.numpy().astype('uint8'), H)
-            _input_blurred = th.from_numpy(_input_blurred).float()
+            H = _butterworth_rfilter(rows, cols, fc_rad, n, _input.device)
+            _input_blurred = _blur_image(_input, H).clamp_(0, 255)
             outputs.append(_input_blurred)
 
         return outputs if idx >= 1 else outputs[0]
@@ -150,9 +180,3 @@ class RandomChoiceBlur(object):
         threshold = random.choice(self.thresholds)
         outputs = Blur(threshold=threshold, order=self.order)(*inputs)
         return outputs
-
-
-
-
-
-
@@ -30,6 +30,8 @@ def _blend(img1, img2, alpha):
 
 class Grayscale(object):
 
+    deterministic = True
+
     def __init__(self, keep_channels=False):
         """
         Convert RGB image to grayscale
@@ -79,6 +81,8 @@ class RandomGrayscale(object):
 
 class Gamma(object):
 
+    deterministic = True
+
     def __init__(self, value):
         """
         Performs Gamma Correction on the input image. Also known as 
@@ -103,6 +107,10 @@ class Gamma(object):
             outputs.append(_input)
         return outputs if idx >= 1 else outputs[0]
 
+    def _call_inplace(self, x):
+        # used by Compose to fuse chains of pointwise ops (x is a floating point tensor it owns)
+        return x.pow_(self.value)
+
 class RandomGamma(object):
 
     def __init__(self, min_val, max_val):
@@ -169,6 +177,9 @@ class RandomChoiceGamma(object):
 # ----------------------------------------------------
 
 class Brightness(object):
+
+    deterministic = True
+
     def __init__(self, value):
         """
         Alter the Brightness of an image
@@ -191,6 +202,10 @@ class Brightness(object):
             outputs.append(_input)
         return outputs if idx >= 1 else outputs[0]
 
+    def _call_inplace(self, x):
+        # used by Compose to fuse chains of pointwise ops (x is a floating point tensor it owns)
+        return x.add_(self.value).clamp_(0, 1)
+
 class RandomBrightness(object):
 
     def __init__(self, min_val, max_val):
@@ -240,6 +255,8 @@ class RandomChoiceBrightness(object):
 
 class Saturation(object):
 
+    deterministic = True
+
     def __init__(self, value):
         """
         Alter the Saturation of image
@@ -316,6 +333,9 @@ class Contrast(object):
     """
 
     """
+
+    deterministic = True
+
     def __init__(self, value):
         """
         Adjust Contrast of image.
@@ -345,6 +365,11 @@ class Contrast(object):
             outputs.append(_input)
         return outputs if idx >= 1 else outputs[0]
 
+    def _call_inplace(self, x):
+        # used by Compose to fuse chains of pointwise ops (x is a floating point tensor it owns)
+        channel_means = x.mean(1, keepdim=True).mean(2, keepdim=True)
+        return x.sub_(channel_means).mul_(self.value).add_(channel_means).clamp_(0, 1)
+
 class RandomContrast(object):
 
     def __init__(self, min_val, max_val):
@@ -396,26 +421,148 @@ class RandomChoiceContrast(object):
 def rgb_to_hsv(x):
     """
     Convert from RGB to HSV
-    """
-    hsv = th.zeros(*x.size())
-    c_min = x.min(0)
-    c_max = x.max(0)
 
-    delta = c_max[0] - c_min[0]
+    Works on a single (3, H, W) image or on a (N, 3, H, W) batch.
+    H is returned in degrees [0, 360), S and V in [0, 1].
+    """
+    c_max, c_argmax = x.max(-3)
+    c_min = x.min(-3)[0]
+    delta = c_max - c_min
+    # avoid dividing by zero on gray pixels (their hue and saturation are 0)
+    safe_delta = th.where(delta > 0, delta, th.ones_like(delta))
+    r, g, b = x.unbind(-3)
 
     # set H
-    r_idx = c_max[1].eq(0)
-    hsv[0][r_idx] = ((x[1][r_idx] - x[2][r_idx]) / delta[r_idx]) % 6
-    g_idx = c_max[1].eq(1)
-    hsv[0][g_idx] = 2 + ((x[2][g_idx] - x[0][g_idx]) / delta[g_idx])
-    b_idx = c_max[1].eq(2)
-    hsv[0][b_idx] = 4 + ((x[0][b_idx] - x[1][b_idx]) / delta[b_idx])
-    hsv[0] = hsv[0].mul(60)
+    h = th.where(c_argmax == 0, ((g - b) / safe_delta) % 6,
+                 th.where(c_argmax == 1, 2 + (b - r) / safe_delta, 4 + (r - g) / safe_delta))
+    h = th.where(delta > 0, h, th.zeros_like(h)).mul_(60)
 
     # set S
-    hsv[1] = delta / c_max[0]
+    s = th.where(c_max > 0, delta / th.where(c_max > 0, c_max, th.ones_like(c_max)), th.zeros_like(c_max))
+
+    # set V
+    return th.stack([h, s, c_max], -3)
+
+
+def hsv_to_rgb(x):
+    """
+    Convert from HSV (as returned by rgb_to_hsv) to RGB
+
+    Works on a single (3, H, W) image or on a (N, 3, H, W) batch.
+    """
+    h, s, v = x.unbind(-3)
+    h = (h / 60).unsqueeze(-3)
+    n = th.tensor([5., 3., 1.], dtype=x.dtype, device=x.device).view(3, 1, 1)
+    k = (n + h) % 6
+    weight = th.min(k, 4 - k).clamp_(0, 1)
+    return v.unsqueeze(-3) - (v * s).unsqueeze(-3) * weight
+
+# ----------------------------------------------------
+# ----------------------------------------------------
+
+class ColorJitter(object):
+
+    batch = True        # accepts whole (N, C, H, W) batches as well as single images
 
-    # set V - good
-    hsv[2] = c_max[0]
+    def __init__(self,
+                 brightness=None,
+                 contrast=None,
+                 saturation=None,
+                 hue=None,
+                 gamma=None,
+                 p=1.0):
+        """
+        Randomly alter brightness, contrast, saturation, hue and gamma of an image
+        or of every sample of a (N, C, H, W) batch in a single vectorized pass.
+        Parameters are drawn independently for every sample, and the ops are applied
+        in place on one working buffer in the order listed below.
+        Works on CPU as well as on the training device.
+
+        NOTE: assumes intensities between 0 and 1.
+        Saturation and hue require 3 (RGB) channels.
+
+        Arguments
+        ---------
+        brightness : tuple/list of 2 floats between [-1, 1]
+            additive brightness bounds, see Brightness (0 = no change)
+
+        contrast : tuple/list of 2 floats
+            contrast factor bounds, see Contrast (1 = no change)
+
+        saturation : tuple/list of 2 floats between [-1, 1]
+            saturation bounds, see Saturation (0 = no change)
+
+        hue : tuple/list of 2 floats between [-0.5, 0.5]
+            hue shift bounds as a fraction of the color wheel (0 = no change)
+
+        gamma : tuple/list of 2 floats
+            gamma bounds, see Gamma (1 = no change)
+
+        p : float between [0,1]
+            probability with which a sample is altered at all
+        """
+        if all(r is None for r in (brightness, contrast, saturation, hue, gamma)):
+            raise ValueError('Must give at least one transform parameter')
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.hue = hue
+        self.gamma = gamma
+        self.p = p
 
-    return hsv
+    def sample_params(self, n, device=None):
+        """
+        Draw per-sample parameters for n samples
+
+        :return: dict - op name -> torch tensor of size (n,)
+        """
+        apply = th.rand(n, device=device) < self.p
+        params = {}
+        for name, identity in (('brightness', 0.), ('contrast', 1.), ('saturation', 0.), ('hue', 0.), ('gamma', 1.)):
+            bounds = getattr(self, name)
+            if bounds is not None:
+                value = th.rand(n, device=device) * (bounds[1] - bounds[0]) + bounds[0]
+                params[name] = th.where(apply, value, th.full_like(value, identity))
+        return params
+
+    def apply(self, x, params):
+        """
+        Apply the given per-sample parameters (see sample_params) to an image or a batch
+
+        :return: new floating point tensor, x is left untouched
+        """
+        batched = x.dim() == 4
+        if not batched:
+            x = x.unsqueeze(0)
+        view = [x.size(0), 1, 1, 1]
+        out = x.float()
+        if out is x:
+            out = out.clone()
+
+        if 'brightness' in params:
+            out.add_(params['brightness'].view(view)).clamp_(0, 1)
+        if 'contrast' in params:
+            channel_means = out.mean(dim=(-2, -1), keepdim=True)
+            out.sub_(channel_means).mul_(params['contrast'].view(view)).add_(channel_means).clamp_(0, 1)
+        if 'saturation' in params:
+            alpha = 1.0 + params['saturation'].view(view)
+            gray = out[:, 0:1] * 0.299 + out[:, 1:2] * 0.587 + out[:, 2:3] * 0.114
+            out.mul_(alpha).add_(gray.mul_(1 - alpha)).clamp_(0, 1)
+        if 'hue' in params:
+            hsv = rgb_to_hsv(out)
+            hsv[:, 0].add_(params['hue'].view(-1, 1, 1) * 360).remainder_(360)
+            out = hsv_to_rgb(hsv).clamp_(0, 1)
+        if 'gamma' in params:
+            out.pow_(params['gamma'].view(view))
+
+        return out if batched else out[0]
+
+    def __call__(self, *inputs):
+        x = inputs[0]
+        n = x.size(0) if x.dim() == 4 else 1
+        params = self.sample_params(n, device=x.device)
+        self.params = params
+        outputs = []
+        for idx, _input in enumerate(inputs):
+            outputs.append(self.apply(_input, params))
+        return outputs if idx >= 1 else outputs[0]
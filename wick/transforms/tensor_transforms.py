@@ -1,4 +1,5 @@
 
+import copy
 import os
 import random
 import math
@@ -11,7 +12,7 @@ class Compose(object):
     """
     Composes several transforms together.
     """
-    def __init__(self, transforms):
+    def __init__(self, transforms, fuse=True, deterministic_prefix=None):
         """
         Composes (chains) several transforms together into
         a single transform
@@ -20,16 +21,187 @@ class Compose(object):
         ---------
         transforms : a list of transforms
             transforms will be applied sequentially
+
+        fuse : boolean
+            if true, adjacent compatible transforms are fused:
+                - consecutive affine transforms (Rotate, Translate, Shear, Zoom and
+                  their random variants) are combined into a single matrix and
+                  interpolated only once
+                - consecutive pointwise ops (Brightness, Contrast, Gamma,
+                  RangeNormalize, TypeCast) share a single buffer and run in-place
+            Dimension shuffles (ChannelsFirst/Last, Transpose, AddChannel) already
+            return views and are left as they are.
+
+        deterministic_prefix : integer (optional)
+            number of leading transforms whose output only depends on the input
+            (e.g. resizing, casting, normalization). Datasets use split_deterministic()
+            to cache the output of this prefix and only rerun the remaining (random)
+            transforms every epoch. If not given, the prefix is detected from the
+            transforms' `deterministic` attribute.
         """
         self.transforms = transforms
+        self.fuse = fuse
+        self.deterministic_prefix = deterministic_prefix
+        self._stages = _fuse_transforms(transforms) if fuse else transforms
 
     def __call__(self, *inputs):
-        for transform in self.transforms:
+        for transform in getattr(self, '_stages', self.transforms):
             if not isinstance(inputs, (list,tuple)):
                 inputs = [inputs]
             inputs = transform(*inputs)
         return inputs
 
+    @property
+    def deterministic(self):
+        return self._prefix_length() == len(self.transforms)
+
+    def _prefix_length(self):
+        if getattr(self, 'deterministic_prefix', None) is not None:
+            return self.deterministic_prefix
+        length = 0
+        while length < len(self.transforms) and is_deterministic(self.transforms[length]):
+            length += 1
+        return length
+
+    def split_deterministic(self):
+        """
+        Split into the deterministic prefix and the remaining transforms
+
+        :return: (prefix, suffix) Compose objects, either of which is None when empty
+        """
+        length = self._prefix_length()
+        fuse = getattr(self, 'fuse', False)
+        prefix = Compose(self.transforms[:length], fuse=fuse) if length > 0 else None
+        suffix = Compose(self.transforms[length:], fuse=fuse) if length < len(self.transforms) else None
+        return prefix, suffix
+
+
+# torchvision transforms whose output only depends on their input
+_TORCHVISION_DETERMINISTIC = {'Resize', 'CenterCrop', 'Pad', 'Grayscale', 'ToTensor', 'PILToTensor', 'ToPILImage',
+                              'ConvertImageDtype', 'Normalize'}
+
+
+def is_deterministic(transform):
+    """
+    Whether a transform always produces the same output for the same input (so its result may be cached).
+    Transforms opt in with a truthy `deterministic` attribute; common torchvision transforms are recognized by name.
+    """
+    if getattr(transform, 'deterministic', False) is True:
+        return True
+    cls = type(transform)
+    return cls.__module__.startswith('torchvision.transforms') and cls.__name__ in _TORCHVISION_DETERMINISTIC
+
+
+def split_deterministic(transform):
+    """
+    Split any transform into a cacheable deterministic prefix and a suffix that has to run on every call
+
+    :param transform: transform, Compose or None
+    :return: (prefix, suffix), either of which may be None
+    """
+    if transform is None:
+        return None, None
+    if hasattr(transform, 'split_deterministic'):
+        return transform.split_deterministic()
+    if type(transform).__name__ == 'Compose' and isinstance(getattr(transform, 'transforms', None), (tuple, list)):
+        return Compose(list(transform.transforms), fuse=False).split_deterministic()      # e.g. torchvision's Compose
+    if is_deterministic(transform):
+        return transform, None
+    return None, transform
+
+
+def _fusion_kind(transform):
+    from .affine_transforms import (Rotate, RandomRotate, RandomChoiceRotate,
+                                    Translate, RandomTranslate, RandomChoiceTranslate,
+                                    Shear, RandomShear, RandomChoiceShear,
+                                    Zoom, RandomZoom, RandomSquareZoom, RandomChoiceZoom,
+                                    RandomAffine)
+    affine_types = (Rotate, RandomRotate, RandomChoiceRotate,
+                    Translate, RandomTranslate, RandomChoiceTranslate,
+                    Shear, RandomShear, RandomChoiceShear,
+                    Zoom, RandomZoom, RandomSquareZoom, RandomChoiceZoom,
+                    RandomAffine)
+    if isinstance(transform, affine_types) and not transform.lazy:
+        return 'affine'
+    if hasattr(transform, '_call_inplace') or (isinstance(transform, TypeCast) and not isinstance(transform.dtype, (tuple,list))):
+        return 'pointwise'
+    return None
+
+
+def _fuse_transforms(transforms):
+    """
+    Group adjacent transforms of the same fusion kind into fused stages
+    """
+    stages = []
+    idx = 0
+    while idx < len(transforms):
+        kind = _fusion_kind(transforms[idx])
+        end = idx + 1
+        while kind is not None and end < len(transforms) and _fusion_kind(transforms[end]) == kind:
+            # affine transforms can only share one interpolation if they agree on it
+            if kind == 'affine' and transforms[end].interp != transforms[idx].interp:
+                break
+            end += 1
+
+        group = transforms[idx:end]
+        if len(group) == 1:
+            stages.append(group[0])
+        elif kind == 'affine':
+            stages.append(_FusedAffine(group))
+        else:
+            stages.append(_FusedPointwise(group))
+        idx = end
+    return stages
+
+
+class _FusedAffine(object):
+    """
+    Chain of affine transforms applied with a single interpolation
+    """
+    def __init__(self, transforms):
+        self.interp = transforms[0].interp
+        # lazy copies only return their transform matrix, the originals are left untouched
+        self.transforms = []
+        for t in transforms:
+            t = copy.copy(t)
+            t.lazy = True
+            self.transforms.append(t)
+
+    def __call__(self, *inputs):
+        from .affine_transforms import _apply_affine
+        tform_matrix = self.transforms[0](inputs[0])
+        for tform in self.transforms[1:]:
+            tform_matrix = tform_matrix.mm(tform(inputs[0]))
+        return _apply_affine(inputs, tform_matrix, self.interp)
+
+
+class _FusedPointwise(object):
+    """
+    Chain of pointwise ops that allocates at most one output buffer per input
+    """
+    def __init__(self, transforms):
+        self.transforms = transforms
+
+    def __call__(self, *inputs):
+        outputs = []
+        for idx, _input in enumerate(inputs):
+            owned = False       # whether _input is a buffer we allocated and may modify in place
+            for tform in self.transforms:
+                if isinstance(tform, TypeCast):
+                    _cast = _input.type(tform.dtype)
+                    owned = owned or _cast is not _input
+                    _input = _cast
+                elif not _input.is_floating_point():
+                    _input = tform(_input)
+                    owned = True
+                else:
+                    if not owned:
+                        _input = _input.clone()
+                        owned = True
+                    _input = tform._call_inplace(_input)
+            outputs.append(_input)
+        return outputs if idx >= 1 else outputs[0]
+
 
 class RandomChoiceCompose(object):
     """
@@ -53,6 +225,9 @@ class ToTensor(object):
     """
     Converts a numpy array to torch.Tensor
     """
+
+    deterministic = True
+
     def __call__(self, *inputs):
         outputs = []
         for idx, _input in enumerate(inputs):
@@ -61,6 +236,57 @@ class ToTensor(object):
         return outputs if idx >= 1 else outputs[0]
 
 
+class MaskToTensor(object):
+    """
+    Converts a segmentation mask (PIL image or numpy array of class indices)
+    to a torch.Tensor WITHOUT rescaling pixel values
+    """
+
+    deterministic = True
+
+    def __init__(self, dtype='byte'):
+        """
+        Converts a segmentation mask to a class-index tensor
+
+        Arguments
+        ---------
+        dtype : string in {'byte', 'long'}
+            'byte' keeps the mask as uint8 (compact, cheap to pass between workers)
+            'long' returns int64 indices as expected by nll_loss / cross_entropy
+        """
+        if dtype not in {'byte', 'long'}:
+            raise ValueError('dtype must be one of {byte, long}')
+        self.dtype = th.uint8 if dtype == 'byte' else th.int64
+
+    def __call__(self, *inputs):
+        outputs = []
+        for idx, _input in enumerate(inputs):
+            _input = th.from_numpy(np.array(_input, copy=True))
+            outputs.append(_input.to(self.dtype))
+        return outputs if idx >= 1 else outputs[0]
+
+
+class ImageToByteTensor(object):
+    """
+    Converts an image (PIL image or (H, W[, C]) numpy array) to a contiguous uint8 (C, H, W)
+    torch.Tensor WITHOUT converting it to float. Batches of such tensors are 4x smaller
+    to pass between loader workers and to copy to the device than float32 batches;
+    convert and normalize them on the device with DeviceNormalize.
+    """
+
+    deterministic = True
+
+    def __call__(self, *inputs):
+        outputs = []
+        for idx, _input in enumerate(inputs):
+            _input = np.asarray(_input, dtype=np.uint8)
+            if _input.ndim == 2:
+                _input = _input[:, :, None]
+            _input = th.from_numpy(np.ascontiguousarray(_input.transpose(2, 0, 1)))
+            outputs.append(_input)
+        return outputs if idx >= 1 else outputs[0]
+
+
 class ToFile(object):
     """
     Saves an image to file. Useful as a pass-through transform
@@ -98,6 +324,8 @@ class ToNumpyType(object):
     Converts an object to a specific numpy type (with the idea to be passed to ToTensor() next)
     '''
 
+    deterministic = True
+
     def __init__(self, type):
         '''
         Convert input to a given numpy.type
@@ -119,6 +347,9 @@ class ChannelsLast(object):
     Transposes a tensor so that the channel dim is last
     `HWC` and `DHWC` are aliases for this transform.    
     """
+
+    deterministic = True
+
     def __init__(self, safe_check=False):
         """
         Transposes a tensor so that the channel dim is last
@@ -154,7 +385,13 @@ class ChannelsFirst(object):
     """
     Transposes a tensor so that the channel dim is first.
     `CHW` and `CDHW` are aliases for this transform.
+
+    The result is a view (no copy), so its memory is still channels-last. Batch such samples
+    with data_utils.collate_channels_last to get channels_last batches without any transpose copy.
     """
+
+    deterministic = True
+
     def __init__(self, safe_check=False):
         """
         Transposes a tensor so that the channel dim is first.
@@ -190,6 +427,9 @@ class TypeCast(object):
     """
     Cast a torch.Tensor to a different type
     """
+
+    deterministic = True
+
     def __init__(self, dtype='float'):
         """
         Cast a torch.Tensor to a different type
@@ -253,6 +493,9 @@ class AddChannel(object):
     This will make an image of size (28, 28) to now be
     of size (1, 28, 28), for example.
     """
+
+    deterministic = True
+
     def __init__(self, axis=0):
         """
         Adds a dummy channel to an image, also known as
@@ -278,6 +521,8 @@ Unsqueeze = AddChannel
 
 class Transpose(object):
 
+    deterministic = True
+
     def __init__(self, dim1, dim2):
         """
         Swaps two dimensions of a tensor
@@ -339,6 +584,9 @@ class RangeNormalize(object):
         >>> rn = RangeNormalize(0,1)
         >>> x_norm = rn(x)
     """
+
+    deterministic = True
+
     def __init__(self, 
                  min_val, 
                  max_val):
@@ -366,11 +614,22 @@ class RangeNormalize(object):
             outputs.append(_input)
         return outputs if idx >= 1 else outputs[0]
 
+    def _call_inplace(self, x):
+        # used by Compose to fuse chains of pointwise ops (x is a floating point tensor it owns)
+        _min_val = x.min()
+        _max_val = x.max()
+        a = (self.max_val - self.min_val) / (_max_val - _min_val)
+        b = self.max_val - a * _max_val
+        return x.mul_(a).add_(b)
+
 
 class StdNormalize(object):
     """
     Normalize torch tensor to have zero mean and unit std deviation
     """
+
+    deterministic = True
+
     def __call__(self, *inputs):
         outputs = []
         for idx, _input in enumerate(inputs):
@@ -381,47 +640,70 @@ class StdNormalize(object):
 
 class Slice2D(object):
 
-    def __init__(self, axis=0, reject_zeros=False):
+    def __init__(self, axis=0, reject_zeros=False, slice_index=None):
         """
         Take a random 2D slice from a 3D image along 
         a given axis. This image should not have a 4th channel dim.
 
+        Works on torch tensors and numpy arrays. For memory mapped volumes
+        (e.g. loaded with npy_loader(path, mmap_mode='r')) only the selected
+        slice is read from disk.
+
         Arguments
         ---------
         axis : integer in {0, 1, 2}
             the axis on which to take slices
 
         reject_zeros : boolean
-            whether to reject slices that are all zeros
+            whether to reject slices that are all zeros (the target's slices
+            if a target is given). Instead of drawing slices until a non-empty
+            one is found, a slice is drawn from the volume's non-empty slices.
+            For memory mapped volumes these are computed once per file (version) and cached.
+
+        slice_index : dict (default: None)
+            precomputed non-empty slices, .npy path -> slice indices
+            (see datasets.data_utils.build_nonzero_slice_index). Looked up
+            by the file name of memory mapped (target) volumes.
         """
         self.axis = axis
         self.reject_zeros = reject_zeros
+        self.slice_index = slice_index
+        self._cache = {}
+
+    def _nonzero_slices(self, volume):
+        from ..datasets.data_utils import nonzero_slices
+
+        filename = getattr(volume, 'filename', None)       # set for np.memmap
+        if filename is None:
+            return nonzero_slices(volume, axis=self.axis)
+        filename = os.path.abspath(filename)
+        if self.slice_index is not None and filename in self.slice_index:
+            return self.slice_index[filename]
+        # a rewritten file gets a new key, so a stale index is never used
+        stat = os.stat(filename)
+        key = (filename, stat.st_mtime_ns, stat.st_size)
+        if key not in self._cache:
+            self._cache = {k: v for k, v in self._cache.items() if k[0] != filename}
+            self._cache[key] = nonzero_slices(volume, axis=self.axis)
+        return self._cache[key]
+
+    def _take(self, volume, keep_slice):
+        if th.is_tensor(volume):
+            return volume.select(self.axis, keep_slice)
+        return np.array(np.take(volume, keep_slice, axis=self.axis))   # only this slice is read and copied
 
     def __call__(self, x, y=None):
-        while True:
-            keep_slice  = random.randint(0,x.size(self.axis)-1)
-            if self.axis == 0:
-                slice_x = x[keep_slice,:,:]
-                if y is not None:
-                    slice_y = y[keep_slice,:,:]
-            elif self.axis == 1:
-                slice_x = x[:,keep_slice,:]
-                if y is not None:
-                    slice_y = y[:,keep_slice,:]
-            elif self.axis == 2:
-                slice_x = x[:,:,keep_slice]
-                if y is not None:
-                    slice_y = y[:,:,keep_slice]
-
-            if not self.reject_zeros:
-                break
-            else:
-                if y is not None and th.sum(slice_y) > 0:
-                        break
-                elif th.sum(slice_x) > 0:
-                        break
+        if self.reject_zeros:
+            candidates = self._nonzero_slices(y if y is not None else x)
+            if len(candidates) == 0:
+                raise ValueError('Slice2D: volume has no non-zero slices along axis %i' % self.axis)
+            keep_slice = int(candidates[random.randrange(len(candidates))])
+        else:
+            keep_slice = random.randint(0, x.shape[self.axis] - 1)
+
+        slice_x = self._take(x, keep_slice)
         if y is not None:
-            return slice_x, slice_y
+            return slice_x, self._take(y, keep_slice)
         else:
             return slice_x
 
@@ -451,6 +733,8 @@ class RandomCrop(object):
 
 class SpecialCrop(object):
 
+    deterministic = True
+
     def __init__(self, size, crop_type=0):
         """
         Perform a special crop - one of the four corners or center crop
@@ -512,6 +796,8 @@ class SpecialCrop(object):
 
 class Pad(object):
 
+    deterministic = True
+
     def __init__(self, size):
         """
         Pads an image to the given size
@@ -539,6 +825,8 @@ class Pad(object):
 
 class PadNumpy(object):
 
+    deterministic = True
+
     def __init__(self, size):
         """
         Pads a Numpy image to the given size
@@ -562,9 +850,33 @@ class PadNumpy(object):
             return x
 
 
+def _dihedral(x, k=0, transpose=False):
+    # exact (interpolation-free) symmetry of the square acting on the last two dims
+    if transpose:
+        x = x.transpose(-2, -1)
+    if k % 4:
+        x = th.rot90(x, k, dims=(-2, -1))
+    return x
+
+
+def _apply_per_sample(inputs, codes, fn):
+    """
+    Apply fn(x, code) to every sample of a batch, grouping samples that share the same code
+    so only one op per distinct code is issued
+    """
+    outputs = []
+    for idx, _input in enumerate(inputs):
+        out = th.empty_like(_input)
+        for code in codes.unique().tolist():
+            sel = (codes == code).nonzero().view(-1).to(_input.device)
+            out[sel] = fn(_input[sel], code)
+        outputs.append(out)
+    return outputs if idx >= 1 else outputs[0]
+
+
 class RandomFlip(object):
 
-    def __init__(self, h=True, v=False, p=0.5):
+    def __init__(self, h=True, v=False, p=0.5, batch=False):
         """
         Randomly flip an image horizontally and/or vertically with
         some probability.
@@ -579,40 +891,132 @@ class RandomFlip(object):
 
         p : float between [0,1]
             probability with which to apply allowed flipping operations
+
+        batch : boolean
+            if true, inputs are (N, ...) batches and every sample is flipped
+            (or not) independently
         """
         self.horizontal = h
         self.vertical = v
         self.p = p
+        self.batch = batch
 
-    def __call__(self, x, y=None):
-        x = x.numpy()
-        if y is not None:
-            y = y.numpy()
-        # horizontal flip with p = self.p
-        if self.horizontal:
-            if random.random() < self.p:
-                x = x.swapaxes(2, 0)
-                x = x[::-1, ...]
-                x = x.swapaxes(0, 2)
-                if y is not None:
-                    y = y.swapaxes(2, 0)
-                    y = y[::-1, ...]
-                    y = y.swapaxes(0, 2)
-        # vertical flip with p = self.p
-        if self.vertical:
-            if random.random() < self.p:
-                x = x.swapaxes(1, 0)
-                x = x[::-1, ...]
-                x = x.swapaxes(0, 1)
-                if y is not None:
-                    y = y.swapaxes(1, 0)
-                    y = y[::-1, ...]
-                    y = y.swapaxes(0, 1)
-        if y is None:
-            # must copy because torch doesnt current support neg strides
-            return th.from_numpy(x.copy())
-        else:
-            return th.from_numpy(x.copy()),th.from_numpy(y.copy())
+    def __call__(self, *inputs):
+        if self.batch:
+            n = inputs[0].size(0)
+            # bit 0 = horizontal flip, bit 1 = vertical flip
+            codes = th.zeros(n, dtype=th.long)
+            if self.horizontal:
+                codes += (th.rand(n) < self.p).long()
+            if self.vertical:
+                codes += 2 * (th.rand(n) < self.p).long()
+            return _apply_per_sample(inputs, codes, self._flip)
+
+        code = 0
+        if self.horizontal and random.random() < self.p:
+            code += 1
+        if self.vertical and random.random() < self.p:
+            code += 2
+        outputs = []
+        for idx, _input in enumerate(inputs):
+            outputs.append(self._flip(_input, code))
+        return outputs if idx >= 1 else outputs[0]
+
+    @staticmethod
+    def _flip(x, code):
+        dims = [d for d, bit in ((-1, 1), (-2, 2)) if code & bit]
+        return x.flip(dims) if dims else x
+
+
+class Rot90(object):
+
+    deterministic = True
+
+    def __init__(self, k=1):
+        """
+        Rotate an image by k * 90 degrees (counter-clockwise) in the plane of the last two dims.
+        This is exact and does not interpolate.
+
+        Arguments
+        ---------
+        k : integer
+            number of quarter turns
+        """
+        self.k = k
+
+    def __call__(self, *inputs):
+        outputs = []
+        for idx, _input in enumerate(inputs):
+            outputs.append(_dihedral(_input, self.k))
+        return outputs if idx >= 1 else outputs[0]
+
+
+class RandomRot90(object):
+
+    def __init__(self, p=0.75, batch=False):
+        """
+        Randomly rotate an image by 90, 180 or 270 degrees with some probability.
+        Non-square images change shape when rotated by an odd number of quarter turns.
+
+        Arguments
+        ---------
+        p : float between [0,1]
+            probability with which to rotate at all. The number of quarter turns
+            is then chosen uniformly from {1, 2, 3}, so p=0.75 samples all four
+            orientations uniformly
+
+        batch : boolean
+            if true, inputs are (N, C, H, W) batches (of square images) and every
+            sample is rotated independently
+        """
+        self.p = p
+        self.batch = batch
+
+    def __call__(self, *inputs):
+        if self.batch:
+            n = inputs[0].size(0)
+            codes = th.randint(1, 4, (n,)) * (th.rand(n) < self.p).long()
+            _check_square_batch(inputs[0], codes % 2 == 1)
+            return _apply_per_sample(inputs, codes, lambda x, k: _dihedral(x, k))
+
+        k = random.randint(1, 3) if random.random() < self.p else 0
+        return Rot90(k)(*inputs)
+
+
+class RandomDihedral(object):
+
+    def __init__(self, batch=False):
+        """
+        Apply one of the 8 symmetries of the square (identity, 3 rotations by multiples
+        of 90 degrees, 4 flips/transpositions) chosen uniformly at random.
+        These are exact and lossless, so they are a cheap augmentation for segmentation.
+
+        Arguments
+        ---------
+        batch : boolean
+            if true, inputs are (N, C, H, W) batches (of square images) and every
+            sample gets its own symmetry
+        """
+        self.batch = batch
+
+    def __call__(self, *inputs):
+        if self.batch:
+            n = inputs[0].size(0)
+            # code = k + 4 * transpose
+            codes = th.randint(0, 8, (n,))
+            _check_square_batch(inputs[0], (codes % 2 == 1) ^ (codes >= 4))
+            return _apply_per_sample(inputs, codes, lambda x, c: _dihedral(x, c % 4, c >= 4))
+
+        code = random.randint(0, 7)
+        outputs = []
+        for idx, _input in enumerate(inputs):
+            outputs.append(_dihedral(_input, code % 4, code >= 4))
+        return outputs if idx >= 1 else outputs[0]
+
+
+def _check_square_batch(x, swaps_axes):
+    if x.size(-2) != x.size(-1) and bool(swaps_axes.any()):
+        raise ValueError('Per-sample rotations/transpositions of a batch require square images, got %s' % str(tuple(x.size())))
 
 
 class RandomOrder(object):
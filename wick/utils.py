@@ -2,11 +2,13 @@
 Utility functions for th.Tensors
 """
 
+import functools
 import pickle
 import random
 import numpy as np
 
 import torch as th
+import torch.nn.functional as F
 
 
 def th_allclose(x, y):
@@ -64,7 +66,7 @@ def th_gather_nd(x, coords):
     return x_gather
 
 
-def th_affine2d(x, matrix, mode='bilinear', center=True):
+def th_affine2d(x, matrix, mode='bilinear', center=True, backend='grid_sample'):
     """
     2D Affine image transform on th.Tensor
     
@@ -84,6 +86,10 @@ def th_affine2d(x, matrix, mode='bilinear', center=True):
         so the transform is applied about the center
         of the image rather than the origin
 
+    backend : string in {'grid_sample', 'gather'}
+        'grid_sample' uses a cached sampling grid and F.grid_sample (fast, default)
+        'gather' uses the original meshgrid + gather based interpolation
+
     Example
     ------- 
     >>> import torch
@@ -95,6 +101,11 @@ def th_affine2d(x, matrix, mode='bilinear', center=True):
     >>> xn = th_affine2d(x, matrix, mode='nearest')
     >>> xb = th_affine2d(x, matrix, mode='bilinear')
     """
+    if backend == 'grid_sample':
+        grid = th_affine2d_grid(matrix, x.size()[1:], center=center, device=x.device)
+        return th_grid_sample2d(x, grid, mode=mode)
+    elif backend != 'gather':
+        raise ValueError('backend must be one of {grid_sample, gather}')
 
     if matrix.dim() == 2:
         matrix = matrix[:2,:]
@@ -133,6 +144,94 @@ def th_affine2d(x, matrix, mode='bilinear', center=True):
     return x_transformed
 
 
+@functools.lru_cache(maxsize=32)
+def _th_base_grid2d(height, width, device):
+    """
+    (row, col) pixel coordinates of every pixel, size (H*W, 2).
+    Cached per (H, W, device) since it only depends on the image size.
+    """
+    return th_iterproduct(height, width).float().to(device)
+
+
+def th_affine2d_grid(matrix, size, center=True, device=None):
+    """
+    Build the sampling grid for a 2D affine transform, to be used with th_grid_sample2d.
+    The grid can be reused for every input that shares the same (H, W)
+    (e.g. an image and its mask).
+
+    Arguments
+    ---------
+    matrix : th.Tensor of size (2, 3), (3, 3), (N, 2, 3) or (N, 3, 3)
+        transformation matrix in (row, col) pixel coordinates,
+        same convention as th_affine2d
+
+    size : tuple of (H, W)
+        spatial size of the inputs
+
+    center : boolean
+        whether the transform is applied about the center of the image
+
+    device : torch device (default: device of the matrix)
+
+    Returns
+    -------
+    grid : th.Tensor of size (N, H, W, 2)
+        (row, col) pixel coordinates each output pixel is sampled from
+    """
+    height, width = int(size[-2]), int(size[-1])
+    device = matrix.device if device is None else th.device(device)
+
+    if matrix.dim() == 2:
+        matrix = matrix.unsqueeze(0)
+    matrix = matrix[:, :2, :].to(device=device, dtype=th.float32)
+    A = matrix[:, :, :2]
+    b = matrix[:, :, 2].unsqueeze(1)
+
+    # same arithmetic as the gather backend of th_affine2d, so both sample the same positions
+    coords = _th_base_grid2d(height, width, device).unsqueeze(0).repeat(matrix.size(0), 1, 1)
+    shift = th.tensor([height / 2. - 0.5, width / 2. - 0.5], device=device)
+    if center:
+        coords = coords - shift
+    grid = coords.bmm(A.transpose(1, 2)) + b.expand_as(coords)
+    if center:
+        grid = grid + shift
+    return grid.view(-1, height, width, 2)
+
+
+def th_grid_sample2d(x, grid, mode='bilinear'):
+    """
+    Sample a (C, H, W) tensor with a grid produced by th_affine2d_grid.
+
+    If the grid has one entry per channel, each channel is sampled with its own grid.
+    Integer tensors (e.g. label masks) are sampled with nearest interpolation
+    and keep their dtype.
+    """
+    dtype = x.dtype
+    if not dtype.is_floating_point:
+        mode = 'nearest'
+        x = x.float()
+
+    # clamp (and round) the positions like th_bilinear_interp2d / th_nearest_interp2d,
+    # then convert them to the normalized (x, y) coordinates F.grid_sample expects
+    last = 2 if mode == 'bilinear' else 1
+    coords = []
+    for d, size in ((1, x.size(-1)), (0, x.size(-2))):
+        pos = grid[..., d].clamp(0, max(size - last, 0))
+        if mode == 'nearest':
+            pos = pos.round()
+        coords.append(pos * (2. / max(size - 1, 1)) - 1)
+    grid = th.stack(coords, -1).to(x.dtype)
+
+    if grid.size(0) == 1:
+        out = F.grid_sample(x.unsqueeze(0), grid, mode=mode, padding_mode='border', align_corners=True)[0]
+    else:
+        out = F.grid_sample(x.unsqueeze(1), grid, mode=mode, padding_mode='border', align_corners=True)[:, 0]
+
+    if not dtype.is_floating_point:
+        out = out.round_().to(dtype)
+    return out
+
+
 def th_nearest_interp2d(input, coords):
     """
     2d nearest neighbor interpolation th.Tensor
@@ -394,9 +493,8 @@ def th_random_choice(a, n_samples=1, replace=True, p=None):
             raise ValueError('p must sum to 1.0')
         if not replace:
             raise ValueError('replace must equal true if probabilities given')
-        idx_vec = th.cat([th.zeros(round(p[i]*1000))+i for i in range(len(p))])
-        idx = (th.floor(th.rand(n_samples)*999)).long()
-        idx = idx_vec[idx].long()
+        # exact draw from the given distribution
+        idx = th.multinomial(th.as_tensor(p, dtype=th.double), n_samples, replacement=True)
     selection = a[idx]
     if n_samples == 1:
         selection = selection[0]